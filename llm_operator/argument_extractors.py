@@ -0,0 +1,159 @@
+import re
+import math
+
+
+# Extracted strings that mean the model found no value.
+MISSING_VALUES = {"", "none", "null", "n/a", "unknown"}
+
+
+class RuleExtractor:
+    '''
+    Deterministic extractor for a single argument.
+    Called with the user message, returns the argument value, or None when the value cannot be extracted with confidence.
+    '''
+    def __call__(self, text):
+        raise NotImplementedError
+
+
+class NumberExtractor(RuleExtractor):
+    '''
+    Extracts a number when the message contains exactly one number within [minimum, maximum].
+    '''
+    def __init__(self, type=int, minimum=None, maximum=None):
+        self.type = type
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def __call__(self, text):
+        numbers = re.findall(r"(?<![\w.])-?\d+(?:\.\d+)?", text)
+        if len(numbers) != 1:
+            return None
+        value = float(numbers[0])
+        if self.type is int:
+            if not value.is_integer():
+                return None
+            value = int(value)
+        if self.minimum is not None and value < self.minimum:
+            return None
+        if self.maximum is not None and value > self.maximum:
+            return None
+        return self.type(value)
+
+
+class UnitExtractor(RuleExtractor):
+    '''
+    Extracts the unit written right after a number, e.g. "6 ft" or "10kg", when the message uses exactly one unit.
+
+    units: dict of canonical unit name to the list of its spellings.
+    '''
+    def __init__(self, units):
+        self.aliases = {}
+        for unit, spellings in units.items():
+            for spelling in [unit] + list(spellings):
+                self.aliases[spelling.lower()] = unit
+        alternatives = "|".join(re.escape(alias) for alias in sorted(self.aliases, key=len, reverse=True))
+        self.pattern = re.compile(fr"\d\s*({alternatives})\b", re.IGNORECASE)
+
+    def __call__(self, text):
+        units = {self.aliases[match.lower()] for match in self.pattern.findall(text)}
+        if len(units) != 1:
+            return None
+        return units.pop()
+
+
+class ChoiceExtractor(RuleExtractor):
+    '''
+    Extracts one of a fixed set of values (an enum) when exactly one of them is mentioned in the message.
+
+    choices: dict of value to the list of words that indicate it, or a list of values that are matched literally.
+    '''
+    def __init__(self, choices):
+        if not isinstance(choices, dict):
+            choices = {choice: [] for choice in choices}
+        self.patterns = {
+            choice: re.compile(r"\b(" + "|".join(re.escape(word) for word in [choice] + list(words)) + r")\b", re.IGNORECASE)
+            for choice, words in choices.items()
+        }
+
+    def __call__(self, text):
+        found = [choice for choice, pattern in self.patterns.items() if pattern.search(text)]
+        if len(found) != 1:
+            return None
+        return found[0]
+
+
+class RegexExtractor(RuleExtractor):
+    '''
+    Extracts the given group of the first match of a regular expression, converted to type.
+    '''
+    def __init__(self, pattern, group=1, type=str):
+        self.pattern = re.compile(pattern, re.IGNORECASE)
+        self.group = group
+        self.type = type
+
+    def __call__(self, text):
+        match = self.pattern.search(text)
+        if match is None:
+            return None
+        try:
+            return self.type(match.group(self.group).strip())
+        except ValueError:
+            return None
+
+
+def argument_extractors(**extractors):
+    '''
+    Decorator declaring rule extractors next to an operation, keyed by argument name. e.g.
+
+    @argument_extractors(age=NumberExtractor(int, minimum=0, maximum=130))
+    def setAge(self, age: int):
+        ...
+
+    When every argument of the operation is filled by its rule extractor, the argument extraction LLM call is skipped.
+    '''
+    def decorator(operation):
+        operation.argument_extractors = extractors
+        return operation
+    return decorator
+
+
+def is_valid_argument(argument, value):
+    '''
+    Whether an extracted value fits the type of the argument: a finite number for float, an integral one for int, and
+    a string that is not empty or a placeholder like "none" for str.
+    '''
+    if value is None or isinstance(value, bool):
+        return False
+    if argument.type in ("int", "float"):
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            return False
+        return math.isfinite(number) and (argument.type == "float" or number.is_integer())
+    return str(value).strip().lower() not in MISSING_VALUES
+
+
+def count_rule_matches(extractors, arguments, text):
+    '''
+    Number of arguments that their rule extractor fills from the text.
+    '''
+    return sum(1 for arg in arguments if arg.name in extractors and extractors[arg.name](text) is not None)
+
+
+def apply_rule_extractors(extractors, arguments, text):
+    '''
+    Run the rule extractors of every argument on the text.
+    Returns the arguments dict if all of them are filled with confidence, None otherwise.
+    '''
+    if not extractors or not arguments:
+        return None
+    values = {}
+    for arg in arguments:
+        extractor = extractors.get(arg.name)
+        if extractor is None:
+            return None
+        value = extractor(text)
+        if value is None:
+            return None
+        values[arg.name] = value
+    return values
@@ -1,149 +1,715 @@
 import re
 import os
+import time
+import asyncio
+import inspect
+import threading
 from textwrap import dedent
 from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
 
-from llama import Lamini
 from llm_routing_agent import LLMRoutingAgent
+from router_training import RouterTrainer
+from model_backend import get_default_backend
+from operation_spec import ArgumentSpec, OperationSpec
+from response_cache import ResponseCache
+from argument_extractors import apply_rule_extractors, count_rule_matches, is_valid_argument
+from confidence_gate import ConfidenceGate
+from token_budget import TokenBudget
+from tool_index import ToolIndex
+from operator_registry import registry
+from router_artifact import get_artifact_path
+from tracing import logger, tracer, count_tokens
+
+
+ARGS_PROMPT_TEMPLATE = dedent("""\
+    <s>[INST] <<SYS>> For the given operation, find out the values of the arguments to call the tool with. For the following input format:
+    'User message': the input message from the user.
+    'Tool chosen': tool chosen and its function.
+    'Arguments list': the list of arguments required for the tool. This includes argument name, type and description.
+
+    Output format:
+    'Output': a dictionary of argument names and values.
+    <</SYS>>
+
+    Given:
+    'User message': {input:query}
+    'Tool chosen': {input:operation}
+    'Arguments list': {input:args}
+    generate the 'Output' only. Do not explain the logic.
+    [/INST] """)
+
+ESCALATION_PROMPT_TEMPLATE = dedent("""\
+    <s>[INST] <<SYS>> Choose the operation that best handles the user message. For the following input format:
+    'User message': the input message from the user.
+    'Operations': the names and descriptions of the candidate operations.
+
+    Output format:
+    'Output': the name of the chosen operation, exactly as written in 'Operations'.
+    <</SYS>>
+
+    Given:
+    'User message': {input:query}
+    'Operations': {input:operations}
+    generate the 'Output' only. Do not explain the logic.
+    [/INST] """)
+
+
+class ArgumentExtractor:
+    '''
+    Prepared argument extraction for a single operation.
+    The prompt inputs and the output type are compiled once, when the operation is added.
+    If the operation declares rule extractors for all of its arguments, they are tried first and the LLM call is
+    skipped when they fill every argument.
+    With a token budget, the user message is cut to fit the prompt in the model's budget, keeping its end.
+    The LLM is the model_name of the operator at the time of the call, unless another model is given.
+    '''
+    def __init__(self, operator, operation, arguments, args_prompt, rules=None, token_budget=None):
+        self.operator = operator
+        self.backend = operator.backend
+        self.operation = operation
+        self.arguments = arguments
+        self.args = args_prompt
+        self.output_type = {arg.name: arg.type for arg in arguments}
+        self.rules = rules or {}
+        self.token_budget = token_budget
+        self.rule_hits = 0
+        self.llm_calls = 0
+        self.counts_lock = threading.Lock()
+
+    @property
+    def model_name(self):
+        return self.operator.model_name
+
+    def fit_query(self, query, model_name):
+        budget = self.token_budget
+        fixed_tokens = budget.count(ARGS_PROMPT_TEMPLATE) + budget.count(self.operation) + budget.count(self.args)
+        tokens = budget.count(query)
+        fitted = budget.truncate(query, budget.get_query_budget(model_name, fixed_tokens), keep_end=True)
+        fitted_tokens = tokens if fitted is query else budget.count(fitted)
+        budget.record(fixed_tokens + fitted_tokens, tokens - fitted_tokens)
+        return fitted
+
+    def get_input(self, query, model_name=None):
+        if self.token_budget is not None:
+            query = self.fit_query(query, model_name or self.model_name)
+        return {
+            "query": query,
+            "operation": self.operation,
+            "args": self.args
+        }
+
+    def __call__(self, query, model_name=None):
+        values = apply_rule_extractors(self.rules, self.arguments, query)
+        if values is not None:
+            self.count(rule_hits=1)
+            return values
+        self.count(llm_calls=1)
+        model_name = model_name or self.model_name
+        return self.backend.generate(self.get_input(query, model_name), self.output_type, model_name, ARGS_PROMPT_TEMPLATE)
+
+    def count(self, rule_hits=0, llm_calls=0):
+        '''
+        Count extractions answered by the rule extractors and by the LLM. Extractors are shared by concurrent callers.
+        '''
+        with self.counts_lock:
+            self.rule_hits += rule_hits
+            self.llm_calls += llm_calls
+
+    def get_counts(self):
+        with self.counts_lock:
+            return self.rule_hits, self.llm_calls
+
+    def score(self, query, values):
+        '''
+        Evidence that the extracted values fit this operation: whether every argument is valid for its type, and how
+        many arguments the rule extractors fill from the query.
+        '''
+        values = values if isinstance(values, dict) else {}
+        valid = all(is_valid_argument(arg, values.get(arg.name)) for arg in self.arguments)
+        return valid, count_rule_matches(self.rules, self.arguments, query)
+
+    def batch(self, queries):
+        results = [apply_rule_extractors(self.rules, self.arguments, query) for query in queries]
+        remaining = [i for i, values in enumerate(results) if values is None]
+        self.count(rule_hits=len(queries) - len(remaining), llm_calls=len(remaining))
+        if remaining:
+            model_name = self.model_name
+            model_response = self.backend.generate(
+                [self.get_input(queries[i], model_name) for i in remaining], self.output_type, model_name, ARGS_PROMPT_TEMPLATE
+            )
+            for i, values in zip(remaining, model_response):
+                results[i] = values
+        return results
 
 
 class Operator:
+    # Parsed operation metadata shared by all instances, keyed by the underlying function and description override.
+    operation_metadata_cache = {}
+
     def __init__(self) -> None:
         self.operations = {}
         self.model_name = "meta-llama/Llama-2-13b-chat-hf"
+        self.backend = get_default_backend()
         self.router = None
+        self.flat_router = None
         self.model_load_path = None
+        self.response_cache = None
+        self.confidence_gate = None
+        self.token_budget = None
+        self.tool_index = None
+        self.tool_shortlist_size = 10
+        self.shortlist_routing = True
+        self.speculative_operations = 0
+        self.speculation_counts = {"hits": 0, "misses": 0, "skipped": 0, "wasted": 0}
+        self.operation_counts = {}
+        # Guards speculation_counts and operation_counts, updated from concurrent queries.
+        self.speculation_lock = threading.Lock()
+        self.fast_router_threshold = 0.5
+        self.max_concurrency = 8
+        self.__semaphore = None
+        self.__semaphore_key = None
+        self.__executor = None
+        self.__tool_executor = None
+        self.__executor_lock = threading.Lock()
 
     def load(self, path):
         '''
         Load the routing operator from the given path.
         '''
-        router_path = path + "router.pkl"
+        router_path = self.__get_router_path(path + "router.pkl")
         if not os.path.exists(router_path):
             raise Exception("Operator path does not exist. Please train your operator first or check the path passed.")
         self.model_load_path = router_path
-        self.router = LLMRoutingAgent(self.model_load_path)
+        self.router = registry.get_router(self.model_load_path, self.fast_router_threshold, self.backend)
+        flat_router_path = self.__get_router_path(path + "flat_router.pkl")
+        if os.path.exists(flat_router_path):
+            self.flat_router = registry.get_router(flat_router_path, self.fast_router_threshold, self.backend)
         return self
 
-    def __generate_args_prompt(self):
-        prompt_template = """\
-        <s>[INST] <<SYS>> For the given operation, find out the values of the arguments to call the tool with. For the following input format:
-        'User message': the input message from the user.
-        'Tool chosen': tool chosen and its function.
-        'Arguments list': the list of arguments required for the tool. This includes argument name, type and description.
-
-        Output format:
-        'Output': a dictionary of argument names and values.
-        <</SYS>>
-
-        Given:
-        'User message': {input:query}
-        'Tool chosen': {input:operation}
-        'Arguments list': {input:args}
-        generate the 'Output' only. Do not explain the logic.
-        [/INST] """
-
-        prompt_template = dedent(prompt_template)
-        model = Lamini(
-            "operator", self.model_name, prompt_template
-        )
-        return model
+    def __get_router_path(self, router_path):
+        '''
+        Prefer the memory-mapped router artifact (router.bin) over the pickle when it is at least as recent.
+        '''
+        artifact_path = get_artifact_path(router_path)
+        if os.path.exists(artifact_path) and (
+                not os.path.exists(router_path) or os.path.getmtime(artifact_path) >= os.path.getmtime(router_path)
+        ):
+            return artifact_path
+        return router_path
+
+    def set_backend(self, backend):
+        '''
+        Make the model calls of this operator, including argument extraction, with the given backend (see model_backend).
+        Call before load or train, so the routers use it too.
+        '''
+        self.backend = backend
+        for operation in self.operations.values():
+            if operation.extractor is not None:
+                operation.extractor.backend = backend
+        return self
 
     def get_func_args(self, op):
         '''
-        currently getting the docstring or function annotation doesn't give parameter wise description. so we try to find each function parameter and its specific description.
+        currently getting the docstring or function annotation doesn't give parameter wise description. so we parse the docstring once for "name: description" lines and look up each function parameter's specific description.
         '''
+        param_descriptions = {}
+        for key, description in re.findall(r"^[ \t]*(\w+):[ \t]+(.*?)\.?[ \t]*$", op.__doc__ or "", re.MULTILINE):
+            param_descriptions.setdefault(key, description.strip())
+
         args = []
         for key, value in op.__annotations__.items():
-            pattern = fr"{key}:\s(.*?)\.?\n"
-            match = re.search(pattern, op.__doc__, re.DOTALL)
-            if match:
-                param_description = match.group(1).strip()
-            else:
-                param_description = None
+            param_description = param_descriptions.get(key)
 
-            type_match = re.search(r"<class '(\w+)'>", str(value))
-            if type_match:
-                param_type = type_match.group(1).strip()
+            if isinstance(value, type):
+                param_type = value.__name__
+            elif isinstance(value, str):
+                param_type = value
             else:
                 param_type = 'str'
             if param_type not in ['str', 'int', 'float']:
-                print("[WARN] Currently supporting only str, int and float types.")
+                logger.warning("Currently supporting only str, int and float types.")
                 param_type = 'str'
-            args.append({"name": key, "type": param_type, "description": param_description})
+            args.append(ArgumentSpec(name=key, type=param_type, description=param_description))
         return args
 
+    def __get_operation_metadata(self, operation, description):
+        '''
+        Parse the description and arguments of an operation, and render its argument list for the extraction prompt.
+        Cached at class level, so creating many instances of an operator only parses each docstring once.
+        '''
+        key = (getattr(operation, "__func__", operation), description)
+        metadata = Operator.operation_metadata_cache.get(key)
+        if metadata is None:
+            description = description or operation.__doc__.split("\n")[1].strip()
+            arguments = tuple(self.get_func_args(operation))
+            args_prompt = str([arg.to_dict() for arg in arguments])
+            metadata = (description, arguments, args_prompt)
+            Operator.operation_metadata_cache[key] = metadata
+        return metadata
+
     def add_operation(
             self,
             operation,
             description: Optional[str] = None,
+            cacheable: bool = True,
+            extractors: Optional[dict] = None,
+            delegate=None,
     ):
         '''
         Add tools to the agent. Each tool has tool name, description and arguments required.
+        Set cacheable to False to always route and extract arguments for this tool, even when the response cache is enabled.
+        extractors: rule extractors by argument name, tried before the LLM. Defaults to the ones declared with @argument_extractors.
+        delegate: for an operation that only passes the user message on to another operator, a callable returning that
+        operator. The message is passed through without an argument extraction call, and the operator can be trained
+        with a flattened router over the leaf operations (see train).
         '''
         name = operation.__name__
-        description = description or operation.__doc__.split("\n")[1].strip()
-        arguments = self.get_func_args(operation)
-        self.operations[name] = {
-            "action": operation,
-            "description": description,
-            "arguments": arguments,
+        description, arguments, args_prompt = self.__get_operation_metadata(operation, description)
+        if delegate is not None and len(arguments) != 1:
+            raise Exception(f"Delegating operation {name} must take exactly one argument, the user message.")
+        if extractors is None:
+            extractors = getattr(operation, "argument_extractors", None)
+        extractor = None
+        if arguments:
+            extractor = ArgumentExtractor(
+                self, name, arguments, args_prompt, rules=extractors, token_budget=self.token_budget
+            )
+        self.operations[name] = OperationSpec(
+            name=name,
+            action=operation,
+            description=description,
+            arguments=arguments,
+            args_prompt=args_prompt,
+            extractor=extractor,
+            cacheable=cacheable,
+            delegate=delegate,
+        )
+        if self.tool_index is not None:
+            self.__index_operation(self.operations[name])
+
+    def get_leaf_operations(self, prefix=""):
+        '''
+        Descriptions of all operations that do not delegate to another operator, including those of delegated operators.
+        Operations of delegated operators are named by their path, e.g. call_onboarding_operator/setAge.
+        '''
+        leaves = {}
+        for name, operation in self.operations.items():
+            if operation.delegate is None:
+                leaves[prefix + name] = operation.description
+            else:
+                leaves.update(operation.delegate().get_leaf_operations(prefix + name + "/"))
+        return leaves
+
+    def get_extraction_report(self):
+        '''
+        Number of argument extractions answered by rule extractors and by the LLM, and the fraction of LLM calls skipped.
+        '''
+        rule_hits = 0
+        llm_calls = 0
+        for operation in self.operations.values():
+            if operation.extractor is not None:
+                operation_rule_hits, operation_llm_calls = operation.extractor.get_counts()
+                rule_hits += operation_rule_hits
+                llm_calls += operation_llm_calls
+        total = rule_hits + llm_calls
+        return {
+            "rule_hits": rule_hits,
+            "llm_calls": llm_calls,
+            "skip_rate": rule_hits / total if total else 0.0,
         }
 
+    def enable_response_cache(self, max_size: int = 1024, ttl: float = 3600):
+        '''
+        Memoize routing and argument extraction results for repeated queries. See ResponseCache.
+        '''
+        self.response_cache = ResponseCache(max_size=max_size, ttl=ttl)
+        return self
+
+    def enable_confidence_gating(
+            self,
+            min_margin: float = 0.2,
+            policy: str = "fallback",
+            fallback_operation: Optional[str] = None,
+            escalation_model_name: str = "meta-llama/Llama-2-70b-chat-hf",
+            max_candidates: int = 2,
+    ):
+        '''
+        Commit to the routing decision only when the probability margin between the two most likely operations is at
+        least min_margin, and handle the other queries with a low-confidence policy. See ConfidenceGate.
+        '''
+        if fallback_operation is not None and fallback_operation not in self.operations:
+            raise Exception(f"Fallback operation {fallback_operation} is not registered with this operator.")
+        self.confidence_gate = ConfidenceGate(
+            min_margin=min_margin,
+            policy=policy,
+            fallback_operation=fallback_operation,
+            escalation_model_name=escalation_model_name,
+            max_candidates=max_candidates,
+        )
+        return self
+
+    def get_confidence_report(self):
+        '''
+        Number of confident and low-confidence routing decisions, with the low-confidence policy.
+        '''
+        if self.confidence_gate is None:
+            return None
+        return self.confidence_gate.get_report()
+
+    def enable_token_budget(
+            self,
+            budgets: Optional[dict] = None,
+            default_budget: int = 4096,
+            reserve_tokens: int = 512,
+            tokenizer=count_tokens,
+            min_query_share: float = 0.25,
+    ):
+        '''
+        Fit prompts into the context of their model (budgets: dict of model name to context size in tokens), pruning
+        the least important prompt sections first. See TokenBudget.
+        '''
+        self.token_budget = TokenBudget(
+            budgets=budgets,
+            default_budget=default_budget,
+            reserve_tokens=reserve_tokens,
+            tokenizer=tokenizer,
+            min_query_share=min_query_share,
+        )
+        for operation in self.operations.values():
+            if operation.extractor is not None:
+                operation.extractor.token_budget = self.token_budget
+        return self
+
+    def get_token_budget_report(self):
+        '''
+        Number of prompts, their mean size in tokens, and how many were pruned to fit the budget, by how many tokens.
+        '''
+        if self.token_budget is None:
+            return None
+        return self.token_budget.get_report()
+
+    def enable_tool_shortlist(self, k: int = 10, routing: bool = True):
+        '''
+        Shortlist the k operations most relevant to a query before routing and planning, with a BM25 index over the
+        operation descriptions and training examples (see ToolIndex). With routing, the router only chooses among the
+        shortlisted operations, unless none of them is relevant to the query. The index is updated by add_operation
+        and train, and includes the examples of an already trained router.
+        '''
+        self.tool_shortlist_size = k
+        self.shortlist_routing = routing
+        self.__build_tool_index()
+        return self
+
+    def __index_operation(self, operation):
+        arguments = " ".join(f"{arg.name} {arg.description or ''}" for arg in operation.arguments)
+        self.tool_index.add(operation.name, [f"{operation.name} {operation.description} {arguments}"])
+
+    def __build_tool_index(self):
+        self.tool_index = ToolIndex()
+        for operation in self.operations.values():
+            self.__index_operation(operation)
+        if self.model_load_path is not None:
+            class_examples = RouterTrainer(self.model_load_path).load_examples(self.tool_index.max_documents_per_operation)
+            for name in self.operations:
+                self.tool_index.add(name, class_examples.get(name, []))
+
+    def shortlist_operations(self, query):
+        '''
+        The tool_shortlist_size names of operations most relevant to the query, most relevant first: the operations
+        matching the query, followed by the other operations in the order they were added. None without a tool
+        shortlist, with no more operations than the shortlist size, or when no operation is relevant to the query.
+        '''
+        if self.tool_index is None or len(self.operations) <= self.tool_shortlist_size:
+            return None
+        names = [name for name, _ in self.tool_index.search(query, self.tool_shortlist_size)]
+        if not names:
+            return None
+        names += [name for name in self.operations if name not in names][:self.tool_shortlist_size - len(names)]
+        return names
+
+    def __get_routing_candidates(self, queries):
+        '''
+        The shortlisted operations of every query, to route among. None when routing is not shortlisted, including
+        with a flattened router, whose classes are leaf operations.
+        '''
+        if self.tool_index is None or not self.shortlist_routing or self.flat_router is not None:
+            return None
+        return [self.shortlist_operations(query) for query in queries]
+
+    def enable_speculation(self, max_operations: int = 1):
+        '''
+        Start argument extraction for the max_operations most likely operations in parallel with routing, so a query
+        costs roughly one model latency instead of two when the guess is right. Extractions for the operations that
+        were not selected are cancelled, or discarded if already running.
+        The guess comes from the fast-path router's probabilities, or from how often each operation was selected so far.
+        Applies to run and arun; batches already share model calls.
+        '''
+        self.speculative_operations = max_operations
+        return self
+
+    def get_speculation_report(self):
+        '''
+        Queries where the speculative extraction was for the selected operation (hits) or not (misses), queries routed
+        without speculation (skipped), and speculative extractions started for operations that were not selected (wasted).
+        '''
+        with self.speculation_lock:
+            counts = dict(self.speculation_counts)
+        attempts = counts["hits"] + counts["misses"]
+        return dict(counts, hit_rate=counts["hits"] / attempts if attempts else 0.0)
+
+    def __get_cache_key(self, query, prompt):
+        if self.response_cache is None:
+            return None
+        return self.response_cache.make_key(self.__get_router().fingerprint, query, prompt)
+
+    def __get_cached(self, cache_key):
+        if cache_key is None:
+            return None
+        cached = self.response_cache.get(cache_key)
+        if cached is not None and cached[0].split("/")[0] in self.operations:
+            return cached
+        return None
+
+    def __put_cached(self, cache_key, selected_operation, probabilities, generated_arguments):
+        if cache_key is not None and self.__get_operation_to_run(selected_operation).cacheable:
+            self.response_cache.put(cache_key, (selected_operation, probabilities, generated_arguments))
+
     def select_operations(self, query):
         '''
-        selects which tool to use
+        selects which tool to use.
+        Returns the selected operation and the probability distribution over all operations.
+        '''
+        with tracer.span("select_operations", operator=type(self).__name__) as span:
+            span.set_prompt(query)
+            # Can adapt to predict multiple operations
+            predicted_cls, prob = self.__get_router().predict([query], self.__get_routing_candidates([query]))
+            span.set(operation=predicted_cls[0], margin=ConfidenceGate.get_margin(prob[0]))
+        return predicted_cls[0], prob[0]
+
+    def select_operations_batch(self, queries):
+        '''
+        selects which tool to use for every query, with a single router call for the whole batch.
+        Returns the list of selected operations and the list of probability distributions.
         '''
-        # Can adapt to predict multiple operations
-        predicted_cls, prob = self.router.predict([query])
-        return predicted_cls[0]
+        with tracer.span("select_operations", operator=type(self).__name__, batch_size=len(queries)):
+            return self.__get_router().predict(list(queries), self.__get_routing_candidates(queries))
+
+    def __get_router(self):
+        '''
+        The flattened router over leaf operations when one is trained, else the router over this operator's operations.
+        '''
+        if self.flat_router is not None:
+            return self.flat_router
+        return self.router
 
     def select_arguments(
             self,
             query: str,
             operation: str,
+            model_name: Optional[str] = None,
     ):
         '''
-        Predicts and parses the arguments required to call the tool.
+        Predicts and parses the arguments required to call the tool, with model_name if given instead of the operator's model.
+        A delegating tool gets the message as is.
         '''
-        arguments = self.__get_operation_to_run(operation)['arguments']
-        if arguments is None or len(arguments) == 0:
+        spec = self.__get_operation_to_run(operation)
+        if spec.delegate is not None:
+            return {spec.arguments[0].name: query}
+        extractor = spec.extractor
+        if extractor is None:
             return None
-        output_type = {}
-        for arg in arguments:
-            output_type[arg['name']] = arg['type']
-        input = {
-            "query": query,
-            "operation": operation,
-            "args": str(arguments)
-        }
-        model = self.__generate_args_prompt()
-        model_response = model(
-            input,
-            output_type
-        )
-        return model_response
+        with tracer.span("select_arguments", operator=type(self).__name__, operation=operation) as span:
+            span.set_prompt(query)
+            return extractor(query, model_name=model_name)
+
+    def select_arguments_batch(
+            self,
+            queries: list,
+            operation: str,
+    ):
+        '''
+        Predicts and parses the arguments for a batch of queries that all selected the same tool, in one batched LLM request.
+        Returns a list of arguments in the same order as queries.
+        '''
+        spec = self.__get_operation_to_run(operation)
+        if spec.delegate is not None:
+            return [{spec.arguments[0].name: query} for query in queries]
+        extractor = spec.extractor
+        if extractor is None:
+            return [None] * len(queries)
+        with tracer.span("select_arguments", operator=type(self).__name__, operation=operation, batch_size=len(queries)) as span:
+            span.set_prompt("".join(queries))
+            return extractor.batch(queries)
+
+    def __get_executor(self):
+        '''
+        Thread pool for model calls made in parallel within a single query, up to max_concurrency at a time.
+        '''
+        with self.__executor_lock:
+            if self.__executor is None:
+                self.__executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+            return self.__executor
+
+    def __get_tool_executor(self):
+        '''
+        Thread pool for the tool calls of a batch, up to max_concurrency at a time. Separate from the model call pool,
+        so tools that run queries through this operator again cannot starve it.
+        '''
+        with self.__executor_lock:
+            if self.__tool_executor is None:
+                self.__tool_executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+            return self.__tool_executor
+
+    def __get_speculative_operations(self, query):
+        '''
+        The operations to extract arguments for while the query is routed: the most likely ones according to the
+        fast-path router, else the most frequently selected ones. None when routing is answered locally anyway, or
+        there is nothing to guess from.
+        '''
+        prior = self.__get_router().get_prior(query)
+        if prior is not None:
+            probabilities, confident = prior
+            if confident:
+                return None
+            ranked = sorted(probabilities, key=probabilities.get, reverse=True)
+        else:
+            with self.speculation_lock:
+                operation_counts = dict(self.operation_counts)
+            ranked = sorted(operation_counts, key=operation_counts.get, reverse=True)
+        candidates = []
+        for name in ranked:
+            spec = self.__get_operation_to_run(name)
+            if spec.extractor is not None and spec.delegate is None:
+                candidates.append(name)
+            if len(candidates) == self.speculative_operations:
+                break
+        return candidates or None
+
+    def __start_speculation(self, query, prompt):
+        '''
+        Start the speculative argument extractions for a query. Returns a dict of operation name to future.
+        '''
+        candidates = self.__get_speculative_operations(query)
+        if candidates is None:
+            with self.speculation_lock:
+                self.speculation_counts["skipped"] += 1
+            return {}
+        executor = self.__get_executor()
+        return {name: executor.submit(tracer.bind(self.select_arguments), prompt, name) for name in candidates}
+
+    def __finish_speculation(self, speculation, selected_operation):
+        '''
+        Returns the future of the speculative extraction for the selected operation, or None, and cancels the others.
+        '''
+        future = speculation.pop(selected_operation, None)
+        if speculation or future is not None:
+            with self.speculation_lock:
+                self.speculation_counts["hits" if future is not None else "misses"] += 1
+                self.speculation_counts["wasted"] += len(speculation)
+        for other in speculation.values():
+            other.cancel()
+        return future
+
+    def __gate_operation(self, selected_operation, probabilities):
+        '''
+        The operation to run for a routing decision: the selected one when confident or the gate is disabled, the
+        fallback operation for a low-confidence query with the fallback policy, or None if the query needs
+        __resolve_low_confidence.
+        '''
+        gate = self.confidence_gate
+        if gate is None or gate.is_confident(probabilities):
+            return selected_operation
+        logger.info("low routing confidence (margin: %.2f), policy: %s", gate.get_margin(probabilities), gate.policy)
+        if gate.policy == "fallback":
+            return gate.fallback_operation
+        return None
+
+    def __resolve_low_confidence(self, query, prompt, probabilities):
+        '''
+        Select the operation and extract its arguments for a low-confidence query, with the speculative or escalate policy.
+        The speculative policy extracts arguments for every candidate, and keeps the candidate whose arguments are all
+        valid for their types, then with the most arguments found by rule extractors, then the most likely one.
+        '''
+        gate = self.confidence_gate
+        candidates = gate.get_candidates(probabilities)
+        with tracer.span("resolve_low_confidence", operator=type(self).__name__, policy=gate.policy) as span:
+            if gate.policy == "escalate":
+                operations = str({name: self.__get_operation_to_run(name).description for name in candidates})
+                choice = self.backend.generate(
+                    {"query": query, "operations": operations},
+                    {"operation": "str"},
+                    gate.escalation_model_name,
+                    ESCALATION_PROMPT_TEMPLATE,
+                )
+                selected_operation = str(choice.get("operation", "")).strip()
+                if selected_operation not in candidates:
+                    selected_operation = candidates[0]
+                span.set(operation=selected_operation)
+                return selected_operation, self.select_arguments(prompt, selected_operation, model_name=gate.escalation_model_name)
+
+            futures = [
+                self.__get_executor().submit(tracer.bind(self.select_arguments), prompt, candidate)
+                for candidate in candidates
+            ]
+            best = None
+            error = None
+            for candidate, future in zip(candidates, futures):
+                try:
+                    arguments = future.result()
+                except Exception as e:
+                    error = error or e
+                    continue
+                score = self.__score_extraction(prompt, candidate, arguments) + (probabilities[candidate],)
+                if best is None or score > best[0]:
+                    best = (score, candidate, arguments)
+            if best is None:
+                raise error
+            score, selected_operation, arguments = best
+            span.set(operation=selected_operation, valid_arguments=score[0], rule_matches=score[1])
+            return selected_operation, arguments
+
+    def __score_extraction(self, prompt, operation, arguments):
+        '''
+        How well the extracted arguments fit the operation, as (all arguments valid, arguments filled by rule extractors).
+        Operations without extracted arguments have nothing invalid and no rule matches.
+        '''
+        spec = self.__get_operation_to_run(operation)
+        if spec.extractor is None or spec.delegate is not None:
+            return True, 0
+        return spec.extractor.score(prompt, arguments)
 
     def __get_operation_to_run(self, output):
         '''
-        Get the tool callback from the name of the tool.
+        Get the tool spec from the name of the tool.
+        Leaf operations of delegated operators, selected by a flattened router, are named by their path, e.g. call_onboarding_operator/setAge.
         '''
-        for name, val in self.operations.items():
-            if output == name:
-                return val
+        operation = self.operations.get(output)
+        if operation is None and "/" in output:
+            name, leaf = output.split("/", 1)
+            operation = self.operations.get(name)
+            if operation is not None and operation.delegate is not None:
+                return operation.delegate().__get_operation_to_run(leaf)
+            operation = None
+        if operation is None:
+            raise Exception(f"Operation {output} is not registered with this operator.")
+        return operation
 
     def __get_classes_dict(self):
         '''
         get tool name and description list
         '''
-        cls = {}
-        for name, val in self.operations.items():
-            cls[name] = val["description"]
-        return cls
+        return {name: operation.description for name, operation in self.operations.items()}
 
-    def train(self, router_save_path, training_file):
+    def train(self, router_save_path, training_file, flatten=False, generate_examples=False):
         '''
         Train the routing agent to decide which tool to use.
+        Training is incremental: only classes whose description or training rows changed since the last training are
+        rebuilt, and an unchanged operator is loaded as is. See RouterTrainer.
+        With flatten, also train a router over the leaf operations of delegated operators, so a message is routed
+        once instead of once per level. Its training file rows use leaf paths as class_name, e.g. call_onboarding_operator/setAge.
+        With generate_examples, operations without training rows get examples generated from their description and
+        cached, instead of being prompt-trained.
         '''
         if router_save_path[-1] != "/":
             router_save_path += "/"
@@ -151,41 +717,347 @@ class Operator:
         if not os.path.exists(router_save_path):
             os.makedirs(router_save_path)
         if training_file and not os.path.exists(training_file):
-            print("Training file does not exist. Continuing without it.")
+            logger.warning("Training file does not exist. Continuing without it.")
+
+        if flatten:
+            self.flat_router = self.__train_router(
+                router_save_path + "flat_router.pkl", self.get_leaf_operations(), training_file, generate_examples
+            )
 
         self.model_load_path = router_save_path + "router.pkl"
-        if os.path.exists(self.model_load_path):
-            print("Operator already trained. Loading from saved path.")
-            self.load(router_save_path)
-            return
-        self.router = LLMRoutingAgent(self.model_load_path)
-        classes_dict = self.__get_classes_dict()
-        self.router.fit(classes_dict, training_file)
-        self.router.save(self.model_load_path)
+        self.router = self.__train_router(self.model_load_path, self.__get_classes_dict(), training_file, generate_examples)
+        if self.tool_index is not None:
+            self.__build_tool_index()
+
+    def __train_router(self, router_path, classes_dict, training_file, generate_examples):
+        trainer = RouterTrainer(
+            router_path,
+            self.backend,
+            self.fast_router_threshold,
+            max_workers=self.max_concurrency,
+            generate_examples=generate_examples,
+        )
+        if not trainer.train(classes_dict, training_file):
+            return registry.get_router(router_path, self.fast_router_threshold, self.backend)
+        router = LLMRoutingAgent(router_path, fast_router_threshold=self.fast_router_threshold, backend=self.backend)
+        registry.put_router(router_path, router)
+        return router
 
-    def run(self, query: str, prompt: str = None):
+    def run(self, query: str, prompt: str = None, timings: dict = None):
         '''
         Gets the routing agent to decide which tool to use, using the query alone.
         Next, this agent fills in the arguments required to call that tool, using the full prompt (optional, defaults to using query).
         That tool is then called. Tool output is returned.
+
+        timings: optional dict, filled with the seconds spent in each stage ("route", "extract", "tool").
         '''
         if not self.model_load_path:
             raise Exception("Router not loaded.")
 
-        print(f"query: {query}")
-        selected_operation = self.select_operations(query)
-        print(f"selected operation: {selected_operation}")
+        logger.info("query: %s", query)
         if prompt is None:
             prompt = query
-        generated_arguments = self.select_arguments(prompt, selected_operation)
-        print(f"inferred arguments: {generated_arguments}")
-        action = self.__get_operation_to_run(selected_operation)["action"]
-        # TODO: better error handling
-        if generated_arguments:
-            tool_output = action(**generated_arguments)
+        if timings is None:
+            timings = {}
+        with tracer.span("run", operator=type(self).__name__) as span:
+            selected_operation, probabilities, generated_arguments = self.__route_and_extract(query, prompt, timings)
+            span.set(operation=selected_operation)
+            start = time.perf_counter()
+            try:
+                return self.__call_operation(selected_operation, generated_arguments)
+            finally:
+                timings["tool"] = time.perf_counter() - start
+
+    def __route_and_extract(self, query, prompt, timings=None):
+        '''
+        Select the tool and its arguments, serving them from the response cache when possible.
+        '''
+        if timings is None:
+            timings = {}
+        timings.update(route=0.0, extract=0.0)
+        cache_key = self.__get_cache_key(query, prompt)
+        cached = self.__get_cached(cache_key)
+        if cached is not None:
+            selected_operation, probabilities, generated_arguments = cached
+            logger.info("cached operation: %s, cached arguments: %s", selected_operation, generated_arguments)
+            return selected_operation, probabilities, generated_arguments
+
+        speculation = self.__start_speculation(query, prompt) if self.speculative_operations else {}
+        start = time.perf_counter()
+        try:
+            selected_operation, probabilities = self.select_operations(query)
+        except Exception:
+            self.__finish_speculation(speculation, None)
+            raise
+        timings["route"] = time.perf_counter() - start
+        logger.info("selected operation: %s (probability: %.2f)", selected_operation, probabilities[selected_operation])
+        if self.speculative_operations:
+            with self.speculation_lock:
+                self.operation_counts[selected_operation] = self.operation_counts.get(selected_operation, 0) + 1
+        start = time.perf_counter()
+        gated_operation = self.__gate_operation(selected_operation, probabilities)
+        speculative_extraction = self.__finish_speculation(speculation, gated_operation)
+        if gated_operation is None:
+            selected_operation, generated_arguments = self.__resolve_low_confidence(query, prompt, probabilities)
+        elif speculative_extraction is not None:
+            selected_operation = gated_operation
+            generated_arguments = speculative_extraction.result()
         else:
-            tool_output = action()
-        return tool_output
+            selected_operation = gated_operation
+            generated_arguments = self.select_arguments(prompt, selected_operation)
+        timings["extract"] = time.perf_counter() - start
+        logger.info("inferred arguments: %s", generated_arguments)
+        self.__put_cached(cache_key, selected_operation, probabilities, generated_arguments)
+        return selected_operation, probabilities, generated_arguments
+
+    def run_batch(self, queries: list, prompts: list = None, timings: list = None):
+        '''
+        Batched version of run.
+        The whole batch is routed with a single router call, queries are grouped by the selected tool, and arguments are
+        extracted with one batched LLM request per group. The tools are then called for every query, up to
+        max_concurrency at a time, starting as soon as the arguments of their group are extracted.
+        Returns a list of tool outputs in the same order as queries. If an item fails, its entry is the raised exception.
+
+        timings: optional list, filled with one dict per query of the seconds spent in each stage ("route", "extract", "tool").
+        Route and extract are the durations of the batched calls the query was part of.
+        '''
+        if not self.model_load_path:
+            raise Exception("Router not loaded.")
+        if prompts is None:
+            prompts = queries
+        if len(prompts) != len(queries):
+            raise Exception("Number of prompts must match the number of queries.")
+
+        results = [None] * len(queries)
+        stage_timings = [{"route": 0.0, "extract": 0.0, "tool": 0.0} for _ in queries]
+        if timings is not None:
+            timings.extend(stage_timings)
+        if len(queries) == 0:
+            return results
+
+        with tracer.span("run_batch", operator=type(self).__name__, batch_size=len(queries)):
+            calls = {}
+            cache_keys = [self.__get_cache_key(query, prompt) for query, prompt in zip(queries, prompts)]
+            groups = {}
+            uncached = []
+            for i, cache_key in enumerate(cache_keys):
+                cached = self.__get_cached(cache_key)
+                if cached is None:
+                    uncached.append(i)
+                    continue
+                selected_operation, _, arguments = cached
+                calls[i] = self.__submit_operation(selected_operation, arguments, stage_timings[i])
+
+            low_confidence = []
+            if uncached:
+                start = time.perf_counter()
+                selected_operations, probabilities = self.select_operations_batch([queries[i] for i in uncached])
+                route_time = time.perf_counter() - start
+                for i, selected_operation, probability in zip(uncached, selected_operations, probabilities):
+                    stage_timings[i]["route"] = route_time
+                    selected_operation = self.__gate_operation(selected_operation, probability)
+                    if selected_operation is None:
+                        low_confidence.append((i, probability))
+                    else:
+                        groups.setdefault(selected_operation, []).append((i, probability))
+
+            for selected_operation, items in groups.items():
+                logger.info("selected operation: %s for %d queries", selected_operation, len(items))
+                start = time.perf_counter()
+                try:
+                    generated_arguments = self.select_arguments_batch([prompts[i] for i, _ in items], selected_operation)
+                except Exception as e:
+                    for i, _ in items:
+                        results[i] = e
+                    continue
+                finally:
+                    extract_time = time.perf_counter() - start
+                    for i, _ in items:
+                        stage_timings[i]["extract"] = extract_time
+                for (i, probability), arguments in zip(items, generated_arguments):
+                    self.__put_cached(cache_keys[i], selected_operation, probability, arguments)
+                    calls[i] = self.__submit_operation(selected_operation, arguments, stage_timings[i])
+
+            for i, probability in low_confidence:
+                start = time.perf_counter()
+                try:
+                    selected_operation, arguments = self.__resolve_low_confidence(queries[i], prompts[i], probability)
+                except Exception as e:
+                    results[i] = e
+                    continue
+                finally:
+                    stage_timings[i]["extract"] = time.perf_counter() - start
+                self.__put_cached(cache_keys[i], selected_operation, probability, arguments)
+                calls[i] = self.__submit_operation(selected_operation, arguments, stage_timings[i])
+
+            for i, call in calls.items():
+                results[i] = call.result()
+            return results
+
+    def __submit_operation(self, operation, arguments, stage_timings):
+        '''
+        Call the tool on the tool thread pool. Returns a future of its output, or of the exception it raised.
+        '''
+        return self.__get_tool_executor().submit(
+            tracer.bind(self.__call_operation_timed), operation, arguments, stage_timings
+        )
+
+    def __call_operation_timed(self, operation, arguments, stage_timings):
+        '''
+        Call the tool, recording its duration. Returns the raised exception instead of raising it.
+        '''
+        start = time.perf_counter()
+        try:
+            return self.__call_operation(operation, arguments)
+        except Exception as e:
+            return e
+        finally:
+            stage_timings["tool"] = time.perf_counter() - start
+
+    def __call_operation(self, operation, arguments):
+        '''
+        Call the tool with the generated arguments.
+        '''
+        action = self.__get_operation_to_run(operation).action
+        with tracer.span("call_operation", operator=type(self).__name__, operation=operation):
+            # TODO: better error handling
+            if arguments:
+                tool_output = action(**arguments)
+            else:
+                tool_output = action()
+            if inspect.isawaitable(tool_output):
+                tool_output = asyncio.run(tool_output)
+            return tool_output
+
+    def __get_semaphore(self):
+        '''
+        Semaphore bounding the number of concurrent conversation turns in the async API.
+        It is rebuilt if max_concurrency changes or the operator is used from a different event loop.
+        '''
+        key = (asyncio.get_running_loop(), self.max_concurrency)
+        if self.__semaphore is None or self.__semaphore_key != key:
+            self.__semaphore = asyncio.Semaphore(self.max_concurrency)
+            self.__semaphore_key = key
+        return self.__semaphore
+
+    async def __acall_operation(self, operation, arguments):
+        '''
+        Call the tool with the generated arguments. Async tools are awaited, sync tools are run in a worker thread.
+        '''
+        action = self.__get_operation_to_run(operation).action
+        arguments = arguments or {}
+        with tracer.span("call_operation", operator=type(self).__name__, operation=operation):
+            if inspect.iscoroutinefunction(action):
+                return await action(**arguments)
+            tool_output = await asyncio.to_thread(action, **arguments)
+            if inspect.isawaitable(tool_output):
+                tool_output = await tool_output
+            return tool_output
+
+    async def arun(self, query: str, prompt: str = None):
+        '''
+        Async version of run. Routing and argument extraction run in worker threads, so the event loop is not blocked.
+        At most max_concurrency turns run at the same time on this operator.
+        '''
+        if not self.model_load_path:
+            raise Exception("Router not loaded.")
+        if prompt is None:
+            prompt = query
+
+        async with self.__get_semaphore():
+            logger.info("query: %s", query)
+            with tracer.span("run", operator=type(self).__name__) as span:
+                selected_operation, probabilities, generated_arguments = await asyncio.to_thread(
+                    self.__route_and_extract, query, prompt
+                )
+                span.set(operation=selected_operation)
+                return await self.__acall_operation(selected_operation, generated_arguments)
+
+    async def arun_batch(self, queries: list, prompts: list = None):
+        '''
+        Async version of run_batch. Queries found in the response cache skip routing and extraction. The rest of the
+        batch is routed with a single router call, then argument extraction for every selected tool and the tool calls
+        run concurrently, bounded by max_concurrency.
+        Returns a list of tool outputs in the same order as queries. If an item fails, its entry is the raised exception.
+        '''
+        if not self.model_load_path:
+            raise Exception("Router not loaded.")
+        if prompts is None:
+            prompts = queries
+        if len(prompts) != len(queries):
+            raise Exception("Number of prompts must match the number of queries.")
+        if len(queries) == 0:
+            return []
+
+        semaphore = self.__get_semaphore()
+        cache_keys = [self.__get_cache_key(query, prompt) for query, prompt in zip(queries, prompts)]
+        cached = {}
+        uncached = []
+        for i, cache_key in enumerate(cache_keys):
+            cached_response = self.__get_cached(cache_key)
+            if cached_response is None:
+                uncached.append(i)
+            else:
+                cached[i] = cached_response
+
+        groups = {}
+        low_confidence = []
+        probabilities = {}
+        if uncached:
+            async with semaphore:
+                selected_operations, uncached_probabilities = await asyncio.to_thread(
+                    self.select_operations_batch, [queries[i] for i in uncached]
+                )
+            for i, selected_operation, probability in zip(uncached, selected_operations, uncached_probabilities):
+                probabilities[i] = probability
+                selected_operation = self.__gate_operation(selected_operation, probability)
+                if selected_operation is None:
+                    low_confidence.append(i)
+                else:
+                    groups.setdefault(selected_operation, []).append(i)
+
+        async def run_cached(i):
+            selected_operation, _, arguments = cached[i]
+            async with semaphore:
+                return await self.__acall_operation(selected_operation, arguments)
+
+        async def run_group(selected_operation, indices):
+            async with semaphore:
+                generated_arguments = await asyncio.to_thread(
+                    self.select_arguments_batch, [prompts[i] for i in indices], selected_operation
+                )
+
+            async def call(i, arguments):
+                self.__put_cached(cache_keys[i], selected_operation, probabilities[i], arguments)
+                async with semaphore:
+                    return await self.__acall_operation(selected_operation, arguments)
+
+            return await asyncio.gather(
+                *[call(i, arguments) for i, arguments in zip(indices, generated_arguments)], return_exceptions=True
+            )
+
+        async def run_low_confidence(i):
+            async with semaphore:
+                selected_operation, arguments = await asyncio.to_thread(
+                    self.__resolve_low_confidence, queries[i], prompts[i], probabilities[i]
+                )
+                self.__put_cached(cache_keys[i], selected_operation, probabilities[i], arguments)
+                return await self.__acall_operation(selected_operation, arguments)
+
+        group_results = await asyncio.gather(
+            *[run_group(selected_operation, indices) for selected_operation, indices in groups.items()],
+            *[run_low_confidence(i) for i in low_confidence],
+            *[run_cached(i) for i in cached],
+            return_exceptions=True,
+        )
+
+        results = [None] * len(queries)
+        for indices, outputs in zip(groups.values(), group_results):
+            for j, i in enumerate(indices):
+                results[i] = outputs if isinstance(outputs, BaseException) else outputs[j]
+        for i, output in zip(low_confidence + list(cached), group_results[len(groups):]):
+            results[i] = output
+        return results
 
     def __call__(self, query: str):
         return self.run(query)
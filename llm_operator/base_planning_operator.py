@@ -1,25 +1,134 @@
 import re 
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-from llama import BasicModelRunner
-from base_operator import Operator
+from base_operator import Operator, ARGS_PROMPT_TEMPLATE
+from session_store import Session, InMemorySessionStore
+from tracing import logger, tracer
+
+
+class EnumeratedListStreamParser:
+    '''
+    Incrementally parses an enumerated list ("1. ... 2. ...") from streamed text.
+    An item is complete once the marker of the next item arrives, or the stream ends. Like the non-streaming parser,
+    parsing stops at the first blank line.
+    '''
+    def __init__(self, prefix=""):
+        self.text = prefix
+        self.emitted = 0
+        self.stopped = False
+        self.item_start_pattern = re.compile(r'(?:^|\s)\d+\.\s')
+
+    def __get_items(self, final):
+        text = self.text.split("\n\n")[0]
+        starts = [match.end() for match in self.item_start_pattern.finditer(text)]
+        ends = [match.start() for match in self.item_start_pattern.finditer(text)][1:]
+        if final or self.stopped:
+            ends.append(len(text))
+        items = [text[start:end].strip() for start, end in zip(starts, ends)]
+        new_items = items[self.emitted:]
+        self.emitted = len(items)
+        return new_items
+
+    def feed(self, chunk):
+        '''
+        Add a chunk of streamed text. Returns the items completed by this chunk.
+        '''
+        if self.stopped:
+            return []
+        self.text += chunk
+        if "\n\n" in self.text:
+            self.stopped = True
+        return self.__get_items(final=False)
+
+    def finish(self):
+        '''
+        Signal the end of the stream. Returns the last item, if any.
+        '''
+        items = self.__get_items(final=True)
+        self.stopped = True
+        return items
+
+
+class PlanScheduler:
+    '''
+    Dispatches plan steps to a thread pool as soon as the steps they depend on are done.
+    Steps can be added while earlier ones are already running.
+    '''
+    def __init__(self, operator, executor, query, chat_history=None):
+        self.operator = operator
+        self.executor = executor
+        self.query = query
+        self.chat_history = chat_history
+        self.steps = []
+        self.dependencies = []
+        self.observations = []
+        self.done = set()
+        self.pending = []
+        self.running = {}
+
+    def add_step(self, step):
+        '''
+        Add the next step of the plan. Returns its index and the step without its dependency annotation.
+        '''
+        i = len(self.steps)
+        step, depends_on = self.operator.parse_step(i, step)
+        self.steps.append(step)
+        self.dependencies.append(depends_on)
+        self.observations.append(None)
+        self.pending.append(i)
+        self.submit_ready()
+        return i, step
+
+    def submit_ready(self):
+        for i in [i for i in self.pending if all(d in self.done for d in self.dependencies[i])]:
+            self.pending.remove(i)
+            prev_obs = {d: self.observations[d] for d in self.dependencies[i]}
+            future = self.executor.submit(tracer.bind(self.operator.execute_step), i, self.steps[i], self.query, self.chat_history, prev_obs)
+            self.running[future] = i
+
+    def collect(self, timeout=None):
+        '''
+        Wait up to timeout seconds (forever if None) for running steps. Returns the (index, observation) of finished steps.
+        '''
+        if not self.running:
+            return []
+        finished, _ = wait(self.running, timeout=timeout, return_when=FIRST_COMPLETED)
+        results = []
+        for future in finished:
+            i = self.running.pop(future)
+            self.observations[i] = future.result()
+            self.done.add(i)
+            results.append((i, self.observations[i]))
+        self.submit_ready()
+        return results
+
+    def is_finished(self):
+        return not self.pending and not self.running
 
 
 class PlanningOperator(Operator):
-    def __init__(self, verbose=True):
+    def __init__(self, verbose=True, max_workers=3):
         super().__init__()
+        self.max_workers = max_workers
         
         self.model_prompt_template = "<s>[INST] <<SYS>>{system_prompt}<</SYS>>{instruction}[/INST]{cue}"
-        self.planner = BasicModelRunner(model_name="meta-llama/Llama-2-7b-chat-hf")
+        self.planner_model_name = "meta-llama/Llama-2-7b-chat-hf"
+        # Optional callable streaming the planner completion for a prompt, as an iterator of text chunks.
+        # Defaults to streaming from the backend.
+        self.planner_stream = None
+        self.session_store = None
     
         self.create_tools_prompt()
         self.create_planning_prompt_templates()
 
         self.enumerated_list_pattern = r'\d+\.\s(.*?)(?=\s*\d+\.\s|\Z)'
+        self.step_dependency_pattern = r'\s*\((?:after|depends on)\s+steps?\s*([\d,\sand]+)\)\.?\s*$'
+        self.step_independent_pattern = r'\s*\((?:independent|no dependencies)\)\.?\s*$'
         self.verbose = verbose
 
     def create_planning_prompt_templates(self):
         self.planner_system_prompt = "You make plans about what actions to take, given a user query and the current state of the conversation. Provide 3 steps on what tools need to be used, given the tools available."
-        self.planning_suffix = "\nMake a 3-step plan in an enumerated list, with the tools available. In each step, include the tool or description of using the tool (no need to specify arguments)."
+        self.planning_suffix = "\nMake a 3-step plan in an enumerated list, with the tools available. In each step, include the tool or description of using the tool (no need to specify arguments). A step uses the results of all earlier steps, unless it ends with (after step N) to use only the result of step N, or with (independent) if it needs no earlier result."
         planning_tools_template = "Tools available: {tools}\n\nConversation:\n"
         planning_user_query_template = "User: {user_query}\n{planning_suffix}"
         
@@ -29,99 +138,314 @@ class PlanningOperator(Operator):
         
         self.step_prompt_template = "Chat history: {chat_history}\n\nLatest user message: {query}\n\nAction to take: {step}"
 
-    def create_tools_prompt(self):
-        tools_string = ""
+    def enable_sessions(self, store=None):
+        '''
+        Keep the chat history of conversations between calls, in the given session store (an InMemorySessionStore by
+        default, or e.g. a SQLiteSessionStore). Calls with a conversation_id then use and extend its history, with
+        older turns compacted into a rolling summary. See Session.
+        '''
+        self.session_store = store if store is not None else InMemorySessionStore()
+        return self
+
+    def get_session(self, conversation_id):
+        if conversation_id is None:
+            return None
+        if self.session_store is None:
+            raise Exception("Sessions are not enabled, call enable_sessions first.")
+        return self.session_store.get(conversation_id)
+
+    def record_turn(self, session, query, response):
+        '''
+        Add a user query and the response to it to the session, and save it.
+        '''
+        session.add_turn("User", query)
+        session.add_turn("System", response)
+        self.session_store.save(session)
+
+    def format_with_history(self, template, chat_history, **kwargs):
+        '''
+        Format a prompt template with a {chat_history} field. chat_history is a string, or a Session, whose cached
+        prompt prefix (the template up to the history, and the history) is reused.
+        '''
+        if not isinstance(chat_history, Session):
+            return template.format(chat_history=chat_history, **kwargs)
+        head, tail = template.split("{chat_history}", 1)
+        return chat_history.get_prefix(head.format(**kwargs)) + tail.format(**kwargs)
+
+    def get_tool_prompts(self):
+        '''
+        The description and arguments of every tool, as rendered in the planning prompt.
+        '''
+        tool_prompts = {}
         for tool_name, tool_obj in self.operations.items():
             tool_arguments_string = ""
             
-            for i, arg in enumerate(tool_obj['arguments']):
-                tool_arguments_string += f"{i+1}) {arg['name']} ({arg['type']}): {arg['description']} "
+            for i, arg in enumerate(tool_obj.arguments):
+                tool_arguments_string += f"{i+1}) {arg.name} ({arg.type}): {arg.description} "
             
-            tools_string += f"\n- {tool_name}: {tool_obj['description']}\n{tool_name} has arguments: {tool_arguments_string}"
-        return tools_string
-    
+            tool_prompts[tool_name] = f"\n- {tool_name}: {tool_obj.description}\n{tool_name} has arguments: {tool_arguments_string}"
+        return tool_prompts
+
+    def create_tools_prompt(self, tool_names=None):
+        tool_prompts = self.get_tool_prompts()
+        return "".join(tool_prompts[tool_name] for tool_name in (tool_names or tool_prompts))
+
+    def get_tool_scores(self, user_query):
+        '''
+        Relevance of every tool to the query, to drop the least relevant tools first when the planning prompt is over
+        budget: the tool index scores with a tool shortlist, else the local fast-path router's probabilities when
+        trained, else the number of query words in the tool prompt.
+        '''
+        if self.tool_index is not None:
+            return dict(self.tool_index.search(user_query))
+        prior = self.router.get_prior(user_query) if self.router is not None else None
+        if prior is not None:
+            return prior[0]
+        words = set(re.findall(r"\w+", user_query.lower()))
+        return {
+            tool_name: len(words & set(re.findall(r"\w+", tool_prompt.lower())))
+            for tool_name, tool_prompt in self.get_tool_prompts().items()
+        }
+
     def postprocess_enumerated_list(self, text):
         items = [item.strip() for item in re.findall(self.enumerated_list_pattern, text, re.DOTALL)]
         return items
 
-    def plan(self, user_query, chat_history=None):
-        tools = self.create_tools_prompt()
-        
+    def render_planning_prompt(self, user_query, chat_history, tools):
+        if isinstance(chat_history, Session) and not chat_history:
+            chat_history = None
         if chat_history is not None:
             instruction_prompt_template = self.planning_prompt_template_chat_history
         else:
             instruction_prompt_template = self.planning_prompt_template
-        
-        instruction = instruction_prompt_template.format(
-            chat_history=chat_history,
+
+        prompt_template = self.model_prompt_template.format(
+            system_prompt=self.planner_system_prompt,
+            instruction=instruction_prompt_template,
+            cue=self.planning_cue
+        )
+        return self.format_with_history(
+            prompt_template,
+            chat_history,
             user_query=user_query,
             tools=tools,
             planning_suffix=self.planning_suffix
         )
 
-        prompt = self.model_prompt_template.format(
-            system_prompt=self.planner_system_prompt,
-            instruction=instruction,
-            cue=self.planning_cue
-        )
-        
-        if self.verbose:
-            print(f"[PLAN prompt] {prompt}")
-            print(f"[PLAN prompt length] {len(prompt)}")
-       
-        out = self.planner(str(prompt))
+    def fit_planning_prompt(self, user_query, chat_history, prompt, tool_names=None):
+        '''
+        Fit the planning prompt into the planner's token budget. The least relevant tools are dropped first (keeping
+        the most relevant one), then the oldest part of the chat history is cut.
+        '''
+        budget = self.token_budget
+        max_tokens = budget.get_budget(self.planner_model_name)
+        tokens = budget.count(prompt)
+        if tokens > max_tokens:
+            tool_prompts = self.get_tool_prompts()
+            if tool_names:
+                tool_prompts = {tool_name: tool_prompts[tool_name] for tool_name in tool_names}
+            base_tokens = budget.count(self.render_planning_prompt(user_query, chat_history, ""))
+            tool_names = budget.fit_sections(tool_prompts, max_tokens - base_tokens, self.get_tool_scores(user_query))
+            tools = self.create_tools_prompt(tool_names)
+            prompt = self.render_planning_prompt(user_query, chat_history, tools)
+            if budget.count(prompt) > max_tokens and chat_history:
+                history = chat_history.get_history() if isinstance(chat_history, Session) else chat_history
+                history_tokens = max_tokens - budget.count(self.render_planning_prompt(user_query, "", tools))
+                prompt = self.render_planning_prompt(user_query, budget.truncate(history, max(history_tokens, 0), keep_end=True), tools)
+        fitted_tokens = budget.count(prompt)
+        budget.record(fitted_tokens, tokens - fitted_tokens)
+        return prompt
+
+    def get_planning_prompt(self, user_query, chat_history=None):
+        '''
+        The planning prompt, with the shortlisted tools only if a tool shortlist is enabled (see enable_tool_shortlist),
+        fitted into the token budget if one is enabled.
+        '''
+        tool_names = self.shortlist_operations(user_query)
+        tools = self.create_tools_prompt(tool_names)
+        prompt = self.render_planning_prompt(user_query, chat_history, tools)
+        if self.token_budget is not None:
+            prompt = self.fit_planning_prompt(user_query, chat_history, prompt, tool_names)
         
         if self.verbose:
-            print(f"[PLAN out] {out}")
-        
-        out = out.split("\n\n")[0]
-        list_out = self.postprocess_enumerated_list(self.planning_cue + out)
-        
+            logger.info("[PLAN prompt] %s", prompt)
+            logger.info("[PLAN prompt length] %d", len(prompt))
+        return prompt
+
+    def plan(self, user_query, chat_history=None):
+        with tracer.span("plan", operator=type(self).__name__) as span:
+            prompt = self.get_planning_prompt(user_query, chat_history)
+            span.set_prompt(prompt)
+
+            out = self.backend.generate_text(str(prompt), model_name=self.planner_model_name)
+
+            if self.verbose:
+                logger.info("[PLAN out] %s", out)
+
+            out = out.split("\n\n")[0]
+            list_out = self.postprocess_enumerated_list(self.planning_cue + out)
+            span.set(steps=len(list_out))
+
         if self.verbose:
-            print(f"[PLAN list]: {list_out}")
-        
+            logger.info("[PLAN list]: %s", list_out)
+
         return list_out
     
-    def execute_plan(self, plan, query, chat_history=None):
-        prev_obs = []
+    def parse_step(self, i, step):
+        '''
+        Parse the "(after step N)" or "(independent)" annotation of the i-th step of a plan.
+        Returns the step without the annotation, and the list of earlier steps it depends on.
+        A step without annotation depends on all earlier steps, an independent step on none. So does a step referring
+        to a step that is not an earlier one, e.g. a missing or later step, rather than running without the observations
+        it expects.
+        '''
+        match = re.search(self.step_independent_pattern, step, re.IGNORECASE)
+        if match:
+            return step[:match.start()], []
+        match = re.search(self.step_dependency_pattern, step, re.IGNORECASE)
+        if not match:
+            return step, list(range(i))
+        references = {int(n) for n in re.findall(r'\d+', match.group(1))}
+        if not references or not all(0 < n <= i for n in references):
+            return step[:match.start()], list(range(i))
+        return step[:match.start()], sorted(n - 1 for n in references)
+
+    def get_step_dependencies(self, plan):
+        '''
+        Returns the steps of the plan without annotations, and for every step the list of earlier steps it depends on.
+        '''
+        steps = []
+        dependencies = []
         for i, step in enumerate(plan):
-            if self.verbose:
-                print(f"Action #{i+1}: {step}")
-            
-            prompt = self.step_prompt_template.format(chat_history=chat_history, query=query, step=step)
-            
-            if prev_obs:
-                prev_obs_str = self.list_obs_to_str(prev_obs)
-                prompt += f"\n\nPrevious observations: {prev_obs_str}"
-            
-            obs = self.run(step, prompt)
-            prev_obs.append(obs)
-            
-            if self.verbose:
-                print(f"Observation #{i+1}: {obs}")
-        
-        return prev_obs
+            step, depends_on = self.parse_step(i, step)
+            steps.append(step)
+            dependencies.append(depends_on)
+        return steps, dependencies
+
+    def fit_observations(self, prompt, prev_obs):
+        '''
+        Truncate the oldest observations of previous steps so the step prompt, and the argument extraction prompt built
+        from it, fit in the token budget of the operator's model.
+        '''
+        budget = self.token_budget
+        extraction_tokens = budget.count(ARGS_PROMPT_TEMPLATE) + max(
+            (budget.count(operation.args_prompt) for operation in self.operations.values()), default=0
+        )
+        max_tokens = budget.get_budget(self.model_name) - extraction_tokens - budget.count(prompt)
+        return budget.fit_observations(prev_obs, max(max_tokens, 0))
+
+    def execute_step(self, i, step, query, chat_history, prev_obs):
+        '''
+        Route and run a single step, given the observations of the steps it depends on as a dict of step index to observation.
+        '''
+        if self.verbose:
+            logger.info("Action #%d: %s", i + 1, step)
+
+        prompt = self.format_with_history(self.step_prompt_template, chat_history, query=query, step=step)
+
+        if prev_obs:
+            step_numbers = list(prev_obs)
+            observations = list(prev_obs.values())
+            if self.token_budget is not None:
+                observations = self.fit_observations(prompt, observations)
+            prev_obs_str = self.list_obs_to_str(observations, step_numbers)
+            prompt += f"\n\nPrevious observations: {prev_obs_str}"
+
+        obs = self.run(step, prompt)
+
+        if self.verbose:
+            logger.info("Observation #%d: %s", i + 1, obs)
+        return obs
+
+    def execute_plan(self, plan, query, chat_history=None):
+        '''
+        Execute the steps of the plan. Independent steps run concurrently on up to max_workers threads, and a step that
+        depends on earlier steps starts once they are done, with their observations in its prompt.
+        Returns the observations in the order of the plan.
+        '''
+        with tracer.span("execute_plan", operator=type(self).__name__, steps=len(plan)):
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                scheduler = PlanScheduler(self, executor, query, chat_history)
+                for step in plan:
+                    scheduler.add_step(step)
+                while not scheduler.is_finished():
+                    scheduler.collect()
+        return scheduler.observations
+
+    def stream_plan_tokens(self, prompt):
+        '''
+        Stream the planner completion, with planner_stream if set, else from the backend.
+        '''
+        if self.planner_stream is not None:
+            yield from self.planner_stream(str(prompt))
+        else:
+            yield from self.backend.stream(str(prompt), model_name=self.planner_model_name)
 
-    def list_obs_to_str(self, obs_list):
+    def stream(self, query, chat_history=None, conversation_id=None):
+        '''
+        Plan and execute incrementally. Steps are parsed as the planner streams its completion, and each step is
+        dispatched as soon as it is complete and its dependencies are done, while later steps are still being generated.
+        Yields ("step", index, step) when a step is planned and ("observation", index, observation) when it is executed.
+        With a conversation_id, the chat history of its session is used, and the turn is added to it once all steps ran.
+        '''
+        session = self.get_session(conversation_id)
+        if session is not None:
+            chat_history = session
+        prompt = self.get_planning_prompt(query, chat_history)
+        parser = EnumeratedListStreamParser(prefix=self.planning_cue)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            scheduler = PlanScheduler(self, executor, query, chat_history)
+            for chunk in self.stream_plan_tokens(prompt):
+                for step in parser.feed(chunk):
+                    yield ("step",) + scheduler.add_step(step)
+                for i, obs in scheduler.collect(timeout=0):
+                    yield ("observation", i, obs)
+            for step in parser.finish():
+                yield ("step",) + scheduler.add_step(step)
+            while not scheduler.is_finished():
+                for i, obs in scheduler.collect():
+                    yield ("observation", i, obs)
+        if session is not None:
+            self.record_turn(session, query, self.list_obs_to_str(scheduler.observations))
+
+    def list_obs_to_str(self, obs_list, step_numbers=None):
+        '''
+        Observations as "1) obs; 2) obs". step_numbers: the index in the plan of every observation, so they keep the
+        numbers of their steps, e.g. for the observations of a step that runs after steps 1 and 3 only.
+        '''
+        if step_numbers is None:
+            step_numbers = range(len(obs_list))
         obs_str = ""
-        for i, obs in enumerate(obs_list):
-            obs_str += f"{i+1}) {obs}"
+        for i, (step_number, obs) in enumerate(zip(step_numbers, obs_list)):
+            obs_str += f"{step_number+1}) {obs}"
             if i != len(obs_list) - 1:
                 obs_str += '; '
         return obs_str
 
-    def __call__(self, query, chat_history=None):
-        print("Generating plan...")
+    def __call__(self, query, chat_history=None, stream=False, conversation_id=None):
+        '''
+        Plan and execute the query. With a conversation_id (see enable_sessions), the chat history is kept in its session
+        instead of being passed in.
+        '''
+        if stream:
+            return self.stream(query, chat_history, conversation_id=conversation_id)
+
+        session = self.get_session(conversation_id)
+        if session is not None:
+            chat_history = session
+
+        logger.info("Generating plan...")
         plan = self.plan(query, chat_history)
         
         plan_string = ""
         for i, step in enumerate(plan):
             plan_string += f"{i+1}) {step}\n"
-        print(f"Plan:\n{plan_string}")
-        
-        print("Executing plan...")
+        logger.info("Plan:\n%s", plan_string)
+
+        logger.info("Executing plan...")
         prev_obs = self.execute_plan(plan, query, chat_history)
 
         all_obs_str = self.list_obs_to_str(prev_obs)
+        if session is not None:
+            self.record_turn(session, query, all_obs_str)
         return f"\nCompleted plan:\n{all_obs_str}"
-
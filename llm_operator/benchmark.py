@@ -0,0 +1,296 @@
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import contextlib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from model_backend import StubBackend, set_default_backend
+from operator_registry import registry
+from food_delivery_operator import FoodDeliveryOperator
+from customer_support_operator import CustomerSupportOperator
+from onboarding_operator import OnboardingOperator
+from motivation_operator import MotivationOperator
+from operator_of_operators import MainApp
+from planning_motivation_operator import PlanningMotivationOperator
+
+
+# Simulated model latencies in milliseconds, roughly those of the hosted models. See StubBackend.
+DEFAULT_LATENCY = {
+    "classify": ("lognormal", 60, 0.3),
+    "generate": ("lognormal", 400, 0.35),
+    "generate_text": ("lognormal", 900, 0.4),
+    "stream_chunk": ("lognormal", 15, 0.3),
+}
+
+# Workloads: data files replayed through the operator, and whether the operator plans.
+WORKLOADS = {
+    "food_delivery": (["data/food_delivery.csv"], False),
+    "customer_support": (["data/customer_support.csv"], False),
+    "operator_of_operators": (["data/onboarding.csv", "data/motivation.csv"], False),
+    "planning_motivation": (["data/motivation.csv"], True),
+}
+
+STAGES = ["route", "extract", "tool", "plan", "execute"]
+
+
+def build_operator(name, models_path):
+    '''
+    Train (or load, if already trained) the operator of a workload with the current default backend, under models_path.
+    '''
+    if name == "food_delivery":
+        operator = FoodDeliveryOperator()
+        operator.train(models_path + "FoodDeliveryOperator/", "data/food_delivery.csv")
+    elif name == "customer_support":
+        operator = CustomerSupportOperator()
+        operator.train(models_path + "CustomerSupportOperator/", "data/customer_support.csv")
+    elif name == "operator_of_operators":
+        OnboardingOperator().train(models_path + "OnboardingOperator/", "data/onboarding.csv")
+        MotivationOperator().train(models_path + "MotivationOperator/", "data/motivation.csv")
+        operator = MainApp()
+        registry.register("OnboardingOperator", OnboardingOperator, models_path + "OnboardingOperator/")
+        registry.register("MotivationOperator", MotivationOperator, models_path + "MotivationOperator/")
+        operator.train(models_path + "MainApp/", None)
+    elif name == "planning_motivation":
+        operator = PlanningMotivationOperator(verbose=False)
+        operator.train(models_path + "MotivationOperator/", "data/motivation.csv")
+    else:
+        raise Exception(f"Unknown workload {name}.")
+    return operator
+
+
+def load_traffic(traffic_path, workloads):
+    '''
+    Queries to replay for every workload: the data column of its CSV files, or the requests of a JSONL file with one
+    {"operator": name, "query": ..., "prompt": ... (optional)} object per line, in the format of the pre-fork server.
+    '''
+    traffic = {name: [] for name in workloads}
+    if traffic_path:
+        with open(traffic_path) as f:
+            for line in f:
+                if line.strip():
+                    request = json.loads(line)
+                    if request["operator"] in traffic:
+                        traffic[request["operator"]].append((request["query"], request.get("prompt")))
+        return traffic
+    for name in workloads:
+        for data_path in WORKLOADS[name][0]:
+            with open(data_path, newline="") as f:
+                for row in csv.DictReader(f, skipinitialspace=True):
+                    traffic[name].append((row["data"], None))
+    return traffic
+
+
+def run_query(operator, planning, query, prompt):
+    '''
+    Run one query, returning the seconds spent in each stage and in total, and whether it failed.
+    '''
+    timings = {}
+    start = time.perf_counter()
+    failed = False
+    try:
+        if planning:
+            plan = operator.plan(query)
+            timings["plan"] = time.perf_counter() - start
+            operator.execute_plan(plan, query)
+            timings["execute"] = time.perf_counter() - start - timings["plan"]
+        else:
+            operator.run(query, prompt, timings=timings)
+    except Exception:
+        failed = True
+    timings["total"] = time.perf_counter() - start
+    return timings, failed
+
+
+def summarize(samples):
+    samples = np.array(samples) * 1000
+    return {
+        "p50": float(np.percentile(samples, 50)),
+        "p95": float(np.percentile(samples, 95)),
+        "p99": float(np.percentile(samples, 99)),
+        "mean": float(samples.mean()),
+    }
+
+
+def run_workload(name, operator, queries, backend, concurrency):
+    planning = WORKLOADS[name][1]
+    backend.reset_call_counts()
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(lambda item: run_query(operator, planning, *item), queries))
+    wall_time = time.perf_counter() - start
+
+    latency = {"total": summarize([timings["total"] for timings, _ in results])}
+    for stage in STAGES:
+        samples = [timings[stage] for timings, _ in results if stage in timings]
+        if samples:
+            latency[stage] = summarize(samples)
+    calls = dict(backend.call_counts, total=sum(backend.call_counts.values()))
+    return {
+        "queries": len(queries),
+        "errors": sum(failed for _, failed in results),
+        "wall_time_s": wall_time,
+        "throughput_qps": len(queries) / wall_time if wall_time else 0.0,
+        "latency_ms": latency,
+        "model_calls_per_query": {kind: count / len(queries) for kind, count in calls.items()},
+    }
+
+
+def compare(report, baseline, max_regression):
+    '''
+    Regressions of the report against a baseline report: p95 total latency or model calls per query that grew by
+    more than max_regression (a fraction), per workload.
+    '''
+    regressions = []
+    for name, result in report["workloads"].items():
+        previous = baseline.get("workloads", {}).get(name)
+        if previous is None:
+            continue
+        checks = [
+            ("latency_ms.total.p95", result["latency_ms"]["total"]["p95"], previous["latency_ms"]["total"]["p95"]),
+            ("model_calls_per_query.total", result["model_calls_per_query"]["total"], previous["model_calls_per_query"]["total"]),
+        ]
+        for metric, value, previous_value in checks:
+            if value > previous_value * (1 + max_regression) + 1e-9:
+                regressions.append({"workload": name, "metric": metric, "baseline": previous_value, "value": value})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--workloads",
+        type=str,
+        nargs="+",
+        choices=list(WORKLOADS),
+        help="Workloads to run.",
+        default=list(WORKLOADS),
+    )
+
+    parser.add_argument(
+        "--traffic",
+        type=str,
+        help="JSONL file of requests to replay, one {\"operator\": workload, \"query\": ...} per line. Defaults to the rows of data/*.csv.",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--models_path",
+        type=str,
+        help="Path to train the benchmark operators to, with the stub backend.",
+        default="models/benchmark/",
+    )
+
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        help="Number of queries in flight.",
+        default=1,
+    )
+
+    parser.add_argument(
+        "--max_queries",
+        type=int,
+        help="Maximum number of queries per workload.",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--latency_scale",
+        type=float,
+        help="Multiplier of the simulated model latencies, e.g. 0 for no latency.",
+        default=1.0,
+    )
+
+    parser.add_argument(
+        "--error_rate",
+        type=float,
+        help="Probability that a simulated model call fails.",
+        default=0.0,
+    )
+
+    parser.add_argument(
+        "--seed",
+        type=int,
+        help="Seed of the simulated latencies and errors.",
+        default=0,
+    )
+
+    parser.add_argument(
+        "--output",
+        type=str,
+        help="Path to write the JSON report to. Defaults to stdout.",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        help="JSON report to compare against. Exits with status 1 on a regression.",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--max_regression",
+        type=float,
+        help="Tolerated relative increase of p95 latency and model calls per query over the baseline.",
+        default=0.1,
+    )
+
+    parser.add_argument(
+        "-l", action="store_true", help="this flag is a no-op to silence errors"
+    )
+
+    args = parser.parse_args()
+
+    if args.models_path[-1] != "/":
+        args.models_path += "/"
+
+    latency = {kind: (name, params[0] * args.latency_scale) + tuple(params[1:]) for kind, (name, *params) in DEFAULT_LATENCY.items()}
+    error_kinds = ["classify", "generate", "generate_text", "stream"]
+    backend = StubBackend(latency=latency, error_rate={kind: args.error_rate for kind in error_kinds}, seed=args.seed)
+    set_default_backend(backend)
+
+    traffic = load_traffic(args.traffic, args.workloads)
+    report = {
+        "config": {
+            "backend": "stub",
+            "latency": latency,
+            "error_rate": args.error_rate,
+            "concurrency": args.concurrency,
+            "seed": args.seed,
+            "traffic": args.traffic or "data/*.csv",
+        },
+        "workloads": {},
+    }
+    for name in args.workloads:
+        queries = traffic[name][:args.max_queries]
+        if not queries:
+            continue
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            operator = build_operator(name, args.models_path)
+        report["workloads"][name] = run_workload(name, operator, queries, backend, args.concurrency)
+        print(f"{name}: {len(queries)} queries, p95 {report['workloads'][name]['latency_ms']['total']['p95']:.1f}ms", file=sys.stderr)
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["regressions"] = compare(report, json.load(f), args.max_regression)
+        status = 1 if report["regressions"] else 0
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    sys.exit(status)
+
+
+if __name__ == "__main__":
+    main()
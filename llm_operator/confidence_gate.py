@@ -0,0 +1,65 @@
+import threading
+
+
+class ConfidenceGate:
+    '''
+    Decides which routing decisions are confident enough to commit to, from the margin between the probabilities of
+    the two most likely operations. Confident queries go straight to argument extraction, without extra verification.
+    Low-confidence queries are handled by the policy:
+
+    "fallback": route to fallback_operation, e.g. noop or gather_info.
+    "speculative": extract arguments for the top candidates in parallel, and keep the one whose arguments fit best: all
+    valid for their types, then the most filled by rule extractors, then the most likely.
+    "escalate": let the larger escalation model choose among the top candidates and extract their arguments.
+    '''
+    POLICIES = ("fallback", "speculative", "escalate")
+
+    def __init__(
+            self,
+            min_margin: float = 0.2,
+            policy: str = "fallback",
+            fallback_operation: str = None,
+            escalation_model_name: str = "meta-llama/Llama-2-70b-chat-hf",
+            max_candidates: int = 2,
+    ):
+        if policy not in self.POLICIES:
+            raise Exception(f"Unknown low-confidence policy {policy}, expected one of {', '.join(self.POLICIES)}.")
+        if policy == "fallback" and fallback_operation is None:
+            raise Exception("The fallback policy needs a fallback_operation.")
+        self.min_margin = min_margin
+        self.policy = policy
+        self.fallback_operation = fallback_operation
+        self.escalation_model_name = escalation_model_name
+        self.max_candidates = max_candidates
+        self.counts = {"confident": 0, "low_confidence": 0}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_margin(probabilities):
+        '''
+        Difference between the probabilities of the two most likely operations. 1.0 with a single operation.
+        '''
+        top = sorted(probabilities.values(), reverse=True)[:2]
+        if len(top) < 2:
+            return 1.0
+        return top[0] - top[1]
+
+    def get_candidates(self, probabilities):
+        '''
+        The max_candidates most likely operations, most likely first.
+        '''
+        return sorted(probabilities, key=probabilities.get, reverse=True)[:self.max_candidates]
+
+    def is_confident(self, probabilities):
+        confident = self.get_margin(probabilities) >= self.min_margin
+        with self.lock:
+            self.counts["confident" if confident else "low_confidence"] += 1
+        return confident
+
+    def get_report(self):
+        total = sum(self.counts.values())
+        return dict(
+            self.counts,
+            policy=self.policy,
+            low_confidence_rate=self.counts["low_confidence"] / total if total else 0.0,
+        )
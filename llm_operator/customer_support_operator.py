@@ -3,7 +3,8 @@ import re
 import argparse
 
 from base_operator import Operator
-from llama import LlamaV2Runner
+from argument_extractors import argument_extractors, ChoiceExtractor
+from tracing import configure_logging
 
 
 os.environ["LLAMA_ENVIRONMENT"] = "PRODUCTION"
@@ -12,7 +13,7 @@ os.environ["LLAMA_ENVIRONMENT"] = "PRODUCTION"
 class CustomerSupportOperator(Operator):
     def __init__(self):
         super().__init__()
-        self.chat_model = LlamaV2Runner()
+        self.chat_model_name = "meta-llama/Llama-2-7b-chat-hf"
 
         # Add operations here
         self.add_operation(self.create_ticket)
@@ -45,6 +46,7 @@ class CustomerSupportOperator(Operator):
         else:
             return f"The user's issue is not resolved. The ticket is still open."
 
+    @argument_extractors(severity_level=ChoiceExtractor(["high", "medium", "low"]))
     def escalate(self, severity_level: str):
         """
         User issue is not resolved after multiple tries. Escalate the ticket.
@@ -65,8 +67,9 @@ class CustomerSupportOperator(Operator):
         """
 
         # Implement the actual business logic here. Eg: save this data in 'miscellaneous data' for user search analysis.
-        model_response = self.chat_model(
+        model_response = self.backend.generate_text(
             message,
+            model_name=self.chat_model_name,
             system_prompt="Your job is to get more details on the user's issue. Answer the user's questions, or ask the user for more details. Use 1 sentence.",
         )
         clean_response = re.sub(r"(\.|\?){2,}", r"\1", model_response)
@@ -82,9 +85,10 @@ def train(operator_save_path, training_data=None):
 
 def inference(queries, operator_save_path):
     operator = CustomerSupportOperator().load(operator_save_path)
-    for query in queries:
+    responses = operator.run_batch(queries)
+
+    for query, response in zip(queries, responses):
         print(f"\n\nUser message: {query}")
-        response = operator(query)
         print(response)
 
 
@@ -126,6 +130,7 @@ def main():
     )
 
     args = parser.parse_args()
+    configure_logging()
 
     if args.train:
         train(args.operator_save_path, args.training_data)
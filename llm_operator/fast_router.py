@@ -0,0 +1,136 @@
+import re
+import zlib
+import numpy as np
+
+
+class FastRouter:
+    '''
+    Local first-stage router, answered in-process without any model call.
+    Queries are embedded as hashed word and character n-gram TF-IDF vectors and scored against one centroid per class.
+    Only queries where the margin between the two most likely classes is at least threshold are answered here.
+    '''
+    def __init__(self, n_features: int = 2 ** 16, threshold: float = 0.5, scale: float = 10.0):
+        self.n_features = n_features
+        self.threshold = threshold
+        self.scale = scale
+        self.class_names = []
+        self.idf = None
+        self.centroids = None
+
+    def __get_features(self, text):
+        '''
+        Hashed feature ids of word unigrams, word bigrams and character trigrams of the text.
+        '''
+        words = re.findall(r"\w+", text.lower())
+        grams = [f"w:{word}" for word in words]
+        grams += [f"b:{a} {b}" for a, b in zip(words, words[1:])]
+        for word in words:
+            padded = f" {word} "
+            grams += [f"c:{padded[i:i + 3]}" for i in range(len(padded) - 2)]
+        return np.array([zlib.crc32(gram.encode()) % self.n_features for gram in grams], dtype=np.int64)
+
+    def __vectorize(self, features):
+        '''
+        Sparse L2-normalized TF-IDF vector from hashed feature ids, as (feature ids, weights).
+        '''
+        ids, counts = np.unique(features, return_counts=True)
+        weights = (1.0 + np.log(counts)) * self.idf[ids]
+        norm = np.linalg.norm(weights)
+        if norm > 0:
+            weights = weights / norm
+        return ids, weights.astype(np.float32)
+
+    def fit(self, class_examples):
+        '''
+        class_examples: dict of class name to the list of example texts of the class (descriptions and training rows).
+        '''
+        return self.fit_batches(list(class_examples), lambda: [class_examples])
+
+    def fit_batches(self, class_names, iter_batches):
+        '''
+        Fit on examples streamed in batches, without holding them all in memory.
+
+        class_names: names of the classes.
+        iter_batches: callable returning an iterator of dicts of class name to example texts. It is called twice: for
+        the document frequencies, then for the centroids.
+        '''
+        self.class_names = list(class_names)
+        class_ids = {name: class_id for class_id, name in enumerate(self.class_names)}
+        document_frequency = np.zeros(self.n_features, dtype=np.float32)
+        documents = 0
+        for batch in iter_batches():
+            for examples in batch.values():
+                for text in examples:
+                    document_frequency[np.unique(self.__get_features(text))] += 1
+                    documents += 1
+        self.idf = np.log((1.0 + documents) / (1.0 + document_frequency)).astype(np.float32) + 1.0
+
+        self.centroids = np.zeros((len(self.class_names), self.n_features), dtype=np.float32)
+        for batch in iter_batches():
+            for name, examples in batch.items():
+                for text in examples:
+                    ids, weights = self.__vectorize(self.__get_features(text))
+                    self.centroids[class_ids[name], ids] += weights
+        norms = np.linalg.norm(self.centroids, axis=1, keepdims=True)
+        self.centroids /= np.where(norms > 0, norms, 1.0)
+        return self
+
+    def predict_proba(self, data, candidates=None):
+        '''
+        data: list of strings to predict.
+        candidates: optional list, for every query, of the class names it may be classified as (None for all classes).
+        Returns a (len(data), number of classes) array of probabilities and a boolean array of which queries are confident.
+        '''
+        scores = np.zeros((len(data), len(self.class_names)), dtype=np.float32)
+        for i, text in enumerate(data):
+            features, weights = self.__vectorize(self.__get_features(text))
+            if len(features):
+                scores[i] = self.centroids[:, features] @ weights
+        logits = self.scale * scores
+        if candidates is not None:
+            logits = np.where(self.get_candidate_mask(candidates), logits, -np.inf)
+        probabilities = np.exp(logits - logits.max(axis=1, keepdims=True))
+        probabilities /= probabilities.sum(axis=1, keepdims=True)
+
+        if len(self.class_names) > 1:
+            top_two = np.sort(probabilities, axis=1)[:, -2:]
+            margin = top_two[:, 1] - top_two[:, 0]
+        else:
+            margin = np.ones(len(data), dtype=np.float32)
+        confident = (margin >= self.threshold) & scores.any(axis=1)
+        return probabilities, confident
+
+    def get_candidate_mask(self, candidates):
+        '''
+        Boolean (len(candidates), number of classes) array of the candidate classes of every query. Queries with fewer
+        than two candidates among the classes may be classified as any class, as a single candidate would always have
+        a margin of 1 and be confident.
+        '''
+        mask = np.ones((len(candidates), len(self.class_names)), dtype=bool)
+        for i, names in enumerate(candidates):
+            if names:
+                row = [name in names for name in self.class_names]
+                if sum(row) > 1:
+                    mask[i] = row
+        return mask
+
+    def save(self, path):
+        np.savez(
+            path,
+            class_names=np.array(self.class_names),
+            idf=self.idf,
+            centroids=self.centroids,
+        )
+
+    @classmethod
+    def from_arrays(cls, class_names, idf, centroids, threshold: float = 0.5):
+        router = cls(n_features=idf.shape[0], threshold=threshold)
+        router.class_names = [str(name) for name in class_names]
+        router.idf = idf
+        router.centroids = centroids
+        return router
+
+    @classmethod
+    def load(cls, path, threshold: float = 0.5):
+        arrays = np.load(path)
+        return cls.from_arrays(arrays["class_names"], arrays["idf"], arrays["centroids"], threshold=threshold)
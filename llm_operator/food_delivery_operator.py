@@ -3,7 +3,7 @@ import re
 import argparse
 
 from base_operator import Operator
-from llama import LlamaV2Runner
+from tracing import logger, configure_logging
 
 
 os.environ["LLAMA_ENVIRONMENT"] = "PRODUCTION"
@@ -16,11 +16,11 @@ class FoodDeliveryOperator(Operator):
         Additionally, define any other entities required within any operation.
         """
         super().__init__()
-        self.chat_model = LlamaV2Runner()
+        self.chat_model_name = "meta-llama/Llama-2-7b-chat-hf"
 
         # Add operations here
         self.add_operation(self.search)
-        self.add_operation(self.order)
+        self.add_operation(self.order, cacheable=False)
         self.add_operation(self.noop)
 
     def search(self, search_query: str):
@@ -32,7 +32,7 @@ class FoodDeliveryOperator(Operator):
         """
 
         # Implement the actual business logic here. Eg: call the search API with this string.
-        print("It is indicated that the user wants to search for something.")
+        logger.info("It is indicated that the user wants to search for something.")
         return f"Redirecting to search API with search_query: {search_query}"
 
     def order(self, item_name: str, quantity: str, unit: str):
@@ -46,7 +46,7 @@ class FoodDeliveryOperator(Operator):
         """
 
         # Implement the actual business logic here. Eg: call the order API with this string.
-        print("It is indicated that the user wants to invoke cart/order operation.")
+        logger.info("It is indicated that the user wants to invoke cart/order operation.")
         return f"Calling orders API with: item_name={item_name}, quantity={quantity}, unit={unit}"
 
     def noop(self, message: str):
@@ -58,11 +58,11 @@ class FoodDeliveryOperator(Operator):
         """
 
         # Implement the actual business logic here. Eg: save this data in 'miscellaneous data' for user search analysis.
-        print(
+        logger.info(
             "It is indicated that this is a general query. So redirecting to a chat LLM."
         )
-        model_response = self.chat_model(
-            message, system_prompt="answer in 3 sentences maximum."
+        model_response = self.backend.generate_text(
+            message, model_name=self.chat_model_name, system_prompt="answer in 3 sentences maximum."
         )
         clean_response = re.sub(r"\.{2,}", ".", model_response)
         return f"Calling a general chat LLM...\nuser_query= {message}\n\noutput=\n{clean_response}"
@@ -77,10 +77,10 @@ def train(operator_save_path, training_data=None):
 
 def inference(queries, operator_save_path):
     operator = FoodDeliveryOperator().load(operator_save_path)
+    responses = operator.run_batch(queries)
 
-    for query in queries:
+    for query, response in zip(queries, responses):
         print(f"\n\nUser message: {query}")
-        response = operator(query)
         print(response)
 
 
@@ -122,6 +122,7 @@ def main():
     )
 
     args = parser.parse_args()
+    configure_logging()
 
     if args.operator_save_path[-1] != "/":
         args.operator_save_path += "/"
@@ -0,0 +1,305 @@
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from model_backend import BACKENDS, set_default_backend
+from tracing import tracer, PrometheusExporter, OTLPExporter
+from prefork_server import OPERATORS, load_operators, train_operators, serve_prefork, get_memory_usage
+
+
+class MicroBatcher:
+    '''
+    Collects concurrent requests to an operator for up to max_wait_ms, or until max_batch_size requests are waiting,
+    and runs them with a single run_batch call: one router call for the batch, one argument extraction call per
+    selected operation.
+
+    Up to max_concurrent_batches batches run at the same time, so the next batch is collected and started while the
+    previous ones are still waiting on the model or on their tools.
+    '''
+    def __init__(self, operator, max_batch_size: int = 32, max_wait_ms: float = 5.0, max_concurrent_batches: int = 4):
+        self.operator = operator
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.requests = queue.Queue()
+        # Only one thread collects a batch at a time, so requests arriving together are batched together.
+        self.collect_lock = threading.Lock()
+        self.threads = [threading.Thread(target=self.__loop, daemon=True) for _ in range(max_concurrent_batches)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, query, prompt=None):
+        '''
+        Run a query as part of the next batch. Blocks until the batch is done, and returns the result dict of the query.
+        '''
+        request = {"query": query, "prompt": prompt, "enqueued_at": time.perf_counter(), "done": threading.Event()}
+        self.requests.put(request)
+        request["done"].wait()
+        return request["result"]
+
+    def __collect_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.perf_counter() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def __loop(self):
+        while True:
+            with self.collect_lock:
+                batch = self.__collect_batch()
+            started_at = time.perf_counter()
+            queries = [request["query"] for request in batch]
+            prompts = [request["prompt"] or request["query"] for request in batch]
+            timings = []
+            try:
+                outputs = self.operator.run_batch(queries, prompts, timings=timings)
+            except Exception as e:
+                outputs = [e] * len(batch)
+                timings = [{} for _ in batch]
+            finished_at = time.perf_counter()
+
+            for request, output, stage_timings in zip(batch, outputs, timings):
+                result = {"batch_size": len(batch)}
+                if isinstance(output, Exception):
+                    result["error"] = f"{type(output).__name__}: {output}"
+                else:
+                    result["output"] = output if isinstance(output, (str, int, float, bool, type(None))) else str(output)
+                result["timings_ms"] = dict(
+                    {stage: seconds * 1000 for stage, seconds in stage_timings.items()},
+                    queue=(started_at - request["enqueued_at"]) * 1000,
+                    total=(finished_at - request["enqueued_at"]) * 1000,
+                )
+                request["result"] = result
+                request["done"].set()
+
+
+class OperatorRequestHandler(BaseHTTPRequestHandler):
+    '''
+    POST /operators/<name> with {"query": ..., "prompt": ... (optional)} runs the query through the operator.
+    GET /operators lists the served operators, GET /health reports the worker's memory usage, GET /metrics reports
+    the stage metrics of the worker in the Prometheus text format, when enabled.
+    '''
+    protocol_version = "HTTP/1.1"
+
+    def __send(self, status, data, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def __send_json(self, status, body):
+        self.__send(status, json.dumps(body).encode(), "application/json")
+
+    def do_GET(self):
+        if self.path == "/metrics" and self.server.metrics is not None:
+            self.__send(200, self.server.metrics.render().encode(), "text/plain; version=0.0.4")
+        elif self.path == "/operators":
+            self.__send_json(200, {"operators": list(self.server.batchers)})
+        elif self.path == "/health":
+            self.__send_json(200, {"status": "ok", "memory": get_memory_usage()})
+        else:
+            self.__send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        name = self.path[len("/operators/"):] if self.path.startswith("/operators/") else None
+        batcher = self.server.batchers.get(name)
+        if batcher is None:
+            self.__send_json(404, {"error": f"Unknown operator {name}"})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            query = body["query"]
+        except (ValueError, KeyError, TypeError):
+            self.__send_json(400, {"error": 'Expected a JSON body with a "query".'})
+            return
+        result = batcher.submit(query, body.get("prompt"))
+        self.__send_json(500 if "error" in result else 200, result)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class OperatorHTTPServer(ThreadingHTTPServer):
+    '''
+    HTTP front-end exposing operators as endpoints, with one micro-batcher per operator.
+    Pass listen_socket to serve on an already bound socket, e.g. one shared by pre-forked workers.
+    '''
+    daemon_threads = True
+    # Same backlog as the pre-fork listening socket, so bursts of concurrent clients are not reset.
+    request_queue_size = 128
+
+    def __init__(
+            self,
+            operators,
+            address=None,
+            listen_socket=None,
+            max_batch_size=32,
+            max_wait_ms=5.0,
+            max_concurrent_batches=4,
+            verbose=False,
+            metrics=None,
+    ):
+        if listen_socket is not None:
+            super().__init__(listen_socket.getsockname(), OperatorRequestHandler, bind_and_activate=False)
+            self.socket = listen_socket
+        else:
+            super().__init__(address, OperatorRequestHandler)
+        self.verbose = verbose
+        self.metrics = metrics
+        self.batchers = {
+            name: MicroBatcher(
+                operator,
+                max_batch_size=max_batch_size,
+                max_wait_ms=max_wait_ms,
+                max_concurrent_batches=max_concurrent_batches,
+            )
+            for name, operator in operators.items()
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--operators",
+        type=str,
+        nargs="+",
+        choices=list(OPERATORS),
+        help="Operators to serve, at POST /operators/<name>.",
+        default=["food_delivery"],
+    )
+
+    parser.add_argument(
+        "--host",
+        type=str,
+        help="Host to listen on.",
+        default="0.0.0.0",
+    )
+
+    parser.add_argument(
+        "--port",
+        type=int,
+        help="Port to listen on.",
+        default=8000,
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of pre-forked worker processes. 0 serves from this process.",
+        default=0,
+    )
+
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        help="Maximum number of requests routed together.",
+        default=32,
+    )
+
+    parser.add_argument(
+        "--max_wait_ms",
+        type=float,
+        help="How long the first request of a batch waits for more requests.",
+        default=5.0,
+    )
+
+    parser.add_argument(
+        "--max_concurrent_batches",
+        type=int,
+        help="Maximum number of batches of an operator running at the same time.",
+        default=4,
+    )
+
+    parser.add_argument(
+        "--models_path",
+        type=str,
+        help="Path the operators were trained to, e.g. models/stub/ for operators trained with --train --backend stub.",
+        default="models/",
+    )
+
+    parser.add_argument(
+        "--train",
+        action="store_true",
+        help="Train the operators to models_path first, with the selected backend. Unchanged operators are loaded as is.",
+        default=False,
+    )
+
+    parser.add_argument(
+        "--backend",
+        type=str,
+        choices=list(BACKENDS),
+        help="Model backend. The stub backend serves deterministic offline responses, for load tests.",
+        default="lamini",
+    )
+
+    parser.add_argument(
+        "--metrics", action="store_true", help="Serve stage metrics at GET /metrics", default=False
+    )
+
+    parser.add_argument(
+        "--otlp_endpoint",
+        type=str,
+        help="OTLP/HTTP endpoint to export spans to, e.g. http://localhost:4318/v1/traces.",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--verbose", action="store_true", help="Log every request", default=False
+    )
+
+    parser.add_argument(
+        "-l", action="store_true", help="this flag is a no-op to silence errors"
+    )
+
+    args = parser.parse_args()
+
+    set_default_backend(BACKENDS[args.backend]())
+    metrics = tracer.add_exporter(PrometheusExporter()) if args.metrics else None
+    if args.otlp_endpoint:
+        tracer.add_exporter(OTLPExporter(endpoint=args.otlp_endpoint))
+    if args.train:
+        train_operators(args.operators, args.models_path)
+    operators = load_operators(args.operators, models_path=args.models_path)
+
+    def server_factory(listen_socket, operators):
+        return OperatorHTTPServer(
+            operators,
+            listen_socket=listen_socket,
+            max_batch_size=args.max_batch_size,
+            max_wait_ms=args.max_wait_ms,
+            max_concurrent_batches=args.max_concurrent_batches,
+            verbose=args.verbose,
+            metrics=metrics,
+        )
+
+    print(f"Serving {', '.join(args.operators)} on http://{args.host}:{args.port}")
+    if args.workers > 0:
+        for _ in serve_prefork(operators, args.host, args.port, args.workers, server_factory=server_factory):
+            os.wait()
+    else:
+        OperatorHTTPServer(
+            operators,
+            address=(args.host, args.port),
+            max_batch_size=args.max_batch_size,
+            max_wait_ms=args.max_wait_ms,
+            max_concurrent_batches=args.max_concurrent_batches,
+            verbose=args.verbose,
+            metrics=metrics,
+        ).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,55 +1,224 @@
 import os
-import pandas as pd
+import hashlib
+import threading
 
-from lamini import LaminiClassifier
+from fast_router import FastRouter
+from model_backend import get_default_backend
+from training_data import TrainingDataReader
+from tracing import logger
+from router_artifact import ARTIFACT_EXTENSION, MappedClassifier, read_artifact, export_router
 
 
 class LLMRoutingAgent:
-    def __init__(self, model_load_path):
+    def __init__(self, model_load_path, fast_router_threshold: float = 0.5, backend=None):
         self.model_load_path = model_load_path
-        if not os.path.exists(self.model_load_path):
-            self.classifier = LaminiClassifier()
+        self.backend = backend or get_default_backend()
+        self.class_names = None
+        self.fast_router_threshold = fast_router_threshold
+        self.fast_router = None
+        self.stage_counts = {"fast_router": 0, "classifier": 0}
+        self.stage_counts_lock = threading.Lock()
+
+        if self.model_load_path.endswith(ARTIFACT_EXTENSION):
+            self.__load_artifact(self.model_load_path)
+            return
+
+        # A router trained by RouterTrainer is a link to a stored router. Resolve it once, so the classifier and the
+        # fast-path router are read from the same stored router even if a new one is swapped in meanwhile.
+        path = os.path.realpath(self.model_load_path)
+        if not os.path.exists(path):
+            self.classifier = self.backend.create_classifier()
         else:
-            self.classifier = LaminiClassifier.load(self.model_load_path)
+            self.classifier = self.backend.load_classifier(path)
+        self.fingerprint = self.__compute_fingerprint(path)
+
+        fast_router_path = self.get_fast_router_path(path)
+        if os.path.exists(fast_router_path):
+            self.fast_router = FastRouter.load(fast_router_path, threshold=self.fast_router_threshold)
+
+    def __load_artifact(self, path):
+        '''
+        Load a router artifact (see router_artifact). Its arrays are memory-mapped, not copied, and nothing is unpickled.
+        A router loaded this way can predict, but not be trained.
+        '''
+        header, arrays = read_artifact(path)
+        self.classifier = MappedClassifier(header, arrays)
+        self.fingerprint = header["fingerprint"]
+        if "fast_router_centroids" in arrays:
+            self.fast_router = FastRouter.from_arrays(
+                header["fast_router_class_names"],
+                arrays["fast_router_idf"],
+                arrays["fast_router_centroids"],
+                threshold=self.fast_router_threshold,
+            )
 
-    def __add_data(self, classes, training_data_path):
+    def export(self, artifact_path):
+        '''
+        Save the trained router as a memory-mappable router artifact.
+        '''
+        logger.info("Exporting router to: %s", artifact_path)
+        export_router(self, artifact_path)
+
+    @staticmethod
+    def get_fast_router_path(model_path):
+        '''
+        The local fast-path router is saved next to the classifier, e.g. fast_router.npz for router.pkl.
         '''
-        Gets names and prompts of classes for routing.
+        directory, filename = os.path.split(model_path)
+        return os.path.join(directory, "fast_" + os.path.splitext(filename)[0] + ".npz")
 
-        classes: list of class names for classification by router
-        training_data_path: json file containing the name and prompt of each class
+    def __compute_fingerprint(self, path):
         '''
-        df = pd.read_csv(training_data_path, quotechar='"', )
-        for cl in classes:
-            d = df.loc[df['class_name'] == cl]['data'].to_list()
-            self.classifier.add_data_to_class(cl, d)
+        Content hash identifying the trained router. None if the router is not saved yet.
+        '''
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
 
     def fit(self, classes_dict, training_data_path = None):
         '''
-        to train/prompt-train the routing classifier.
+        to train/prompt-train the routing classifier, and the local fast-path router in front of it.
+        Training data is streamed: its examples are fed to the classifier chunk by chunk, as they are read.
 
         classes_dict: dict containing name of class and prompt for the class
-        training_data_path: optional string path of training data csv.
+        training_data_path: optional string path of training data csv or jsonl.
         '''
         if training_data_path:
-            self.__add_data(classes_dict, training_data_path)
-            self.classifier.train()
-        else:
-            self.classifier.prompt_train(classes_dict)
+            self.fit_batches(classes_dict, lambda: TrainingDataReader(classes_dict).iter_batches(training_data_path))
+            return
+        self.classifier.prompt_train(classes_dict)
+        self.class_names = None
+        self.fit_fast_router(classes_dict)
+
+    def fit_batches(self, classes_dict, iter_batches):
+        '''
+        Train the routing classifier, and the local fast-path router in front of it, on examples streamed in batches.
+        Examples are fed to the classifier batch by batch, as they are read, see RouterTrainer.
+
+        classes_dict: dict containing name of class and prompt for the class
+        iter_batches: callable returning an iterator of dicts of class name to examples, e.g. chunks of a training file.
+        '''
+        for batch in iter_batches():
+            for cl, examples in batch.items():
+                self.classifier.add_data_to_class(cl, examples)
+        self.classifier.train()
+        self.class_names = None
+        self.fit_fast_router(classes_dict, iter_batches)
+
+    def fit_embeddings(self, classes_dict, class_embeddings, iter_batches):
+        '''
+        Train the routing classifier on embedded examples (dict of class name to array of embeddings, see
+        ModelBackend.embed_examples) without embedding them again, and the local fast-path router on the examples of
+        iter_batches, see fit_batches.
+        '''
+        self.backend.train_on_embeddings(self.classifier, class_embeddings)
+        self.class_names = None
+        self.fit_fast_router(classes_dict, iter_batches)
+
+    def fit_fast_router(self, classes_dict, iter_batches=None):
+        '''
+        Train the local fast-path router on the class descriptions and the examples of iter_batches, see fit_batches.
+        This is local and cheap, so it can also be added to an already trained router.
+        '''
+        def iter_fast_router_batches():
+            yield {cl: [description] for cl, description in classes_dict.items()}
+            for batch in iter_batches() if iter_batches is not None else []:
+                yield {
+                    cl: [example for example in examples if example != classes_dict[cl]]
+                    for cl, examples in batch.items() if cl in classes_dict
+                }
+
+        self.fast_router = FastRouter(threshold=self.fast_router_threshold).fit_batches(classes_dict, iter_fast_router_batches)
 
     def save(self, model_save_path):
-        print("Saving router to:", model_save_path)
+        logger.info("Saving router to: %s", model_save_path)
         self.classifier.save(model_save_path)
+        self.fingerprint = self.__compute_fingerprint(model_save_path)
+        self.save_fast_router(model_save_path)
+
+    def save_fast_router(self, model_save_path):
+        if self.fast_router is not None:
+            self.fast_router.save(self.get_fast_router_path(model_save_path))
 
-    def predict(self, data):
+    def get_class_names(self):
         '''
-        Predict label and probabilities
+        Class names in the column order of the classifier's probability output.
+        '''
+        if self.class_names is None:
+            metadata = self.classifier.class_ids_to_metadata
+            self.class_names = [metadata[class_id]["class_name"] for class_id in sorted(metadata)]
+        return self.class_names
+
+    def predict(self, data, candidates=None):
+        '''
+        Predict label and probabilities.
+        Queries the local fast-path router is confident about are answered in-process. The rest go to the classifier
+        in a single pass, and their label is the argmax of the probability distribution.
 
         data: list of strings to predict
+        candidates: optional list, for every query, of the labels it may be predicted as, e.g. a shortlist of relevant
+        operations (None for all labels). Probabilities are renormalized over the candidates, unless a query has fewer
+        than two of them.
         Output format: tuple of 2 lists.
         List 1 of len(data): predicted label of every query string.
-        List 2 of len(data): probability distribution of each label for every query string.
+        List 2 of len(data): probability distribution of each label for every query string, as a dict of label to probability.
+        '''
+        distributions = [None] * len(data)
+        remaining = list(range(len(data)))
+        if self.fast_router is not None and len(data) > 0:
+            probabilities, confident = self.fast_router.predict_proba(data, candidates)
+            remaining = []
+            for i, prob in enumerate(probabilities):
+                if confident[i]:
+                    distributions[i] = {name: float(p) for name, p in zip(self.fast_router.class_names, prob)}
+                else:
+                    remaining.append(i)
+            with self.stage_counts_lock:
+                self.stage_counts["fast_router"] += len(data) - len(remaining)
+
+        if remaining:
+            probabilities = self.backend.classify_proba(self.classifier, [data[i] for i in remaining])
+            class_names = self.get_class_names()
+            for i, prob in zip(remaining, probabilities):
+                distributions[i] = {name: float(p) for name, p in zip(class_names, prob)}
+                if candidates is not None and candidates[i]:
+                    distributions[i] = self.__restrict(distributions[i], candidates[i])
+            with self.stage_counts_lock:
+                self.stage_counts["classifier"] += len(remaining)
+
+        prediction = [max(distribution, key=distribution.get) for distribution in distributions]
+        return prediction, distributions
+
+    @staticmethod
+    def __restrict(distribution, candidates):
+        '''
+        The distribution renormalized over the candidate labels. Unchanged with fewer than two candidate labels, like
+        in the fast-path router, or if no candidate has any probability.
+        '''
+        total = sum(p for name, p in distribution.items() if name in candidates)
+        if sum(name in candidates for name in distribution) < 2 or total <= 0:
+            return distribution
+        return {name: (p / total if name in candidates else 0.0) for name, p in distribution.items()}
+
+    def get_prior(self, query):
+        '''
+        Cheap local estimate of the class probabilities of a query, from the fast-path router, without any model call.
+        Returns a dict of label to probability and whether the fast-path router is confident, or None without a fast-path router.
+        '''
+        if self.fast_router is None:
+            return None
+        probabilities, confident = self.fast_router.predict_proba([query])
+        return {name: float(p) for name, p in zip(self.fast_router.class_names, probabilities[0])}, bool(confident[0])
+
+    def get_stage_report(self):
+        '''
+        Number and fraction of queries answered by each routing stage.
         '''
-        prediction = self.classifier.predict(data)
-        probabilities = self.classifier.predict_proba(data)
-        return prediction, probabilities
+        with self.stage_counts_lock:
+            stage_counts = dict(self.stage_counts)
+        total = sum(stage_counts.values())
+        return {
+            stage: {"count": count, "fraction": count / total if total else 0.0}
+            for stage, count in stage_counts.items()
+        }
@@ -0,0 +1,137 @@
+import sys
+import csv
+import json
+import time
+import argparse
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmark import summarize
+from prefork_server import OPERATORS
+
+
+def load_queries(name, count):
+    '''
+    count queries for the operator, cycling through the data column of its training data.
+    '''
+    examples = []
+    for data_path in OPERATORS[name][2]:
+        with open(data_path, newline="") as f:
+            examples += [row["data"] for row in csv.DictReader(f, skipinitialspace=True)]
+    if not examples:
+        raise Exception(f"No queries found for {name}.")
+    return [examples[i % len(examples)] for i in range(count)]
+
+
+def send_request(url, query, timeout):
+    '''
+    POST a query to the HTTP server. Returns the seconds until the response, and the response body (or None on error).
+    '''
+    request = urllib.request.Request(
+        url, data=json.dumps({"query": query}).encode(), headers={"Content-Type": "application/json"}
+    )
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            body = json.loads(response.read())
+    except (urllib.error.URLError, OSError, ValueError):
+        body = None
+    return time.perf_counter() - start, body
+
+
+def run_load_test(url, queries, concurrency, timeout=60.0):
+    '''
+    Send the queries to url from concurrency client threads, and report latencies, throughput, errors and batch sizes.
+    '''
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda query: send_request(url, query, timeout), queries))
+    wall_time = time.perf_counter() - start
+
+    responses = [body for _, body in results if body is not None]
+    server_timings = {}
+    for body in responses:
+        for stage, ms in body.get("timings_ms", {}).items():
+            server_timings.setdefault(stage, []).append(ms / 1000)
+    return {
+        "requests": len(queries),
+        "concurrency": concurrency,
+        "errors": sum(body is None or "error" in body for _, body in results),
+        "wall_time_s": wall_time,
+        "throughput_qps": len(queries) / wall_time if wall_time else 0.0,
+        "latency_ms": summarize([seconds for seconds, _ in results]),
+        "server_timings_ms": {stage: summarize(samples) for stage, samples in server_timings.items()},
+        "mean_batch_size": sum(body.get("batch_size", 1) for body in responses) / len(responses) if responses else 0.0,
+    }
+
+
+def main():
+    '''
+    Load test a running HTTP server (see http_server.py) with the training queries of an operator.
+    '''
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--url",
+        type=str,
+        help="Address of the HTTP server.",
+        default="http://localhost:8000",
+    )
+
+    parser.add_argument(
+        "--operator",
+        type=str,
+        choices=list(OPERATORS),
+        help="Operator to send the queries to.",
+        default="food_delivery",
+    )
+
+    parser.add_argument(
+        "--requests",
+        type=int,
+        help="Number of requests to send.",
+        default=200,
+    )
+
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        help="Number of requests in flight.",
+        default=10,
+    )
+
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        help="Seconds to wait for each response.",
+        default=60.0,
+    )
+
+    parser.add_argument(
+        "--output",
+        type=str,
+        help="Path to write the JSON report to. Defaults to stdout.",
+        default=None,
+    )
+
+    parser.add_argument(
+        "-l", action="store_true", help="this flag is a no-op to silence errors"
+    )
+
+    args = parser.parse_args()
+
+    queries = load_queries(args.operator, args.requests)
+    report = run_load_test(f"{args.url.rstrip('/')}/operators/{args.operator}", queries, args.concurrency, args.timeout)
+    print(f"{args.operator}: {report['requests']} requests, p95 {report['latency_ms']['p95']:.1f}ms", file=sys.stderr)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
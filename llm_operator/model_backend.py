@@ -0,0 +1,408 @@
+import os
+import re
+import math
+import time
+import zlib
+import pickle
+import random
+import hashlib
+import threading
+import numpy as np
+
+from fast_router import FastRouter
+from tracing import tracer
+
+
+EXAMPLES_SYSTEM_PROMPT = "You write example messages that users send to an app, to train a classifier. Write one message per line, without numbering or explanations."
+
+
+class BackendError(Exception):
+    '''
+    A model call failed, e.g. an error injected by the StubBackend.
+    '''
+
+
+class ModelBackend:
+    '''
+    Every model call of the operators goes through a backend:
+    classify / classify_proba: routing classifier predictions.
+    generate: structured generation, a dict of typed values per input, e.g. argument extraction.
+    generate_text / stream: free-text generation, e.g. chat replies and plans.
+    embed: embeddings of routing examples, for backends whose classifiers train on cached embeddings (see
+    trains_on_embeddings).
+
+    Backends count their calls by kind in call_counts.
+    '''
+    def __init__(self):
+        self.call_counts = {"classify": 0, "generate": 0, "generate_text": 0, "stream": 0, "embed": 0}
+        self.call_counts_lock = threading.Lock()
+
+    def count_call(self, kind):
+        with self.call_counts_lock:
+            self.call_counts[kind] += 1
+        tracer.record_model_call()
+
+    def reset_call_counts(self):
+        with self.call_counts_lock:
+            for kind in self.call_counts:
+                self.call_counts[kind] = 0
+
+    # Whether the routing classifiers of this backend can be trained on precomputed example embeddings, see embed_examples.
+    trains_on_embeddings = False
+
+    def create_classifier(self):
+        '''
+        A new, untrained routing classifier.
+        '''
+        raise NotImplementedError
+
+    def load_classifier(self, path):
+        raise NotImplementedError
+
+    def classify_proba(self, classifier, data):
+        '''
+        data: list of strings.
+        Returns a (len(data), number of classes) array of probabilities, in the column order of the classifier classes.
+        '''
+        raise NotImplementedError
+
+    def embed_examples(self, classifier, examples):
+        '''
+        Embeddings of routing examples with the embedding model of the classifier, as a (len(examples), dimensions)
+        array. They can be cached, to train the classifier again with train_on_embeddings without embedding every
+        example again.
+        '''
+        raise NotImplementedError
+
+    def train_on_embeddings(self, classifier, class_embeddings):
+        '''
+        Train the classifier on embedded examples: a dict of class name to a (number of examples, dimensions) array.
+        '''
+        raise NotImplementedError
+
+    def classify(self, classifier, data):
+        '''
+        Returns the most likely class name of every string of data.
+        '''
+        metadata = classifier.class_ids_to_metadata
+        class_names = [metadata[class_id]["class_name"] for class_id in sorted(metadata)]
+        return [class_names[i] for i in np.argmax(self.classify_proba(classifier, data), axis=1)]
+
+    def generate(self, inputs, output_type, model_name, prompt_template):
+        '''
+        inputs: dict of prompt inputs, or a list of them for a batched call.
+        output_type: dict of output field name to type name ("str", "int" or "float").
+        Returns a dict of output values, or a list of them for a list of inputs.
+        '''
+        raise NotImplementedError
+
+    def complete_text(self, prompt, model_name=None, system_prompt=None):
+        '''
+        The free-text completion of generate_text and stream, without counting the call.
+        With a system prompt, the prompt is a user message wrapped in the chat template of the model.
+        Without, the prompt is sent as is.
+        '''
+        raise NotImplementedError
+
+    def generate_text(self, prompt, model_name=None, system_prompt=None):
+        self.count_call("generate_text")
+        return self.complete_text(prompt, model_name=model_name, system_prompt=system_prompt)
+
+    def stream(self, prompt, model_name=None, system_prompt=None):
+        '''
+        Like generate_text, as an iterator of text chunks. Backends that cannot stream yield the whole completion at
+        once. Counted as a single stream call.
+        '''
+        self.count_call("stream")
+        yield self.complete_text(prompt, model_name=model_name, system_prompt=system_prompt)
+
+    def generate_examples(self, class_name, description, count=10):
+        '''
+        Example queries for a routing class that has no training data, generated from its description.
+        The description itself is the first example.
+        '''
+        text = self.generate_text(
+            f"Write {count} different messages a user could send for this: {description}",
+            system_prompt=EXAMPLES_SYSTEM_PROMPT,
+        )
+        examples = [re.sub(r"^\s*(?:\d+[.)]|[-*])\s*", "", line).strip() for line in text.splitlines()]
+        return [description] + [example for example in examples if example][:count]
+
+
+class LaminiBackend(ModelBackend):
+    '''
+    Hosted Lamini models. lamini and llama are only imported on first use, so other backends work without them.
+    Clients are shared process-wide through the operator registry.
+    '''
+    def create_classifier(self):
+        from lamini import LaminiClassifier
+
+        return LaminiClassifier()
+
+    def load_classifier(self, path):
+        from lamini import LaminiClassifier
+
+        return LaminiClassifier.load(path)
+
+    def classify_proba(self, classifier, data):
+        self.count_call("classify")
+        return classifier.predict_proba(data)
+
+    trains_on_embeddings = True
+
+    def embed_examples(self, classifier, examples):
+        self.count_call("embed")
+        return np.array(classifier.get_embeddings(list(examples)), dtype=np.float32)
+
+    def train_on_embeddings(self, classifier, class_embeddings):
+        '''
+        The second half of LaminiClassifier.train, after it embedded the examples: fit its logistic regression.
+        '''
+        from sklearn.linear_model import LogisticRegression
+
+        labels = []
+        for class_name, embeddings in class_embeddings.items():
+            classifier.add_class(class_name)
+            labels += [classifier.class_names_to_ids[class_name]] * len(embeddings)
+        features = np.concatenate([np.asarray(embeddings) for embeddings in class_embeddings.values()])
+        classifier.logistic_regression = LogisticRegression(random_state=0).fit(features, labels)
+
+    def __get_client(self, key, factory):
+        from operator_registry import registry
+
+        return registry.get_client(key, factory)
+
+    def generate(self, inputs, output_type, model_name, prompt_template):
+        from llama import Lamini
+
+        self.count_call("generate")
+        model = self.__get_client(("operator", model_name, prompt_template), lambda: Lamini("operator", model_name, prompt_template))
+        return model(inputs, output_type)
+
+    def complete_text(self, prompt, model_name=None, system_prompt=None):
+        from llama import LlamaV2Runner, BasicModelRunner
+
+        kwargs = {"model_name": model_name} if model_name else {}
+        if system_prompt is not None:
+            model = self.__get_client(("chat", model_name), lambda: LlamaV2Runner(**kwargs))
+            return model(prompt, system_prompt=system_prompt)
+        model = self.__get_client(("completion", model_name), lambda: BasicModelRunner(**kwargs))
+        return model(prompt)
+
+
+class StubClassifier:
+    '''
+    Local routing classifier of the StubBackend, trained on the class descriptions and examples with a FastRouter,
+    or on their embeddings (hashed bags of words) with the nearest class centroid.
+    Saved with pickle, like LaminiClassifier.
+    '''
+    dimensions = 512
+    centroids = None
+
+    def __init__(self):
+        self.class_examples = {}
+        self.class_ids_to_metadata = {}
+        self.router = None
+
+    def add_data_to_class(self, class_name, examples):
+        self.class_examples.setdefault(class_name, []).extend(str(example) for example in examples)
+
+    def prompt_train(self, classes_dict):
+        for class_name, description in classes_dict.items():
+            self.add_data_to_class(class_name, [description])
+        self.train()
+
+    def train(self):
+        self.router = FastRouter(threshold=0.0).fit(self.class_examples)
+        self.class_ids_to_metadata = {i: {"class_name": name} for i, name in enumerate(self.router.class_names)}
+
+    @classmethod
+    def embed(cls, data):
+        '''
+        L2-normalized hashed bags of words, stable across processes so they can be cached.
+        '''
+        embeddings = np.zeros((len(data), cls.dimensions), dtype=np.float32)
+        for i, text in enumerate(data):
+            for word in re.findall(r"\w+", str(text).lower()):
+                embeddings[i, zlib.crc32(word.encode()) % cls.dimensions] += 1.0
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / np.where(norms > 0, norms, 1.0)
+
+    def train_on_embeddings(self, class_embeddings):
+        centroids = np.stack([np.asarray(embeddings).mean(axis=0) for embeddings in class_embeddings.values()])
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        self.centroids = centroids / np.where(norms > 0, norms, 1.0)
+        self.router = None
+        self.class_ids_to_metadata = {i: {"class_name": name} for i, name in enumerate(class_embeddings)}
+
+    def predict_proba(self, data):
+        if self.centroids is not None:
+            logits = 10.0 * self.embed(data) @ self.centroids.T
+            probabilities = np.exp(logits - logits.max(axis=1, keepdims=True))
+            return probabilities / probabilities.sum(axis=1, keepdims=True)
+        probabilities, _ = self.router.predict_proba(data)
+        return probabilities
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            pickle.dump(self, f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+
+class StubBackend(ModelBackend):
+    '''
+    In-process backend with deterministic outputs, simulated latency and injected errors, for benchmarks and load
+    tests without network access.
+
+    latency: dict of call kind ("classify", "generate", "generate_text", "stream_chunk", "embed") to a distribution
+    in milliseconds: ("constant", ms), ("uniform", low, high), ("normal", mean, stddev), ("lognormal", median, sigma)
+    or ("exponential", mean). Batched calls take the latency of a single call.
+    error_rate: dict of call kind ("classify", "generate", "generate_text", "stream", "embed") to the probability that
+    a call raises BackendError.
+    seed: seed of the latency and error draws.
+    '''
+    def __init__(self, latency=None, error_rate=None, seed=0):
+        super().__init__()
+        self.latency = latency or {}
+        self.error_rate = error_rate or {}
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+
+    def __draw_latency(self, kind):
+        distribution = self.latency.get(kind)
+        if distribution is None:
+            return 0.0
+        name, *params = distribution
+        with self.random_lock:
+            if name == "constant":
+                ms = params[0]
+            elif name == "uniform":
+                ms = self.random.uniform(*params)
+            elif name == "normal":
+                ms = self.random.gauss(*params)
+            elif name == "lognormal":
+                ms = self.random.lognormvariate(math.log(params[0]), params[1]) if params[0] > 0 else 0.0
+            elif name == "exponential":
+                ms = self.random.expovariate(1.0 / params[0])
+            else:
+                raise Exception(f"Unknown latency distribution {name}.")
+        return max(ms, 0.0) / 1000
+
+    def __simulate(self, kind, latency_kind=None):
+        self.count_call(kind)
+        time.sleep(self.__draw_latency(latency_kind or kind))
+        with self.random_lock:
+            failed = self.random.random() < self.error_rate.get(kind, 0.0)
+        if failed:
+            raise BackendError(f"Injected {kind} error.")
+
+    def create_classifier(self):
+        return StubClassifier()
+
+    def load_classifier(self, path):
+        return StubClassifier.load(path)
+
+    def classify_proba(self, classifier, data):
+        self.__simulate("classify")
+        return classifier.predict_proba(data)
+
+    trains_on_embeddings = True
+
+    def embed_examples(self, classifier, examples):
+        self.__simulate("embed")
+        return classifier.embed(list(examples))
+
+    def train_on_embeddings(self, classifier, class_embeddings):
+        classifier.train_on_embeddings(class_embeddings)
+
+    @staticmethod
+    def get_value(text, type):
+        '''
+        Deterministic value of the given type for a message: its first number for int and float, the message for str.
+        '''
+        if type in ("int", "float"):
+            numbers = re.findall(r"-?\d+(?:\.\d+)?", text)
+            value = float(numbers[0]) if numbers else 0.0
+            return int(value) if type == "int" else value
+        return text
+
+    def generate(self, inputs, output_type, model_name, prompt_template):
+        self.__simulate("generate")
+        batch = inputs if isinstance(inputs, list) else [inputs]
+        outputs = [
+            {name: self.get_value(str(item.get("query", "")), type) for name, type in output_type.items()}
+            for item in batch
+        ]
+        return outputs if isinstance(inputs, list) else outputs[0]
+
+    def get_completion(self, prompt):
+        '''
+        Deterministic completion of a prompt. Planning prompts, which list the tools available as "- name: description"
+        lines, get an enumerated plan using those tools.
+        '''
+        tools = re.findall(r"^- (\w+):", prompt, re.MULTILINE)
+        if tools:
+            steps = [f"Use {tool} for the user request." for tool in tools[:3]]
+            # Alternate independent steps and steps using the result of the previous one, so plans exercise both.
+            steps = [
+                step if i == 0 else step[:-1] + (" (independent)." if i % 2 else f" (after step {i}).")
+                for i, step in enumerate(steps)
+            ]
+            # The planning prompt ends with the " 1." cue, so the completion starts with the first step.
+            return " " + "\n".join(f"{i + 1}. {step}" if i else step for i, step in enumerate(steps)) + "\n\n"
+        digest = hashlib.sha256(prompt.encode()).hexdigest()[:8]
+        return f"Stub response {digest}."
+
+    def generate_text(self, prompt, model_name=None, system_prompt=None):
+        self.__simulate("generate_text")
+        return self.get_completion(prompt)
+
+    def generate_examples(self, class_name, description, count=10):
+        '''
+        The description and its sentences, so routing with stub-trained routers follows the descriptions.
+        '''
+        self.__simulate("generate_text")
+        sentences = [sentence.strip() for sentence in re.split(r"(?<=[.!?])\s+", description) if sentence.strip()]
+        return [description] + sentences[:count]
+
+    def stream(self, prompt, model_name=None, system_prompt=None):
+        self.__simulate("stream")
+        for chunk in re.findall(r"\S*\s*", self.get_completion(prompt)):
+            if chunk:
+                time.sleep(self.__draw_latency("stream_chunk"))
+                yield chunk
+
+
+BACKENDS = {
+    "lamini": LaminiBackend,
+    "stub": StubBackend,
+}
+
+default_backend = None
+default_backend_lock = threading.Lock()
+
+
+def get_default_backend():
+    '''
+    The backend used by operators and routers that are not given one. Chosen by the LLM_OPERATOR_BACKEND environment
+    variable ("lamini" or "stub"), Lamini by default.
+    '''
+    global default_backend
+    if default_backend is None:
+        with default_backend_lock:
+            if default_backend is None:
+                name = os.environ.get("LLM_OPERATOR_BACKEND", "lamini")
+                if name not in BACKENDS:
+                    raise Exception(f"Unknown backend {name}, expected one of {', '.join(BACKENDS)}.")
+                default_backend = BACKENDS[name]()
+    return default_backend
+
+
+def set_default_backend(backend):
+    global default_backend
+    with default_backend_lock:
+        default_backend = backend
@@ -2,6 +2,7 @@ import os
 import argparse
 
 from base_operator import Operator
+from tracing import logger, configure_logging
 
 os.environ["LLAMA_ENVIRONMENT"] = "PRODUCTION"
 
@@ -22,7 +23,7 @@ class MotivationOperator(Operator):
         workout_name: name of the workout. if no name given, keep it static at 'no-name'
         workout_time: date and time to schedule the workout.
         """
-        print("It is indicated to be a reminder message.")
+        logger.info("It is indicated to be a reminder message.")
         return f"Reminder has been set. Workout: {workout_name}, Time: {workout_time}"
 
     def sendCongratsMessage(self, message: str):
@@ -32,7 +33,7 @@ class MotivationOperator(Operator):
         Parameters:
         message: the congratulatory message.
         """
-        print("It is indicated to be a congratulatory message.")
+        logger.info("It is indicated to be a congratulatory message.")
         return "Sending user message=" + message
 
     def sendFollowupMessage(self, message: str):
@@ -42,7 +43,7 @@ class MotivationOperator(Operator):
         Parameters:
         message: a message meant to follow up with the user on missing a workout
         """
-        print("It is indicated to be a follow up message.")
+        logger.info("It is indicated to be a follow up message.")
         return "Sending user message=" + message
 
 
@@ -54,10 +55,10 @@ def train(operator_save_path, training_data=None):
 
 def inference(queries, operator_save_path):
     operator = MotivationOperator().load(operator_save_path)
-    
-    for query in queries:
+    responses = operator.run_batch(queries)
+
+    for query, response in zip(queries, responses):
         print(f"\n\nUser message: {query}")
-        response = operator(query)
         print(response)
 
 
@@ -95,6 +96,7 @@ def main():
     )
 
     args = parser.parse_args()
+    configure_logging()
 
     if args.operator_save_path[-1] != "/":
         args.operator_save_path += "/"
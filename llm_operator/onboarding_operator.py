@@ -2,6 +2,8 @@ import os
 import argparse
 
 from base_operator import Operator
+from argument_extractors import argument_extractors, NumberExtractor, UnitExtractor
+from tracing import logger, configure_logging
 
 os.environ["LLAMA_ENVIRONMENT"] = "PRODUCTION"
 
@@ -12,6 +14,7 @@ class OnboardingOperator(Operator):
         self.add_operation(self.setAge)
         self.add_operation(self.setHeight)
 
+    @argument_extractors(age=NumberExtractor(int, minimum=1, maximum=130))
     def setAge(self, age: int):
         """
         set the age of a person
@@ -19,9 +22,18 @@ class OnboardingOperator(Operator):
         Parameters:
         age: age of the person in years.
         """
-        print("It is indicated to be the age of the user.")
+        logger.info("It is indicated to be the age of the user.")
         return f"Age has been set. Age= {age}"
 
+    @argument_extractors(
+        height=NumberExtractor(int, minimum=1, maximum=300),
+        units=UnitExtractor({
+            "feet": ["foot", "ft"],
+            "inches": ["inch"],
+            "cm": ["centimeters", "centimetres"],
+            "meters": ["m", "metres"],
+        }),
+    )
     def setHeight(self, height: int, units: str):
         """
         set the height of a person
@@ -30,7 +42,7 @@ class OnboardingOperator(Operator):
         height: height of the person in numbers.
         units: units of the height like feet, inches, cm, etc.
         """
-        print("It is indicated to be the height of the user.")
+        logger.info("It is indicated to be the height of the user.")
         return f"Height has been set. Height={height}, units={units}"
 
 
@@ -43,10 +55,10 @@ def train(operator_save_path, training_data=None):
 
 def inference(queries, operator_save_path):
     operator = OnboardingOperator().load(operator_save_path)
+    responses = operator.run_batch(queries)
 
-    for query in queries:
+    for query, response in zip(queries, responses):
         print(f"\n\nUser message: {query}")
-        response = operator(query)
         print(response)
 
 
@@ -88,6 +100,7 @@ def main():
     )
 
     args = parser.parse_args()
+    configure_logging()
 
     if args.operator_save_path[-1] != "/":
         args.operator_save_path += "/"
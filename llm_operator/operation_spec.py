@@ -0,0 +1,40 @@
+from dataclasses import dataclass
+from typing import Any, Callable, Optional, Tuple
+
+
+@dataclass(frozen=True, slots=True)
+class ArgumentSpec:
+    '''
+    Name, type and description of one argument of an operation.
+    '''
+    name: str
+    type: str
+    description: Optional[str]
+
+    def to_dict(self):
+        return {"name": self.name, "type": self.type, "description": self.description}
+
+
+@dataclass(frozen=True, slots=True)
+class OperationSpec:
+    '''
+    Everything the operator needs to route to, extract arguments for, and call an operation.
+    Built once when the operation is added.
+
+    name: name of the operation, used as the router class name.
+    action: the callable invoked with the extracted arguments.
+    description: description of the operation, used to prompt-train the router.
+    arguments: typed argument schema of the operation.
+    args_prompt: the argument list pre-rendered for the argument extraction prompt.
+    extractor: prepared argument extraction for the operation, None if it takes no arguments.
+    cacheable: whether routing and argument extraction results for this operation may be served from the response cache.
+    delegate: for an operation that only passes the user message on to another operator, a callable returning that operator.
+    '''
+    name: str
+    action: Callable
+    description: str
+    arguments: Tuple[ArgumentSpec, ...]
+    args_prompt: str
+    extractor: Any = None
+    cacheable: bool = True
+    delegate: Optional[Callable] = None
@@ -4,6 +4,8 @@ import argparse
 from motivation_operator import MotivationOperator
 from onboarding_operator import OnboardingOperator
 from base_operator import Operator
+from operator_registry import registry
+from tracing import logger, configure_logging
 
 os.environ["LLAMA_ENVIRONMENT"] = "PRODUCTION"
 
@@ -12,18 +14,25 @@ class MainApp(Operator):
     def __init__(self):
         super().__init__()
 
+        # Sub-operators are loaded on first dispatch, and shared by all MainApp instances in the process.
+        # Operators registered under these names beforehand are used instead.
         self.onboarding_operator_save_path = "models/OnboardingOperator/"
-        self.onboarding_operator = OnboardingOperator().load(
-            self.onboarding_operator_save_path
-        )
+        registry.register_default("OnboardingOperator", OnboardingOperator, self.onboarding_operator_save_path)
 
         self.motivation_operator_save_path = "models/MotivationOperator/"
-        self.motivation_operator = MotivationOperator().load(
-            self.motivation_operator_save_path
-        )
+        registry.register_default("MotivationOperator", MotivationOperator, self.motivation_operator_save_path)
 
-        self.add_operation(self.call_onboarding_operator)
-        self.add_operation(self.call_motivation_operator)
+        # These operations only pass the message on, so the message is not extracted by the LLM.
+        self.add_operation(self.call_onboarding_operator, delegate=lambda: self.onboarding_operator)
+        self.add_operation(self.call_motivation_operator, delegate=lambda: self.motivation_operator)
+
+    @property
+    def onboarding_operator(self):
+        return registry.get("OnboardingOperator")
+
+    @property
+    def motivation_operator(self):
+        return registry.get("MotivationOperator")
 
     def call_onboarding_operator(self, message: str):
         """
@@ -32,8 +41,8 @@ class MainApp(Operator):
         Parameters:
         message: user input message.
         """
-        print("\nIt is indicated that the user is new and needs to be onboarded.")
-        print("call_onboarding_operator...\n")
+        logger.info("It is indicated that the user is new and needs to be onboarded.")
+        logger.info("call_onboarding_operator...")
         return self.onboarding_operator(message)
 
     def call_motivation_operator(self, message: str):
@@ -43,24 +52,24 @@ class MainApp(Operator):
         Parameters:
         message: user input message.
         """
-        print("\nIt is indicated that this meant to be a motivational message.")
-        print("call_motivation_operator...\n")
+        logger.info("It is indicated that this meant to be a motivational message.")
+        logger.info("call_motivation_operator...")
         return self.motivation_operator(message)
 
 
-def train(operator_save_path, training_data=None):
+def train(operator_save_path, training_data=None, flatten=False):
     """Trains the Operator."""
     operator = MainApp()
-    operator.train(operator_save_path, training_data)
+    operator.train(operator_save_path, training_data, flatten=flatten)
     print("Done training!")
 
 
 def inference(queries, operator_save_path):
     operator = MainApp().load(operator_save_path)
+    responses = operator.run_batch(queries)
 
-    for query in queries:
+    for query, response in zip(queries, responses):
         print(f"\n\nUser message: {query}")
-        response = operator(query)
         print(response)
 
 
@@ -88,6 +97,13 @@ def main():
         default=False,
     )
 
+    parser.add_argument(
+        "--flatten",
+        action="store_true",
+        help="Also train a flattened router over the operations of the sub-operators, to route each message once.",
+        default=False,
+    )
+
     parser.add_argument(
         "--query",
         type=str,
@@ -102,12 +118,13 @@ def main():
     )
 
     args = parser.parse_args()
+    configure_logging()
 
     if args.operator_save_path[-1] != "/":
         args.operator_save_path += "/"
 
     if args.train:
-        train(args.operator_save_path, args.training_data)
+        train(args.operator_save_path, args.training_data, args.flatten)
 
     default_queries = [
         "You missed your workout yesterday. Just wanted to check in!",
@@ -0,0 +1,95 @@
+import os
+import threading
+
+from llm_routing_agent import LLMRoutingAgent
+from model_backend import get_default_backend
+
+
+class OperatorRegistry:
+    '''
+    Process-wide registry of operators, routers and model clients.
+    Operators are built and loaded lazily on first use and memoized, and a router saved at a given path is only
+    loaded once, even when several operators reference it.
+    '''
+    def __init__(self):
+        self.factories = {}
+        self.operators = {}
+        self.routers = {}
+        self.clients = {}
+        self.lock = threading.RLock()
+
+    def register(self, name, factory, save_path):
+        '''
+        Register how to build an operator, without building it.
+
+        name: name to get the operator by.
+        factory: callable returning a new, unloaded operator, e.g. the operator class.
+        save_path: path the operator was trained to, passed to its load().
+        An operator already built for name under a different factory or save_path is dropped, and built again on next use.
+        '''
+        with self.lock:
+            if self.factories.get(name) != (factory, save_path):
+                self.operators.pop(name, None)
+            self.factories[name] = (factory, save_path)
+
+    def register_default(self, name, factory, save_path):
+        '''
+        Register an operator like register, unless name is already registered, so a custom registration is kept.
+        '''
+        with self.lock:
+            if name not in self.factories:
+                self.register(name, factory, save_path)
+
+    def get(self, name):
+        '''
+        Get a loaded operator, building and loading it on first use.
+        '''
+        operator = self.operators.get(name)
+        if operator is not None:
+            return operator
+        with self.lock:
+            if name not in self.operators:
+                if name not in self.factories:
+                    raise Exception(f"Operator {name} is not registered.")
+                factory, save_path = self.factories[name]
+                self.operators[name] = factory().load(save_path)
+            return self.operators[name]
+
+    def is_loaded(self, name):
+        return name in self.operators
+
+    def get_router(self, router_path, fast_router_threshold: float = 0.5, backend=None):
+        '''
+        Get the router saved at router_path, loading it on first use. Routers are shared per backend.
+        '''
+        backend = backend or get_default_backend()
+        key = (os.path.abspath(router_path), fast_router_threshold, backend)
+        router = self.routers.get(key)
+        if router is not None:
+            return router
+        with self.lock:
+            if key not in self.routers:
+                self.routers[key] = LLMRoutingAgent(router_path, fast_router_threshold=fast_router_threshold, backend=backend)
+            return self.routers[key]
+
+    def put_router(self, router_path, router):
+        '''
+        Replace the router for router_path, e.g. after it was retrained.
+        '''
+        with self.lock:
+            self.routers[(os.path.abspath(router_path), router.fast_router_threshold, router.backend)] = router
+
+    def get_client(self, key, factory):
+        '''
+        Get a model client shared by all operators, building it with factory() on first use.
+        '''
+        client = self.clients.get(key)
+        if client is not None:
+            return client
+        with self.lock:
+            if key not in self.clients:
+                self.clients[key] = factory()
+            return self.clients[key]
+
+
+registry = OperatorRegistry()
@@ -2,6 +2,7 @@ import os
 import argparse
 
 from base_planning_operator import PlanningOperator
+from tracing import logger, configure_logging
 
 
 os.environ["LLAMA_ENVIRONMENT"] = "PRODUCTION"
@@ -9,8 +10,8 @@ os.environ["LLAMA_ENVIRONMENT"] = "STAGING"
 
 
 class PlanningMotivationOperator(PlanningOperator):
-    def __init__(self, verbose=False):
-        super().__init__(verbose=verbose)
+    def __init__(self, verbose=False, max_workers=3):
+        super().__init__(verbose=verbose, max_workers=max_workers)
 
         self.add_operation(self.setReminder)
         self.add_operation(self.sendCongratsMessage)
@@ -24,7 +25,7 @@ class PlanningMotivationOperator(PlanningOperator):
         workout_name: name of the workout. if no name given, keep it static at 'no-name'
         workout_time: date and time to schedule the workout.
         """
-        print("It is indicated to be a reminder message.")
+        logger.info("It is indicated to be a reminder message.")
         return f"Reminder has been set. Workout: {workout_name}, Time: {workout_time}"
 
     def sendCongratsMessage(self, message: str):
@@ -34,7 +35,7 @@ class PlanningMotivationOperator(PlanningOperator):
         Parameters:
         message: the congratulatory message.
         """
-        print("It is indicated to be a congratulatory message.")
+        logger.info("It is indicated to be a congratulatory message.")
         return "Sending user message=" + message
 
     def sendFollowupMessage(self, message: str):
@@ -44,7 +45,7 @@ class PlanningMotivationOperator(PlanningOperator):
         Parameters:
         message: a message meant to follow up with the user on missing a workout
         """
-        print("It is indicated to be a follow up message.")
+        logger.info("It is indicated to be a follow up message.")
         return "Sending user message=" + message
 
 
@@ -57,6 +58,7 @@ def main():
         "-l", action="store_true", help="this flag is a no-op to silence errors"
     )
     args = args.parse_args()
+    configure_logging()
 
     operator_save_path = "models/MotivationOperator/"
     operator = PlanningMotivationOperator(verbose=args.verbose).load(operator_save_path)
@@ -0,0 +1,254 @@
+import os
+import gc
+import csv
+import sys
+import json
+import time
+import signal
+import socket
+import argparse
+import socketserver
+
+from operator_registry import registry
+from food_delivery_operator import FoodDeliveryOperator
+from customer_support_operator import CustomerSupportOperator
+from onboarding_operator import OnboardingOperator
+from motivation_operator import MotivationOperator
+from operator_of_operators import MainApp
+from tracing import logger, configure_logging
+
+
+# Operators that can be served: operator class, save path under the models path, and the training data used to
+# warm it up (and to train it, for operators with a single training file).
+OPERATORS = {
+    "food_delivery": (FoodDeliveryOperator, "FoodDeliveryOperator/", ["data/food_delivery.csv"]),
+    "customer_support": (CustomerSupportOperator, "CustomerSupportOperator/", ["data/customer_support.csv"]),
+    "onboarding": (OnboardingOperator, "OnboardingOperator/", ["data/onboarding.csv"]),
+    "motivation": (MotivationOperator, "MotivationOperator/", ["data/motivation.csv"]),
+    "operator_of_operators": (MainApp, "MainApp/", ["data/onboarding.csv", "data/motivation.csv"]),
+}
+
+# Operators delegated to by a served operator: registry name of each sub-operator, and the served operator it is.
+SUB_OPERATORS = {
+    "operator_of_operators": {"OnboardingOperator": "onboarding", "MotivationOperator": "motivation"},
+}
+
+
+def get_memory_usage():
+    '''
+    Resident (RSS), proportional (PSS) and shared memory of this process in kB, from /proc.
+    PSS splits pages shared with other processes between them, so it shows what copy-on-write sharing saves.
+    '''
+    usage = {}
+    for path, fields in [("/proc/self/status", {"VmRSS": "rss_kb"}), ("/proc/self/smaps_rollup", {"Pss": "pss_kb", "Shared_Clean": "shared_clean_kb", "Shared_Dirty": "shared_dirty_kb"})]:
+        try:
+            with open(path) as f:
+                for line in f:
+                    key, _, value = line.partition(":")
+                    if key in fields:
+                        usage[fields[key]] = int(value.split()[0])
+        except OSError:
+            pass
+    if "rss_kb" not in usage:
+        import resource
+        usage["rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage
+
+
+def load_warmup_queries(data_paths, count):
+    '''
+    Up to count example queries from the training data, taken round-robin across classes.
+    '''
+    by_class = {}
+    for data_path in data_paths:
+        if not os.path.exists(data_path):
+            continue
+        with open(data_path, newline="") as f:
+            for row in csv.DictReader(f, skipinitialspace=True):
+                by_class.setdefault(row["class_name"], []).append(row["data"])
+    queries = []
+    while len(queries) < count and any(by_class.values()):
+        for examples in by_class.values():
+            if examples and len(queries) < count:
+                queries.append(examples.pop(0))
+    return queries
+
+
+def train_operators(names, models_path="models/"):
+    '''
+    Train the operators, and the operators they delegate to, under models_path with the current default backend.
+    Training is incremental, so operators already trained there with the same data are loaded as is.
+    '''
+    for name in names:
+        for sub_name in SUB_OPERATORS.get(name, {}).values():
+            train_operators([sub_name], models_path)
+        operator_class, save_path, data_paths = OPERATORS[name]
+        training_file = data_paths[0] if len(data_paths) == 1 else None
+        operator_class().train(os.path.join(models_path, save_path), training_file)
+
+
+def load_operators(names, warmup_count=8, models_path="models/"):
+    '''
+    Load the operators saved under models_path, their routers and compiled operation specs, and warm them up by
+    routing a few representative queries. Sub-operators of an operator of operators are loaded too, from models_path.
+    '''
+    operators = {}
+    for name in names:
+        for registry_name, sub_name in SUB_OPERATORS.get(name, {}).items():
+            sub_class, sub_path, _ = OPERATORS[sub_name]
+            registry.register(registry_name, sub_class, os.path.join(models_path, sub_path))
+        operator_class, save_path, data_paths = OPERATORS[name]
+        registry.register(name, operator_class, os.path.join(models_path, save_path))
+        operator = registry.get(name)
+        for spec in operator.operations.values():
+            if spec.delegate is not None:
+                spec.delegate()
+        queries = load_warmup_queries(data_paths, warmup_count)
+        if queries:
+            operator.select_operations_batch(queries)
+        operators[name] = operator
+        logger.info("Loaded and warmed up %s with %d queries.", name, len(queries))
+    return operators
+
+
+class JSONLinesHandler(socketserver.StreamRequestHandler):
+    '''
+    One JSON request per line: {"operator": name, "query": message}. One JSON response per line: {"output": ...} or {"error": ...}.
+    '''
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                operator = self.server.operators[request["operator"]]
+                response = {"output": str(operator.run(request["query"], request.get("prompt")))}
+            except Exception as e:
+                response = {"error": f"{type(e).__name__}: {e}"}
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+class JSONLinesServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+
+    def __init__(self, listen_socket, operators):
+        super().__init__(listen_socket.getsockname(), JSONLinesHandler, bind_and_activate=False)
+        self.socket = listen_socket
+        self.operators = operators
+
+
+def serve_prefork(operators, host, port, workers, server_factory=JSONLinesServer):
+    '''
+    Fork workers that serve the already loaded operators on a shared listening socket.
+    The loaded state is frozen out of the garbage collector before forking, so workers keep sharing its pages copy-on-write.
+
+    server_factory: callable(listen_socket, operators) returning a socketserver-like object with serve_forever().
+    '''
+    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listen_socket.bind((host, port))
+    listen_socket.listen(128)
+
+    gc.collect()
+    gc.freeze()
+
+    ready_read, ready_write = os.pipe()
+    children = []
+    for worker_id in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_read)
+            server = server_factory(listen_socket, operators)
+            report = dict(worker=worker_id, pid=os.getpid(), **get_memory_usage())
+            os.write(ready_write, (json.dumps(report) + "\n").encode())
+            os.close(ready_write)
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        children.append(pid)
+    os.close(ready_write)
+
+    with os.fdopen(ready_read) as reports:
+        for _ in range(workers):
+            line = reports.readline()
+            if line:
+                logger.info("Worker ready: %s", line.strip())
+
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    return children
+
+
+def main():
+    start = time.perf_counter()
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--operators",
+        type=str,
+        nargs="+",
+        choices=list(OPERATORS),
+        help="Operators to serve.",
+        default=["food_delivery"],
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of worker processes to fork.",
+        default=4,
+    )
+
+    parser.add_argument(
+        "--host",
+        type=str,
+        help="Host to listen on.",
+        default="0.0.0.0",
+    )
+
+    parser.add_argument(
+        "--port",
+        type=int,
+        help="Port to listen on.",
+        default=8000,
+    )
+
+    parser.add_argument(
+        "--models_path",
+        type=str,
+        help="Path the operators were trained to.",
+        default="models/",
+    )
+
+    parser.add_argument(
+        "--warmup_queries",
+        type=int,
+        help="Number of queries from the training data used to warm up each operator.",
+        default=8,
+    )
+
+    parser.add_argument(
+        "-l", action="store_true", help="this flag is a no-op to silence errors"
+    )
+
+    args = parser.parse_args()
+    configure_logging()
+
+    operators = load_operators(args.operators, args.warmup_queries, models_path=args.models_path)
+    print(f"Parent memory after loading: {get_memory_usage()}")
+    children = serve_prefork(operators, args.host, args.port, args.workers)
+    print(f"Time to first request: {time.perf_counter() - start:.2f}s, serving on {args.host}:{args.port} with {args.workers} workers.")
+
+    for _ in children:
+        os.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import re
+import time
+import threading
+from collections import OrderedDict
+
+
+class ResponseCache:
+    '''
+    Memoizes the routing and argument extraction results of an operator, so that near-identical queries skip both model calls.
+    Entries are evicted least recently used first once max_size is reached, and expire ttl seconds after they are stored.
+    Keys include the router fingerprint, so retraining the router invalidates all previous entries.
+    '''
+    def __init__(self, max_size: int = 1024, ttl: float = 3600, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def normalize(text):
+        '''
+        Normalize a query so that trivially different messages share an entry: case, surrounding whitespace and punctuation, repeated spaces.
+        '''
+        text = re.sub(r"\s+", " ", text.lower())
+        return text.strip(" .!?")
+
+    def make_key(self, router_fingerprint, query, prompt):
+        return (router_fingerprint, self.normalize(query), self.normalize(prompt))
+
+    def get(self, key):
+        '''
+        Returns the cached value, or None on a miss.
+        '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > self.clock():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+                self.evictions += 1
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (self.clock() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        '''
+        Hit, miss and eviction counters, the hit rate and the current number of entries.
+        '''
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self.entries),
+            }
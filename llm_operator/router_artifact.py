@@ -0,0 +1,210 @@
+import os
+import sys
+import json
+import mmap
+import struct
+import hashlib
+import argparse
+import numpy as np
+
+
+ARTIFACT_MAGIC = b"LLMROUTR"
+ARTIFACT_VERSION = 1
+ARTIFACT_ALIGNMENT = 64
+ARTIFACT_EXTENSION = ".bin"
+# Credentials are not written to artifacts, the embedding client reads them from the environment at load time.
+SECRET_CONFIG_KEYS = {"key", "api_key", "token"}
+
+
+def align_offset(offset):
+    return (offset + ARTIFACT_ALIGNMENT - 1) // ARTIFACT_ALIGNMENT * ARTIFACT_ALIGNMENT
+
+
+def write_artifact(path, header, arrays):
+    '''
+    Write a router artifact: magic bytes, the length of the JSON header, the JSON header, then every array as a
+    contiguous, aligned blob. The header records the dtype, shape and offset (from the start of the blobs) of each
+    array, and a content hash. The file is written to a temporary path and moved into place, so readers never see a
+    partial artifact.
+
+    header: JSON-serializable dict of metadata, e.g. class names.
+    arrays: dict of array name to numpy array.
+    '''
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    digest = hashlib.sha256(json.dumps(header, sort_keys=True).encode())
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        digest.update(name.encode())
+        digest.update(array.tobytes())
+        layout[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset = align_offset(offset + array.nbytes)
+    header = dict(header, version=ARTIFACT_VERSION, fingerprint=digest.hexdigest(), arrays=layout)
+    header_bytes = json.dumps(header).encode()
+    data_start = align_offset(len(ARTIFACT_MAGIC) + 8 + len(header_bytes))
+
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(ARTIFACT_MAGIC)
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.write(b"\0" * (data_start + layout[name]["offset"] - f.tell()))
+            f.write(array.tobytes())
+    os.replace(tmp_path, path)
+    return header
+
+
+def read_artifact(path):
+    '''
+    Memory-map a router artifact. Returns the header and a dict of read-only arrays backed by the mapped file, so
+    processes loading the same artifact, including forked workers, share its pages.
+    '''
+    with open(path, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if buffer[:len(ARTIFACT_MAGIC)] != ARTIFACT_MAGIC:
+        raise Exception(f"{path} is not a router artifact.")
+    header_length, = struct.unpack_from("<Q", buffer, len(ARTIFACT_MAGIC))
+    header_start = len(ARTIFACT_MAGIC) + 8
+    header = json.loads(buffer[header_start:header_start + header_length])
+    if header["version"] > ARTIFACT_VERSION:
+        raise Exception(f"Router artifact version {header['version']} is not supported, please upgrade.")
+    data_start = align_offset(header_start + header_length)
+
+    arrays = {}
+    for name, layout in header["arrays"].items():
+        dtype = np.dtype(layout["dtype"])
+        count = int(np.prod(layout["shape"]))
+        arrays[name] = np.frombuffer(buffer, dtype=dtype, count=count, offset=data_start + layout["offset"]).reshape(layout["shape"])
+    return header, arrays
+
+
+def get_embedding_config(config):
+    '''
+    The classifier config without its credentials, to embed queries at prediction time the same way as at training time.
+    '''
+    if isinstance(config, dict):
+        return {key: get_embedding_config(value) for key, value in config.items() if key not in SECRET_CONFIG_KEYS}
+    return config
+
+
+class MappedClassifier:
+    '''
+    Routing classifier loaded from a router artifact, a drop-in for a trained LaminiClassifier at prediction time.
+    Queries are embedded with the Lamini embedding endpoint, configured like the classifier the artifact was exported
+    from, and scored with the logistic regression weights of the artifact.
+
+    embed: optional callable returning the embeddings of a list of queries, instead of the Lamini embedding endpoint.
+    '''
+    def __init__(self, header, arrays, embed=None):
+        self.class_ids_to_metadata = {
+            int(class_id): {"class_name": name}
+            for class_id, name in zip(arrays["classes"], header["class_names"])
+        }
+        self.classes = arrays["classes"]
+        self.coef = arrays["coef"]
+        self.intercept = arrays["intercept"]
+        self.embedding_config = header.get("embedding_config") or {}
+        self.embed = embed
+
+    @classmethod
+    def load(cls, path, embed=None):
+        header, arrays = read_artifact(path)
+        return cls(header, arrays, embed=embed)
+
+    def get_embeddings(self, data):
+        if self.embed is not None:
+            return np.asarray(self.embed(data), dtype=np.float32)
+        from lamini.api.embedding import Embedding
+
+        embeddings = Embedding(config=self.embedding_config).generate(data)
+        return np.array([embedding[0] for embedding in embeddings], dtype=np.float32)
+
+    def predict_proba(self, data):
+        logits = self.get_embeddings(data) @ self.coef.T + self.intercept
+        if self.coef.shape[0] == 1:
+            positive = 1.0 / (1.0 + np.exp(-logits))
+            return np.hstack([1.0 - positive, positive])
+        probabilities = np.exp(logits - logits.max(axis=1, keepdims=True))
+        return probabilities / probabilities.sum(axis=1, keepdims=True)
+
+    def predict(self, data):
+        probabilities = self.predict_proba(data)
+        return [self.class_ids_to_metadata[int(self.classes[i])]["class_name"] for i in probabilities.argmax(axis=1)]
+
+
+def export_router(router, path):
+    '''
+    Write the trained classifier (and fast-path router, if any) of an LLMRoutingAgent as a router artifact.
+    Only classifiers scoring embeddings with a trained logistic regression, like LaminiClassifier, can be exported.
+    '''
+    model = getattr(router.classifier, "logistic_regression", None)
+    if model is None or not hasattr(model, "coef_"):
+        raise Exception(
+            f"Cannot export a router with a {type(router.classifier).__name__}: only trained classifiers with a "
+            "logistic regression over embeddings, like LaminiClassifier, can be exported."
+        )
+    classes = np.asarray(model.classes_, dtype=np.int64)
+    metadata = router.classifier.class_ids_to_metadata
+    header = {
+        "kind": "logistic_regression",
+        "class_names": [metadata[int(class_id)]["class_name"] for class_id in classes],
+        "embedding_config": get_embedding_config(getattr(router.classifier, "config", None) or {}),
+    }
+    arrays = {
+        "classes": classes,
+        "coef": np.asarray(model.coef_, dtype=np.float32),
+        "intercept": np.asarray(model.intercept_, dtype=np.float32),
+    }
+    if router.fast_router is not None:
+        header["fast_router_class_names"] = router.fast_router.class_names
+        arrays["fast_router_idf"] = router.fast_router.idf
+        arrays["fast_router_centroids"] = router.fast_router.centroids
+    return write_artifact(path, header, arrays)
+
+
+def check_artifact(router, path, queries, atol=1e-4):
+    '''
+    Check that the artifact at path gives the same probabilities as the router's classifier on the queries.
+    Both score the same embeddings, from the classifier, so any difference comes from the exported weights.
+    '''
+    classifier = router.classifier
+    mapped = MappedClassifier.load(path, embed=classifier.get_embeddings)
+    expected = np.asarray(classifier.predict_proba(queries))
+    actual = mapped.predict_proba(queries)
+    if expected.shape != actual.shape or not np.allclose(expected, actual, atol=atol):
+        raise Exception(f"Router artifact {path} does not match the router it was exported from.")
+
+
+def get_artifact_path(router_path):
+    return os.path.splitext(router_path)[0] + ARTIFACT_EXTENSION
+
+
+def main():
+    '''
+    Convert trained router.pkl files to router artifacts written next to them, e.g. models/*/router.pkl.
+    Every artifact is checked against its router on the class names of the router as queries.
+    '''
+    from llm_routing_agent import LLMRoutingAgent
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "router_paths",
+        type=str,
+        nargs="+",
+        help="Paths of the router.pkl files to convert.",
+    )
+    args = parser.parse_args()
+
+    for router_path in args.router_paths:
+        if not os.path.exists(router_path):
+            print(f"{router_path} does not exist, skipping.", file=sys.stderr)
+            continue
+        artifact_path = get_artifact_path(router_path)
+        router = LLMRoutingAgent(router_path)
+        router.export(artifact_path)
+        check_artifact(router, artifact_path, router.get_class_names())
+
+
+if __name__ == "__main__":
+    main()
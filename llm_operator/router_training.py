@@ -0,0 +1,359 @@
+import os
+import re
+import json
+import glob
+import hashlib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from llm_routing_agent import LLMRoutingAgent
+from model_backend import get_default_backend
+from training_data import TrainingDataReader
+from tracing import logger
+
+
+# Bump when the way examples are built from the class inputs changes, to invalidate the cached examples.
+EXAMPLES_VERSION = 3
+
+
+def get_writer_pid(name):
+    '''
+    The id of the process writing a temporary file (name.tmp.<pid>, or <hash>.<ext>.<pid>.partial and its fast-path
+    router), None for other files.
+    '''
+    match = re.search(r"\.tmp\.(\d+)$|\.(\d+)\.(?:partial|npz)$", name)
+    if match is None:
+        return None
+    return int(match.group(1) or match.group(2))
+
+
+def is_running(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class RouterTrainer:
+    '''
+    Incremental router training. Every class is keyed by a content hash of its description and training rows, and its
+    examples (the training rows, or examples generated from the description) are cached under that hash, so only
+    classes whose inputs changed are rebuilt, in parallel. With a backend that trains on embeddings (see
+    ModelBackend.trains_on_embeddings), the embeddings of the examples are cached under the class hash too: adding rows
+    to one class only embeds that class again, and the classifier is refit on the cached embeddings of the others.
+
+    The router trained on the examples is stored as a content-addressed file under routers/, with its fast-path router
+    next to it. router_path is then swapped to a link to the stored router with an atomic rename, and LLMRoutingAgent
+    resolves the link once, so a router loading during the swap reads the classifier and the fast-path router of the
+    same stored router. Training the same inputs again reuses the stored router without any model call. Cached
+    examples, embeddings and stored routers that no manifest references any more are removed, as are files left
+    behind by trainings that did not finish.
+
+    Classes without training rows are prompt-trained, with LaminiClassifier.prompt_train, when no class has training
+    rows, like LLMRoutingAgent.fit. Their description is their only example when other classes have rows. With
+    generate_examples, they get examples from backend.generate_examples instead, which are cached per class, so only
+    the classes whose description changed are generated again. prompt_train generates and trains in one call, so
+    nothing can be reused from one training to the next, but the routers it trains are the ones operators were
+    evaluated with.
+
+    A router trained before (without a manifest) is adopted as is: its manifest is written for the current inputs,
+    instead of retraining it.
+
+    The training file is streamed in chunks of chunk_size rows, see TrainingDataReader: class hashes are updated one
+    chunk at a time, rows are appended to the example caches (one JSON example per line) as they are read, and the
+    classifier is fed from the caches chunk by chunk. No copy of the whole training data is kept in memory.
+
+    router_path: path of the router to train, e.g. models/FoodDeliveryOperator/router.pkl.
+    '''
+    def __init__(
+            self,
+            router_path,
+            backend=None,
+            fast_router_threshold: float = 0.5,
+            max_workers: int = 8,
+            chunk_size: int = 10000,
+            generate_examples: bool = False,
+    ):
+        self.router_path = router_path
+        self.directory = os.path.dirname(router_path)
+        self.name = os.path.splitext(os.path.basename(router_path))[0]
+        self.backend = backend or get_default_backend()
+        self.fast_router_threshold = fast_router_threshold
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.generate_examples_from_descriptions = generate_examples
+        self.manifest_path = os.path.join(self.directory, f"{self.name}.manifest.json")
+        self.counts = {"cached": 0, "rebuilt": 0, "embedded": 0}
+
+    def get_examples_path(self, class_hash):
+        return os.path.join(self.directory, "examples", class_hash + ".jsonl")
+
+    def get_embeddings_path(self, class_hash):
+        return os.path.join(self.directory, "embeddings", class_hash + ".npy")
+
+    def get_content_path(self, router_hash):
+        return os.path.join(self.directory, "routers", router_hash + os.path.splitext(self.router_path)[1])
+
+    @staticmethod
+    def write_atomic(path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp.{os.getpid()}"
+        with open(tmp_path, "wb" if isinstance(data, bytes) else "w") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def link_atomic(target, path):
+        '''
+        Point path to target (relative to the directory of path) with an atomic rename of a new link.
+        '''
+        tmp_path = f"{path}.tmp.{os.getpid()}"
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        os.symlink(target, tmp_path)
+        os.replace(tmp_path, path)
+
+    def load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return None
+        with open(self.manifest_path) as f:
+            return json.load(f)
+
+    def load_examples(self, max_examples_per_class=None):
+        '''
+        The cached examples of every class of the current router, at most max_examples_per_class each, as a dict of class
+        name to examples. Empty if the router was not trained with a RouterTrainer.
+        '''
+        manifest = self.load_manifest()
+        class_examples = {}
+        for class_name, class_hash in (manifest or {}).get("classes", {}).items():
+            if os.path.exists(self.get_examples_path(class_hash)):
+                class_examples[class_name] = []
+                for batch in self.iter_examples({class_name: class_hash}):
+                    class_examples[class_name].extend(batch[class_name])
+                    if max_examples_per_class is not None and len(class_examples[class_name]) >= max_examples_per_class:
+                        del class_examples[class_name][max_examples_per_class:]
+                        break
+        return class_examples
+
+    def iter_training_batches(self, classes_dict, training_data_path):
+        '''
+        The rows of the training file in chunks, as dicts of class name to rows. See TrainingDataReader.
+        '''
+        if not training_data_path or not os.path.exists(training_data_path):
+            return
+        yield from TrainingDataReader(classes_dict, chunk_size=self.chunk_size).iter_batches(training_data_path)
+
+    def hash_classes(self, classes_dict, training_data_path):
+        '''
+        Content hash of every class, of its description and training rows, updated one chunk of the training file at a
+        time. Returns the hashes, and the classes that have training rows.
+        '''
+        digests = {
+            cl: hashlib.sha256(json.dumps([EXAMPLES_VERSION, cl, description]).encode())
+            for cl, description in classes_dict.items()
+        }
+        classes_with_rows = set()
+        for batch in self.iter_training_batches(classes_dict, training_data_path):
+            for cl, rows in batch.items():
+                for row in rows:
+                    digests[cl].update(json.dumps(row).encode() + b"\n")
+                classes_with_rows.add(cl)
+        for cl in classes_dict:
+            if cl not in classes_with_rows and self.generate_examples_from_descriptions:
+                digests[cl].update(b"generated")
+        return {cl: digest.hexdigest() for cl, digest in digests.items()}, classes_with_rows
+
+    def iter_examples(self, class_hashes):
+        '''
+        The cached examples of the classes (dict of class name to hash) in chunks, as dicts of class name to examples.
+        '''
+        for cl, class_hash in class_hashes.items():
+            chunk = []
+            with open(self.get_examples_path(class_hash)) as f:
+                for line in f:
+                    chunk.append(json.loads(line))
+                    if len(chunk) == self.chunk_size:
+                        yield {cl: chunk}
+                        chunk = []
+            if chunk:
+                yield {cl: chunk}
+
+    def generate_examples(self, class_name, description, class_hash):
+        '''
+        Generate and cache the examples of a class without training rows, from its description: with
+        generate_examples, examples generated by the backend, else only the description.
+        '''
+        examples = [description]
+        if self.generate_examples_from_descriptions:
+            examples = self.backend.generate_examples(class_name, description)
+        self.write_atomic(self.get_examples_path(class_hash), "".join(json.dumps(example) + "\n" for example in examples))
+
+    def copy_training_rows(self, classes_dict, training_data_path, class_hashes):
+        '''
+        Cache the training rows of the classes of class_hashes as their examples, appending every chunk of the training
+        file as it is read.
+        '''
+        os.makedirs(os.path.join(self.directory, "examples"), exist_ok=True)
+        tmp_paths = {cl: f"{self.get_examples_path(class_hash)}.tmp.{os.getpid()}" for cl, class_hash in class_hashes.items()}
+        files = {cl: open(tmp_path, "w") for cl, tmp_path in tmp_paths.items()}
+        try:
+            for batch in self.iter_training_batches(classes_dict, training_data_path):
+                for cl, rows in batch.items():
+                    if cl in files:
+                        files[cl].write("".join(json.dumps(row) + "\n" for row in rows))
+        finally:
+            for f in files.values():
+                f.close()
+        for cl, tmp_path in tmp_paths.items():
+            os.replace(tmp_path, self.get_examples_path(class_hashes[cl]))
+
+    def cache_examples(self, classes_dict, training_data_path, class_hashes, classes_with_rows):
+        '''
+        Cache the examples of the classes whose inputs changed: their training rows, or examples generated from their
+        description for classes without rows. Generation runs in parallel, while the training rows are copied.
+        '''
+        missing = [cl for cl in classes_dict if not os.path.exists(self.get_examples_path(class_hashes[cl]))]
+        self.counts["cached"] += len(classes_dict) - len(missing)
+        self.counts["rebuilt"] += len(missing)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [
+                executor.submit(self.generate_examples, cl, classes_dict[cl], class_hashes[cl])
+                for cl in missing if cl not in classes_with_rows
+            ]
+            rows_missing = {cl: class_hashes[cl] for cl in missing if cl in classes_with_rows}
+            if rows_missing:
+                self.copy_training_rows(classes_dict, training_data_path, rows_missing)
+            for future in futures:
+                future.result()
+
+    def embed_examples(self, classifier, class_hash):
+        '''
+        Embed and cache the examples of a class, one chunk at a time.
+        '''
+        embeddings = [
+            self.backend.embed_examples(classifier, batch["examples"])
+            for batch in self.iter_examples({"examples": class_hash})
+        ]
+        path = self.get_embeddings_path(class_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp.{os.getpid()}"
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.concatenate(embeddings).astype(np.float32))
+        os.replace(tmp_path, path)
+
+    def cache_embeddings(self, classifier, class_hashes):
+        '''
+        Embed the examples of the classes whose embeddings are not cached yet, in parallel. Returns the embeddings of
+        every class, memory-mapped from the cache.
+        '''
+        missing = {cl: h for cl, h in class_hashes.items() if not os.path.exists(self.get_embeddings_path(h))}
+        self.counts["embedded"] += len(missing)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for future in [executor.submit(self.embed_examples, classifier, h) for h in missing.values()]:
+                future.result()
+        return {cl: np.load(self.get_embeddings_path(h), mmap_mode="r") for cl, h in class_hashes.items()}
+
+    def swap_in(self, content_path):
+        '''
+        Point router_path, and its fast-path router path, to the stored router at content_path. Each link is replaced
+        with an atomic rename. Loaders resolve the router link once and read the fast-path router next to the stored
+        router it points to, so they never pair the classifier of one router with the fast-path router of another.
+        '''
+        for source, target in [
+            (LLMRoutingAgent.get_fast_router_path(content_path), LLMRoutingAgent.get_fast_router_path(self.router_path)),
+            (content_path, self.router_path),
+        ]:
+            if os.path.exists(source):
+                self.link_atomic(os.path.relpath(source, self.directory), target)
+
+    def write_manifest(self, router_hash, class_hashes):
+        self.write_atomic(self.manifest_path, json.dumps({"router": router_hash, "classes": class_hashes}, indent=2))
+
+    def adopt(self, classes_dict, training_data_path, router_hash, class_hashes):
+        '''
+        Take over the router at router_path, trained without a RouterTrainer, as the router for the current inputs.
+        Its fast-path router is trained if it has none. Returns whether the fast-path router was added.
+        '''
+        logger.info("Adopting existing router %s.", self.router_path)
+        added = False
+        if not os.path.exists(LLMRoutingAgent.get_fast_router_path(self.router_path)):
+            router = LLMRoutingAgent(self.router_path, self.fast_router_threshold, self.backend)
+            router.fit_fast_router(classes_dict, lambda: self.iter_training_batches(classes_dict, training_data_path))
+            router.save_fast_router(self.router_path)
+            added = True
+        self.write_manifest(router_hash, class_hashes)
+        return added
+
+    def prune(self):
+        '''
+        Remove the cached examples and embeddings, and the stored routers, that are not referenced by any manifest or
+        router link of the directory, e.g. of a router and a flat router trained in the same folder. Temporary files
+        are removed once the process writing them is gone.
+        '''
+        class_hashes = set()
+        router_hashes = set()
+        for manifest_path in glob.glob(os.path.join(self.directory, "*.manifest.json")):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            class_hashes.update(manifest["classes"].values())
+            router_hashes.add(manifest["router"])
+        for path in glob.glob(os.path.join(self.directory, "*")):
+            if os.path.islink(path):
+                router_hashes.add(os.path.basename(os.readlink(path)).split(".")[0].replace("fast_", "", 1))
+        for folder, hashes in [("examples", class_hashes), ("embeddings", class_hashes), ("routers", router_hashes)]:
+            for path in glob.glob(os.path.join(self.directory, folder, "*")):
+                name = os.path.basename(path)
+                pid = get_writer_pid(name)
+                if pid is not None:
+                    if not is_running(pid):
+                        os.remove(path)
+                elif name.split(".")[0].replace("fast_", "", 1) not in hashes:
+                    os.remove(path)
+
+    def train(self, classes_dict, training_data_path=None):
+        '''
+        Train the router for the classes (dict of class name to description) and the optional training csv or jsonl.
+        Returns whether a new router was swapped in at router_path.
+        '''
+        class_hashes, classes_with_rows = self.hash_classes(classes_dict, training_data_path)
+        router_hash = hashlib.sha256(json.dumps(class_hashes, sort_keys=True).encode()).hexdigest()
+
+        manifest = self.load_manifest()
+        if manifest is None and os.path.exists(self.router_path):
+            return self.adopt(classes_dict, training_data_path, router_hash, class_hashes)
+        if manifest is not None and manifest["router"] == router_hash and os.path.exists(self.router_path):
+            logger.info("Router %s is up to date.", self.router_path)
+            return False
+
+        content_path = self.get_content_path(router_hash)
+        if not os.path.exists(content_path):
+            previous = manifest["classes"] if manifest is not None else {}
+            changed = [cl for cl in classes_dict if previous.get(cl) != class_hashes[cl]]
+            logger.info("Training router %s, %d of %d classes changed.", self.router_path, len(changed), len(classes_dict))
+            self.cache_examples(classes_dict, training_data_path, class_hashes, classes_with_rows)
+
+            partial_path = f"{content_path}.{os.getpid()}.partial"
+            router = LLMRoutingAgent(partial_path, self.fast_router_threshold, self.backend)
+            iter_batches = lambda: self.iter_examples(class_hashes)
+            if not classes_with_rows and not self.generate_examples_from_descriptions:
+                router.fit(classes_dict)
+            elif self.backend.trains_on_embeddings:
+                router.fit_embeddings(classes_dict, self.cache_embeddings(router.classifier, class_hashes), iter_batches)
+            else:
+                router.fit_batches(classes_dict, iter_batches)
+            os.makedirs(os.path.dirname(content_path), exist_ok=True)
+            router.save(partial_path)
+            # The fast-path router goes first, so a stored router is always complete.
+            os.replace(LLMRoutingAgent.get_fast_router_path(partial_path), LLMRoutingAgent.get_fast_router_path(content_path))
+            os.replace(partial_path, content_path)
+
+        self.swap_in(content_path)
+        self.write_manifest(router_hash, class_hashes)
+        self.prune()
+        return True
@@ -0,0 +1,217 @@
+import re
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from tracing import count_tokens, truncate_tokens
+
+
+def compact_summary(summary, turns, max_tokens=256, max_words_per_turn=20):
+    '''
+    Default summarizer: folds turns into the summary as their first sentence, at most max_words_per_turn words each.
+    The oldest entries are dropped once the summary is over max_tokens tokens, so it stays bounded however long the
+    conversation gets.
+    '''
+    entries = summary.split(" | ") if summary else []
+    for role, text in turns:
+        sentence = re.split(r"(?<=[.!?])\s", text.strip(), maxsplit=1)[0]
+        words = sentence.split()
+        if len(words) > max_words_per_turn:
+            sentence = " ".join(words[:max_words_per_turn]) + "..."
+        entries.append(f"{role}: {sentence}")
+    while len(entries) > 1 and count_tokens(" | ".join(entries)) > max_tokens:
+        entries.pop(0)
+    return " | ".join(entries)
+
+
+class Session:
+    '''
+    Chat history of one conversation. The last max_recent_turns turns are kept, cut to max_turn_tokens tokens each.
+    Older turns are folded into a rolling summary by the summarizer, so the history rendered into prompts stays bounded.
+
+    The rendered history is cached, and a new turn is appended to it instead of rendering the whole history again.
+    It is only rendered again when the summary changes. Only the latest rendering is kept, whatever prompt heads it
+    is used with.
+    '''
+    def __init__(
+            self,
+            conversation_id,
+            turns=None,
+            summary="",
+            turn_count=None,
+            max_recent_turns=8,
+            max_turn_tokens=256,
+            summarizer=compact_summary,
+    ):
+        self.conversation_id = conversation_id
+        self.turns = [tuple(turn) for turn in turns or []]
+        self.summary = summary
+        self.turn_count = len(self.turns) if turn_count is None else turn_count
+        self.max_recent_turns = max_recent_turns
+        self.max_turn_tokens = max_turn_tokens
+        self.summarizer = summarizer
+        self.summary_version = 0
+        self.rendered = None
+        self.lock = threading.Lock()
+
+    def __bool__(self):
+        return bool(self.turns or self.summary)
+
+    def add_turn(self, role, text):
+        with self.lock:
+            self.turns.append((role, truncate_tokens(text, self.max_turn_tokens)))
+            self.turn_count += 1
+            if len(self.turns) > self.max_recent_turns:
+                overflow = len(self.turns) - self.max_recent_turns
+                self.summary = self.summarizer(self.summary, self.turns[:overflow])
+                self.turns = self.turns[overflow:]
+                self.summary_version += 1
+
+    @staticmethod
+    def render_turn(role, text):
+        return f"{role}: {text}"
+
+    def __render_history(self):
+        lines = [f"Summary of earlier conversation: {self.summary}"] if self.summary else []
+        lines += [self.render_turn(role, text) for role, text in self.turns]
+        return "\n".join(lines)
+
+    def get_history(self):
+        '''
+        The history as a chat_history string, the summary first.
+        '''
+        with self.lock:
+            if self.rendered is not None:
+                turn_count, summary_version, history = self.rendered
+                if turn_count == self.turn_count:
+                    return history
+                new_turns = self.turn_count - turn_count
+                if summary_version == self.summary_version and new_turns <= len(self.turns):
+                    lines = [self.render_turn(role, text) for role, text in self.turns[-new_turns:]]
+                    history += ("\n" if history else "") + "\n".join(lines)
+                    self.rendered = (self.turn_count, summary_version, history)
+                    return history
+            history = self.__render_history()
+            self.rendered = (self.turn_count, self.summary_version, history)
+            return history
+
+    def get_prefix(self, head):
+        '''
+        head followed by the rendered history.
+        '''
+        return head + self.get_history()
+
+    def to_dict(self):
+        return {"turns": self.turns, "summary": self.summary, "turn_count": self.turn_count}
+
+
+class InMemorySessionStore:
+    '''
+    Sessions keyed by conversation id, in memory. The least recently used sessions are dropped once max_sessions is reached.
+    max_recent_turns, max_turn_tokens and summarizer configure the sessions, see Session.
+    '''
+    def __init__(self, max_sessions: int = 1024, max_recent_turns: int = 8, max_turn_tokens: int = 256, summarizer=compact_summary):
+        self.max_sessions = max_sessions
+        self.max_recent_turns = max_recent_turns
+        self.max_turn_tokens = max_turn_tokens
+        self.summarizer = summarizer
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def new_session(self, conversation_id, **state):
+        return Session(
+            conversation_id,
+            max_recent_turns=self.max_recent_turns,
+            max_turn_tokens=self.max_turn_tokens,
+            summarizer=self.summarizer,
+            **state
+        )
+
+    def cache(self, session):
+        with self.lock:
+            self.sessions[session.conversation_id] = session
+            self.sessions.move_to_end(session.conversation_id)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+    def get(self, conversation_id):
+        '''
+        The session of the conversation, a new empty one if there is none.
+        '''
+        with self.lock:
+            session = self.sessions.get(conversation_id)
+        if session is None:
+            session = self.new_session(conversation_id)
+        self.cache(session)
+        return session
+
+    def save(self, session):
+        self.cache(session)
+
+    def delete(self, conversation_id):
+        with self.lock:
+            self.sessions.pop(conversation_id, None)
+
+
+class SQLiteSessionStore(InMemorySessionStore):
+    '''
+    Sessions persisted in a SQLite database, so they survive restarts and are shared by the workers of a server.
+    Recently used sessions (and their rendered history) are also kept in memory, and reloaded from the database
+    if another process saved more turns since. A save never replaces a state with more turns, so a thread saving a
+    session late does not undo the turns saved by another.
+    '''
+    def __init__(
+            self,
+            path,
+            max_sessions: int = 1024,
+            max_recent_turns: int = 8,
+            max_turn_tokens: int = 256,
+            summarizer=compact_summary,
+    ):
+        super().__init__(
+            max_sessions=max_sessions,
+            max_recent_turns=max_recent_turns,
+            max_turn_tokens=max_turn_tokens,
+            summarizer=summarizer,
+        )
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.db_lock = threading.Lock()
+        with self.db_lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS sessions (conversation_id TEXT PRIMARY KEY, turn_count INTEGER, state TEXT)"
+            )
+
+    def get(self, conversation_id):
+        with self.db_lock:
+            row = self.connection.execute(
+                "SELECT turn_count, state FROM sessions WHERE conversation_id = ?", (conversation_id,)
+            ).fetchone()
+        with self.lock:
+            session = self.sessions.get(conversation_id)
+        if row is None:
+            if session is None:
+                session = self.new_session(conversation_id)
+        elif session is None or row[0] > session.turn_count:
+            session = self.new_session(conversation_id, **json.loads(row[1]))
+        self.cache(session)
+        return session
+
+    def save(self, session):
+        self.cache(session)
+        with session.lock:
+            state = json.dumps(session.to_dict())
+            turn_count = session.turn_count
+        with self.db_lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO sessions (conversation_id, turn_count, state) VALUES (?, ?, ?) "
+                "ON CONFLICT (conversation_id) DO UPDATE SET turn_count = excluded.turn_count, state = excluded.state "
+                "WHERE excluded.turn_count >= sessions.turn_count",
+                (session.conversation_id, turn_count, state),
+            )
+
+    def delete(self, conversation_id):
+        super().delete(conversation_id)
+        with self.db_lock, self.connection:
+            self.connection.execute("DELETE FROM sessions WHERE conversation_id = ?", (conversation_id,))
@@ -0,0 +1,133 @@
+import threading
+
+from tracing import count_tokens, logger, tracer
+
+
+class TokenBudget:
+    '''
+    Fits prompts into the context of the model they are sent to. Prompt sections are measured with the tokenizer, a
+    callable returning the number of tokens of a text: tracing.count_tokens by default, an approximation that needs no
+    model vocabulary, or e.g. lambda text: len(hf_tokenizer.encode(text)) for exact counts.
+
+    budgets: dict of model name to its context size in tokens, default_budget for other models.
+    reserve_tokens: tokens left free for the completion.
+    min_query_share: share of the budget kept for the user message, even if the other prompt sections take more, so
+    the model is never called without the message.
+
+    Sections are pruned in order of importance: the least relevant tools are dropped first, then old observations and
+    the oldest part of the chat history are truncated. The selected tool and the latest user message are kept.
+    '''
+    def __init__(
+            self,
+            budgets=None,
+            default_budget: int = 4096,
+            reserve_tokens: int = 512,
+            tokenizer=count_tokens,
+            min_query_share: float = 0.25,
+    ):
+        self.budgets = budgets or {}
+        self.default_budget = default_budget
+        self.reserve_tokens = reserve_tokens
+        self.min_query_share = min_query_share
+        self.tokenizer = tokenizer
+        self.counts = {"prompts": 0, "pruned": 0, "prompt_tokens": 0, "pruned_tokens": 0}
+        self.lock = threading.Lock()
+
+    def count(self, text):
+        return self.tokenizer(text)
+
+    def get_budget(self, model_name):
+        '''
+        Tokens available for the prompt of the model.
+        '''
+        return self.budgets.get(model_name, self.default_budget) - self.reserve_tokens
+
+    def get_query_budget(self, model_name, fixed_tokens):
+        '''
+        Tokens available for the user message of a prompt whose other sections take fixed_tokens tokens: what is left
+        of the budget, but at least min_query_share of it.
+        '''
+        max_tokens = self.get_budget(model_name)
+        min_tokens = int(max_tokens * self.min_query_share)
+        if max_tokens - fixed_tokens < min_tokens:
+            logger.warning(
+                "Prompt sections take %d of the %d tokens of %s, keeping %d tokens for the message.",
+                fixed_tokens, max_tokens, model_name, min_tokens,
+            )
+            return min_tokens
+        return max_tokens - fixed_tokens
+
+    def truncate(self, text, max_tokens, keep_end=False):
+        '''
+        The start (or with keep_end, the end) of the text that fits in max_tokens tokens, cut at a word boundary and
+        marked with an ellipsis.
+        '''
+        if self.count(text) <= max_tokens:
+            return text
+        max_tokens -= self.count("…")
+        low, high = 0, len(text)
+        while low < high:
+            middle = (low + high + 1) // 2
+            part = text[len(text) - middle:] if keep_end else text[:middle]
+            if self.count(part) <= max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        if keep_end:
+            start = len(text) - low
+            part = text[start:]
+            if 0 < start < len(text) and not text[start - 1].isspace() and not text[start].isspace():
+                part = part.split(None, 1)[1] if len(part.split(None, 1)) > 1 else ""
+            return "…" + part.lstrip()
+        part = text[:low]
+        if low > 0 and not text[low].isspace() and not text[low - 1].isspace():
+            part = part.rsplit(None, 1)[0] if len(part.rsplit(None, 1)) > 1 else ""
+        return part.rstrip() + "…"
+
+    def fit_sections(self, sections, max_tokens, scores=None, min_sections=1):
+        '''
+        Names of the sections (dict of name to text) to keep within max_tokens tokens, in their original order.
+        The sections with the lowest scores (dict of name to relevance) are dropped first, at least min_sections are kept.
+        '''
+        kept = {name: self.count(text) for name, text in sections.items()}
+        total = sum(kept.values())
+        for name in sorted(sections, key=lambda name: (scores or {}).get(name, 0.0)):
+            if total <= max_tokens or len(kept) <= min_sections:
+                break
+            total -= kept.pop(name)
+        return [name for name in sections if name in kept]
+
+    def fit_observations(self, observations, max_tokens):
+        '''
+        The observations of previous steps, fitted into max_tokens tokens by truncating the oldest ones first.
+        '''
+        observations = [str(obs) for obs in observations]
+        counts = [self.count(obs) for obs in observations]
+        excess = sum(counts) - max_tokens
+        for i, obs in enumerate(observations):
+            if excess <= 0:
+                break
+            observations[i] = self.truncate(obs, max(counts[i] - excess, 0))
+            excess -= counts[i] - self.count(observations[i])
+        return observations
+
+    def record(self, tokens, pruned_tokens=0):
+        '''
+        Count a prompt of the given size, after pruning pruned_tokens tokens from it. Also set on the open span.
+        '''
+        tracer.annotate(prompt_tokens=tokens, pruned_tokens=pruned_tokens)
+        with self.lock:
+            self.counts["prompts"] += 1
+            self.counts["prompt_tokens"] += tokens
+            if pruned_tokens > 0:
+                self.counts["pruned"] += 1
+                self.counts["pruned_tokens"] += pruned_tokens
+
+    def get_report(self):
+        with self.lock:
+            prompts = self.counts["prompts"]
+            return dict(
+                self.counts,
+                mean_prompt_tokens=self.counts["prompt_tokens"] / prompts if prompts else 0.0,
+                pruned_rate=self.counts["pruned"] / prompts if prompts else 0.0,
+            )
@@ -0,0 +1,141 @@
+import re
+import threading
+from collections import Counter
+
+import numpy as np
+
+STOPWORDS = frozenset("""
+a an and are as at be but by can could do does for from have how i if in into is it its me my of on or our please
+should so than that the their them then there these they this to was we what when where which who why will with would
+you your
+""".split())
+
+
+class ToolIndex:
+    '''
+    In-process BM25 index over the descriptions and example queries of operations, to shortlist the operations
+    relevant to a query. Every description and example is its own document, and an operation scores as its best
+    matching document, so a query close to a single training example still finds its operation.
+
+    max_documents_per_operation: keep at most this many documents (the description and first examples) per operation.
+    max_operation_frequency: terms found in the documents of more than this fraction of the operations, like stopwords,
+    do not tell operations apart and are not indexed. Only applied to catalogs of at least min_cutoff_operations
+    operations: in small catalogs, operation names and domain words are shared by a large fraction of the operations.
+
+    The BM25 weight of every (term, document) pair is computed once, into flat arrays grouped by term, when the index
+    is first searched after documents were added. A search then only sums the weights of the query terms with NumPy,
+    on a snapshot of the arrays, without holding the lock.
+    '''
+    def __init__(
+            self,
+            k1: float = 1.2,
+            b: float = 0.75,
+            max_documents_per_operation: int = 200,
+            max_operation_frequency: float = 0.5,
+            min_cutoff_operations: int = 20,
+    ):
+        self.k1 = k1
+        self.b = b
+        self.max_documents_per_operation = max_documents_per_operation
+        self.max_operation_frequency = max_operation_frequency
+        self.min_cutoff_operations = min_cutoff_operations
+        self.document_operations = []
+        self.document_lengths = []
+        self.postings = {}
+        self.operation_documents = Counter()
+        self.snapshot = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def tokenize(text):
+        '''
+        Lowercased words, with camelCase and snake_case names split into their words, without stopwords.
+        '''
+        text = re.sub(r"([a-z])([A-Z])", r"\1 \2", text)
+        return [term for term in re.findall(r"[a-z0-9]+", text.lower()) if term not in STOPWORDS]
+
+    def add(self, operation, texts):
+        '''
+        Index texts (description, argument descriptions, example queries) of an operation.
+        '''
+        with self.lock:
+            for text in texts:
+                if self.operation_documents[operation] >= self.max_documents_per_operation:
+                    break
+                terms = Counter(self.tokenize(str(text)))
+                if not terms:
+                    continue
+                document_id = len(self.document_operations)
+                self.document_operations.append(operation)
+                self.document_lengths.append(sum(terms.values()))
+                self.operation_documents[operation] += 1
+                for term, count in terms.items():
+                    self.postings.setdefault(term, []).append((document_id, count))
+            self.snapshot = None
+
+    def __build_snapshot(self):
+        '''
+        The BM25 weights of the index, as a tuple of:
+        the column of every indexed term, the start of every term's documents (the last entry is the end),
+        the document ids and weights of every term one after the other, the operation names, the start of every
+        operation's documents, and the document ids sorted by operation.
+        '''
+        documents = len(self.document_operations)
+        operations = sorted(self.operation_documents)
+        operation_index = {operation: i for i, operation in enumerate(operations)}
+        document_operation_ids = np.array([operation_index[op] for op in self.document_operations], dtype=np.int64)
+        lengths = np.array(self.document_lengths, dtype=np.float32)
+        length_norm = 1 - self.b + self.b * lengths / lengths.mean()
+
+        cutoff = len(operations) >= self.min_cutoff_operations
+        max_operations = self.max_operation_frequency * len(operations)
+        columns, starts, document_ids, weights = {}, [0], [], []
+        for term, postings in self.postings.items():
+            ids = np.fromiter((document_id for document_id, _ in postings), dtype=np.int64, count=len(postings))
+            if cutoff and len(np.unique(document_operation_ids[ids])) > max_operations:
+                continue
+            counts = np.fromiter((count for _, count in postings), dtype=np.float32, count=len(postings))
+            idf = np.log(1 + (documents - len(postings) + 0.5) / (len(postings) + 0.5))
+            columns[term] = len(columns)
+            document_ids.append(ids)
+            weights.append(idf * counts * (self.k1 + 1) / (counts + self.k1 * length_norm[ids]))
+            starts.append(starts[-1] + len(postings))
+
+        order = np.argsort(document_operation_ids, kind="stable")
+        operation_starts = np.searchsorted(document_operation_ids[order], np.arange(len(operations)))
+        return (
+            columns,
+            np.array(starts, dtype=np.int64),
+            np.concatenate(document_ids) if document_ids else np.zeros(0, dtype=np.int64),
+            np.concatenate(weights) if weights else np.zeros(0, dtype=np.float32),
+            operations,
+            operation_starts,
+            order,
+        )
+
+    def get_snapshot(self):
+        with self.lock:
+            if self.snapshot is None and self.document_operations:
+                self.snapshot = self.__build_snapshot()
+            return self.snapshot
+
+    def search(self, query, k=None):
+        '''
+        Operations matching the query, as (operation, score) pairs with the highest score first, at most k of them.
+        Operations sharing no indexed word with the query are not returned.
+        '''
+        snapshot = self.get_snapshot()
+        if snapshot is None:
+            return []
+        columns, starts, document_ids, weights, operations, operation_starts, order = snapshot
+        terms = [columns[term] for term in set(self.tokenize(query)) if term in columns]
+        if not terms:
+            return []
+        ids = np.concatenate([document_ids[starts[term]:starts[term + 1]] for term in terms])
+        scores = np.bincount(ids, np.concatenate([weights[starts[term]:starts[term + 1]] for term in terms]), len(order))
+        operation_scores = np.maximum.reduceat(scores[order], operation_starts)
+        ranked = np.argsort(-operation_scores, kind="stable")
+        ranked = ranked[operation_scores[ranked] > 0]
+        if k is not None:
+            ranked = ranked[:k]
+        return [(operations[i], float(operation_scores[i])) for i in ranked]
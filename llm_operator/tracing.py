@@ -0,0 +1,368 @@
+import os
+import re
+import json
+import time
+import queue
+import logging
+import threading
+import contextvars
+import urllib.request
+
+
+logger = logging.getLogger("llm_operator")
+
+
+def configure_logging(level=logging.INFO):
+    '''
+    Log operator messages to stderr at the given level, for command line use.
+    '''
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.handlers = [handler]
+    logger.setLevel(level)
+    logger.propagate = False
+
+
+def count_tokens(text):
+    '''
+    Approximate number of tokens of a prompt: words and punctuation marks.
+    '''
+    return len(re.findall(r"\w+|[^\w\s]", text))
+
+
+def truncate_tokens(text, max_tokens):
+    '''
+    The text cut after its first max_tokens tokens, as counted by count_tokens.
+    '''
+    for i, match in enumerate(re.finditer(r"\w+|[^\w\s]", text)):
+        if i == max_tokens:
+            return text[:match.start()].rstrip() + "..."
+    return text
+
+
+class Span:
+    '''
+    One timed stage, e.g. routing a query. Model calls made while the span is open are counted in it, and in its parents.
+    '''
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start_time", "end_time", "attributes", "model_calls", "outcome")
+
+    def __init__(self, name, trace_id, parent_id, attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.model_calls = 0
+        self.outcome = "ok"
+        self.start_time = time.time()
+        self.end_time = None
+
+    @property
+    def duration(self):
+        return self.end_time - self.start_time
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def set_prompt(self, prompt):
+        self.attributes["prompt_chars"] = len(prompt)
+        self.attributes["prompt_tokens"] = count_tokens(prompt)
+
+
+class NoopSpan:
+    '''
+    Returned while tracing is disabled, so instrumented code does no work beyond the call.
+    '''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+    def set_prompt(self, prompt):
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class SpanContext:
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.span = None
+        self.token = None
+
+    def __enter__(self):
+        stack = self.tracer.stack.get()
+        parent = stack[-1] if stack else None
+        self.span = Span(
+            self.name,
+            parent.trace_id if parent else os.urandom(16).hex(),
+            parent.span_id if parent else None,
+            self.attributes,
+        )
+        self.token = self.tracer.stack.set(stack + (self.span,))
+        return self.span
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.span.end_time = time.time()
+        if exc_type is not None:
+            self.span.outcome = "error"
+            self.span.attributes["error"] = exc_type.__name__
+        self.tracer.stack.reset(self.token)
+        self.tracer.finish(self.span)
+        return False
+
+
+class Tracer:
+    '''
+    Records spans around the stages of the operators and hands finished spans to the exporters.
+    Tracing is enabled by adding an exporter. While disabled, span() returns a shared no-op span.
+    Open spans are kept in a context variable, so asyncio tasks and asyncio.to_thread calls nest under the span they
+    were started from. Use bind() for other thread pools.
+    '''
+    def __init__(self):
+        self.exporters = []
+        self.enabled = False
+        self.stack = contextvars.ContextVar("llm_operator_spans", default=())
+
+    def add_exporter(self, exporter):
+        self.exporters.append(exporter)
+        self.enabled = True
+        return exporter
+
+    def remove_exporter(self, exporter):
+        self.exporters.remove(exporter)
+        self.enabled = bool(self.exporters)
+
+    def span(self, name, **attributes):
+        '''
+        Context manager timing a stage: with tracer.span("select_operations", operator=...) as span: ...
+        An exception raised in the block marks the span as an error.
+        '''
+        if not self.enabled:
+            return NOOP_SPAN
+        return SpanContext(self, name, attributes)
+
+    def bind(self, function):
+        '''
+        Wrap function to run in the current context, e.g. in a worker thread, so its spans nest under the open span.
+        '''
+        if not self.enabled:
+            return function
+        context = contextvars.copy_context()
+        return lambda *args, **kwargs: context.copy().run(function, *args, **kwargs)
+
+    def annotate(self, **attributes):
+        '''
+        Set attributes on the innermost open span, e.g. the size of a prompt built deep inside a stage.
+        '''
+        if not self.enabled:
+            return
+        stack = self.stack.get()
+        if stack:
+            stack[-1].set(**attributes)
+
+    def record_model_call(self):
+        if not self.enabled:
+            return
+        for span in self.stack.get():
+            span.model_calls += 1
+
+    def finish(self, span):
+        for exporter in self.exporters:
+            exporter.export(span)
+
+
+class PrometheusExporter:
+    '''
+    Aggregates spans into Prometheus metrics by span name and outcome: a duration histogram, and counters of model
+    calls, prompt characters and tokens, and tokens pruned from prompts (see TokenBudget). render() returns them in the Prometheus text exposition format.
+    '''
+    def __init__(self, prefix="llm_operator", buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)):
+        self.prefix = prefix
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def export(self, span):
+        key = (span.name, span.outcome)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = {
+                    "buckets": [0] * len(self.buckets), "count": 0, "sum": 0.0,
+                    "model_calls": 0, "prompt_chars": 0, "prompt_tokens": 0, "pruned_tokens": 0,
+                }
+            duration = span.duration
+            for i, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    series["buckets"][i] += 1
+            series["count"] += 1
+            series["sum"] += duration
+            series["model_calls"] += span.model_calls
+            series["prompt_chars"] += span.attributes.get("prompt_chars", 0)
+            series["prompt_tokens"] += span.attributes.get("prompt_tokens", 0)
+            series["pruned_tokens"] += span.attributes.get("pruned_tokens", 0)
+
+    def render(self):
+        name = f"{self.prefix}_span_duration_seconds"
+        lines = [
+            f"# HELP {name} Duration of operator stages.",
+            f"# TYPE {name} histogram",
+        ]
+        counters = [
+            ("model_calls", "Model calls made during operator stages."),
+            ("prompt_chars", "Characters of the prompts sent during operator stages."),
+            ("prompt_tokens", "Approximate tokens of the prompts sent during operator stages."),
+            ("pruned_tokens", "Tokens pruned from prompts to fit the token budget during operator stages."),
+        ]
+        with self.lock:
+            series = sorted(self.series.items())
+            for (span_name, outcome), values in series:
+                labels = f'span="{span_name}",outcome="{outcome}"'
+                for bound, count in zip(self.buckets, values["buckets"]):
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {values["count"]}')
+                lines.append(f"{name}_sum{{{labels}}} {values['sum']}")
+                lines.append(f"{name}_count{{{labels}}} {values['count']}")
+            for counter, help in counters:
+                counter_name = f"{self.prefix}_span_{counter}_total"
+                lines.append(f"# HELP {counter_name} {help}")
+                lines.append(f"# TYPE {counter_name} counter")
+                for (span_name, outcome), values in series:
+                    lines.append(f'{counter_name}{{span="{span_name}",outcome="{outcome}"}} {values[counter]}')
+        return "\n".join(lines) + "\n"
+
+
+class OTLPExporter:
+    '''
+    Exports spans in the OpenTelemetry OTLP/JSON format, POSTed to an OTLP/HTTP collector endpoint
+    (e.g. http://localhost:4318/v1/traces), or appended to a file as one JSON request per line.
+    Spans are queued and sent from a background thread, in batches, once max_batch_size spans are waiting or
+    flush_interval seconds after the previous batch, so requests never wait on the collector. Spans are dropped (and
+    counted in dropped) when max_queue_size spans are already waiting. Call flush() to export the remaining spans.
+    '''
+    # Queued by flush() to send the current batch right away.
+    FLUSH = object()
+
+    def __init__(
+            self,
+            endpoint=None,
+            path=None,
+            service_name="llm-operator",
+            max_batch_size=512,
+            flush_interval=5.0,
+            max_queue_size=8192,
+    ):
+        if (endpoint is None) == (path is None):
+            raise Exception("Pass exactly one of endpoint or path.")
+        self.endpoint = endpoint
+        self.path = path
+        self.service_name = service_name
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.__start()
+        # Threads do not survive fork, so pre-forked workers start their own sender, with an empty queue.
+        os.register_at_fork(after_in_child=self.__start)
+
+    def __start(self):
+        self.queue = queue.Queue(maxsize=self.max_queue_size)
+        self.thread = threading.Thread(target=self.__send_loop, args=(self.queue,), daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def to_attribute(key, value):
+        if isinstance(value, bool):
+            return {"key": key, "value": {"boolValue": value}}
+        if isinstance(value, int):
+            return {"key": key, "value": {"intValue": str(value)}}
+        if isinstance(value, float):
+            return {"key": key, "value": {"doubleValue": value}}
+        return {"key": key, "value": {"stringValue": str(value)}}
+
+    def to_otlp(self, span):
+        attributes = dict(span.attributes, model_calls=span.model_calls)
+        otlp_span = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": 1,
+            "startTimeUnixNano": str(int(span.start_time * 1e9)),
+            "endTimeUnixNano": str(int(span.end_time * 1e9)),
+            "attributes": [self.to_attribute(key, value) for key, value in attributes.items()],
+            # STATUS_CODE_OK, STATUS_CODE_ERROR
+            "status": {"code": 1 if span.outcome == "ok" else 2},
+        }
+        if span.parent_id is not None:
+            otlp_span["parentSpanId"] = span.parent_id
+        return otlp_span
+
+    def export(self, span):
+        try:
+            self.queue.put_nowait(self.to_otlp(span))
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def flush(self):
+        '''
+        Send the queued spans, and wait until they are sent.
+        '''
+        self.queue.put(self.FLUSH)
+        self.queue.join()
+
+    def __send_loop(self, spans_queue):
+        spans = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                item = spans_queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                item = None
+            if item is not None and item is not self.FLUSH:
+                spans.append(item)
+            if item is self.FLUSH or len(spans) >= self.max_batch_size or time.monotonic() >= deadline:
+                if spans:
+                    try:
+                        self.send(spans)
+                    except Exception as e:
+                        logger.warning("Failed to export %d spans: %s", len(spans), e)
+                # Spans count as done once sent, so flush() returns after the spans queued before it are sent.
+                for _ in spans:
+                    spans_queue.task_done()
+                spans = []
+                deadline = time.monotonic() + self.flush_interval
+            if item is self.FLUSH:
+                spans_queue.task_done()
+
+    def send(self, spans):
+        request = {
+            "resourceSpans": [{
+                "resource": {"attributes": [self.to_attribute("service.name", self.service_name)]},
+                "scopeSpans": [{"scope": {"name": "llm_operator"}, "spans": spans}],
+            }]
+        }
+        data = json.dumps(request).encode()
+        if self.path is not None:
+            with open(self.path, "ab") as f:
+                f.write(data + b"\n")
+            return
+        try:
+            urllib.request.urlopen(
+                urllib.request.Request(self.endpoint, data=data, headers={"Content-Type": "application/json"}),
+                timeout=5,
+            )
+        except OSError as e:
+            logger.warning("Failed to export %d spans to %s: %s", len(spans), self.endpoint, e)
+
+
+tracer = Tracer()
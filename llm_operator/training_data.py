@@ -0,0 +1,100 @@
+import re
+import csv
+import json
+
+
+class TrainingDataReader:
+    '''
+    Streams the training examples of a router from a training file, without loading the whole file in memory.
+    CSV files have a class_name and a data column. JSONL files (.jsonl) have one {"class_name": ..., "data": ...}
+    object per line.
+    A space after a CSV comma and the quotes around a value are not part of the value: order, "buy apples" is the
+    example buy apples. The pandas.read_csv call used before kept both, so the bundled training files now give
+    different examples than they did then.
+
+    Rows are read in chunks of chunk_size and grouped by class name in a single pass. Rows of other classes are skipped.
+    With dedupe, near-identical examples of a class (equal up to case, punctuation and whitespace) are only kept once.
+    Only a 64-bit hash of every kept example is remembered for this.
+    max_examples_per_class: keep at most this many examples of every class, the first ones in the file.
+    '''
+    def __init__(self, classes, dedupe: bool = True, max_examples_per_class: int = None, chunk_size: int = 10000):
+        self.classes = list(classes)
+        self.dedupe = dedupe
+        self.max_examples_per_class = max_examples_per_class
+        self.chunk_size = chunk_size
+        self.counts = {"rows": 0, "kept": 0, "duplicates": 0, "skipped": 0}
+
+    @staticmethod
+    def normalize(text):
+        return " ".join(re.findall(r"\w+", text.lower()))
+
+    @staticmethod
+    def iter_rows(path):
+        '''
+        (class_name, data) of every row of the training file, lazily.
+        '''
+        if path.endswith(".jsonl"):
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        row = json.loads(line)
+                        yield str(row["class_name"]), str(row["data"])
+            return
+        with open(path, newline="") as f:
+            reader = csv.reader(f, skipinitialspace=True)
+            header = [name.strip() for name in next(reader, [])]
+            if "class_name" not in header or "data" not in header:
+                raise Exception(f"Training file {path} needs a class_name and a data column.")
+            class_index, data_index = header.index("class_name"), header.index("data")
+            for row in reader:
+                if len(row) > max(class_index, data_index):
+                    yield row[class_index].strip(), row[data_index].strip()
+
+    def iter_chunks(self, path):
+        chunk = []
+        for row in self.iter_rows(path):
+            chunk.append(row)
+            if len(chunk) == self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def iter_batches(self, path):
+        '''
+        The new examples of every chunk of the training file, as a dict of class name to examples, so they can be fed
+        to a classifier as they are read.
+        '''
+        seen = {cl: set() for cl in self.classes}
+        kept = {cl: 0 for cl in self.classes}
+        for chunk in self.iter_chunks(path):
+            batch = {}
+            for class_name, data in chunk:
+                self.counts["rows"] += 1
+                if class_name not in seen or not data:
+                    self.counts["skipped"] += 1
+                    continue
+                if self.max_examples_per_class is not None and kept[class_name] >= self.max_examples_per_class:
+                    self.counts["skipped"] += 1
+                    continue
+                if self.dedupe:
+                    key = hash(self.normalize(data))
+                    if key in seen[class_name]:
+                        self.counts["duplicates"] += 1
+                        continue
+                    seen[class_name].add(key)
+                kept[class_name] += 1
+                self.counts["kept"] += 1
+                batch.setdefault(class_name, []).append(data)
+            if batch:
+                yield batch
+
+    def read(self, path):
+        '''
+        All examples of every class, as a dict of class name to examples. Classes without rows get an empty list.
+        '''
+        class_data = {cl: [] for cl in self.classes}
+        for batch in self.iter_batches(path):
+            for cl, examples in batch.items():
+                class_data[cl].extend(examples)
+        return class_data
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The operator modules import each other as top-level modules, like the scripts running with PYTHONPATH=llm_operator.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "llm_operator"))
+os.environ.setdefault("LLM_OPERATOR_BACKEND", "stub")
@@ -0,0 +1,169 @@
+import asyncio
+import threading
+
+import pytest
+
+from base_operator import Operator
+from model_backend import StubBackend
+
+
+TRAINING_DATA = """class_name,data
+echo,"echo this message back"
+echo,"repeat after me"
+echo,"say it again"
+shout,"shout this message loudly"
+shout,"yell it out"
+shout,"scream at the top of your lungs"
+"""
+
+
+class ConcurrencyProbe:
+    def __init__(self):
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+
+    def __exit__(self, *exc_info):
+        with self.lock:
+            self.active -= 1
+
+
+class EchoOperator(Operator):
+    def __init__(self):
+        super().__init__()
+        self.probe = ConcurrencyProbe()
+        self.add_operation(self.echo)
+        self.add_operation(self.shout)
+
+    def echo(self, message: str):
+        """
+        echo a message back to the user.
+
+        Parameters:
+        message: the message to echo
+        """
+        with self.probe:
+            threading.Event().wait(0.02)
+        if "fail" in message:
+            raise ValueError(message)
+        return "echo: " + message
+
+    async def shout(self, message: str):
+        """
+        shout a message loudly to the user.
+
+        Parameters:
+        message: the message to shout
+        """
+        with self.probe:
+            await asyncio.sleep(0.02)
+        if "fail" in message:
+            raise ValueError(message)
+        return "SHOUT: " + message
+
+
+@pytest.fixture
+def operator(tmp_path):
+    training_file = tmp_path / "train.csv"
+    training_file.write_text(TRAINING_DATA)
+    operator = EchoOperator().set_backend(StubBackend())
+    operator.train(str(tmp_path / "model"), str(training_file))
+    return operator
+
+
+def test_arun_calls_sync_and_async_tools(operator):
+    assert asyncio.run(operator.arun("echo this message back")) == "echo: echo this message back"
+    assert asyncio.run(operator.arun("shout this message loudly")) == "SHOUT: shout this message loudly"
+
+
+def test_arun_matches_run(operator):
+    assert asyncio.run(operator.arun("repeat after me")) == operator.run("repeat after me")
+
+
+def test_arun_concurrency_is_bounded(operator):
+    operator.max_concurrency = 2
+
+    async def run_all():
+        return await asyncio.gather(*[operator.arun(f"echo this message back {i}") for i in range(8)])
+
+    results = asyncio.run(run_all())
+    assert results == [f"echo: echo this message back {i}" for i in range(8)]
+    assert operator.probe.max_active <= 2
+
+
+def test_arun_batch_concurrency_is_bounded(operator):
+    operator.max_concurrency = 3
+    queries = [f"shout this message loudly {i}" for i in range(6)] + [f"echo this message back {i}" for i in range(6)]
+    results = asyncio.run(operator.arun_batch(queries))
+    assert results[:6] == [f"SHOUT: shout this message loudly {i}" for i in range(6)]
+    assert results[6:] == [f"echo: echo this message back {i}" for i in range(6)]
+    assert 1 < operator.probe.max_active <= 3
+
+
+def test_arun_batch_returns_per_item_errors(operator):
+    queries = ["echo this message back", "echo this message back, fail", "shout this message loudly, fail", "yell it out"]
+    results = asyncio.run(operator.arun_batch(queries))
+    assert results[0] == "echo: echo this message back"
+    assert isinstance(results[1], ValueError)
+    assert isinstance(results[2], ValueError)
+    assert results[3] == "SHOUT: yell it out"
+
+
+def test_arun_batch_empty(operator):
+    assert asyncio.run(operator.arun_batch([])) == []
+
+
+def test_arun_batch_uses_response_cache(operator):
+    operator.enable_response_cache()
+    queries = ["echo this message back", "shout this message loudly"]
+    first = asyncio.run(operator.arun_batch(queries))
+    assert asyncio.run(operator.arun_batch(queries + ["yell it out"])) == first + ["SHOUT: yell it out"]
+    assert asyncio.run(operator.arun("echo this message back")) == first[0]
+    assert operator.response_cache.stats()["hits"] == 3
+
+
+def test_arun_batch_skips_cache_for_uncacheable_tools(operator):
+    operator.enable_response_cache()
+    operator.add_operation(operator.echo, cacheable=False)
+    asyncio.run(operator.arun_batch(["echo this message back", "shout this message loudly"]))
+    asyncio.run(operator.arun_batch(["echo this message back", "shout this message loudly"]))
+    assert operator.response_cache.stats()["hits"] == 1
+
+
+def test_speculation_counts_under_concurrency(operator):
+    operator.enable_speculation()
+
+    async def run_all():
+        return await asyncio.gather(*[operator.arun(f"echo this message back {i}") for i in range(40)])
+
+    asyncio.run(run_all())
+    report = operator.get_speculation_report()
+    assert report["hits"] + report["misses"] + report["skipped"] == 40
+    assert sum(operator.operation_counts.values()) == 40
+
+
+def test_argument_extraction_uses_the_current_model_name(operator):
+    model_names = []
+    generate = operator.backend.generate
+    operator.backend.generate = lambda *args: model_names.append(args[2]) or generate(*args)
+
+    operator.model_name = "meta-llama/Llama-2-70b-chat-hf"
+    operator.select_arguments("echo this message back", "echo")
+    operator.select_arguments_batch(["echo this message back"], "echo")
+    operator.select_arguments("echo this message back", "echo", model_name="other-model")
+    assert model_names == ["meta-llama/Llama-2-70b-chat-hf", "meta-llama/Llama-2-70b-chat-hf", "other-model"]
+
+
+def test_extraction_counts_under_concurrency(operator):
+    async def run_all():
+        return await asyncio.gather(*[operator.arun(f"echo this message back {i}") for i in range(40)])
+
+    asyncio.run(run_all())
+    operator.run_batch([f"echo this message back {i}" for i in range(10)])
+    report = operator.get_extraction_report()
+    assert report["rule_hits"] + report["llm_calls"] == 50
@@ -0,0 +1,76 @@
+import re
+
+import pytest
+
+from argument_extractors import NumberExtractor, argument_extractors
+from base_operator import Operator
+from model_backend import StubBackend
+
+
+TRAINING_DATA = """class_name,data
+setAge,"I am 30 years old"
+setAge,"my age is 42"
+setName,"my name is Bob"
+setName,"call me Alice"
+"""
+
+
+class ExtractionBackend(StubBackend):
+    '''
+    Extracts no number, as "none", from messages without one.
+    '''
+    def generate(self, inputs, output_type, model_name, prompt_template):
+        outputs = super().generate(inputs, output_type, model_name, prompt_template)
+        for item, output in zip(inputs if isinstance(inputs, list) else [inputs], outputs if isinstance(outputs, list) else [outputs]):
+            for name, type in output_type.items():
+                if type == "int" and not re.search(r"\d", item["query"]):
+                    output[name] = "none"
+        return outputs
+
+
+class ProfileOperator(Operator):
+    def __init__(self):
+        super().__init__()
+        self.add_operation(self.setAge)
+        self.add_operation(self.setName)
+
+    @argument_extractors(age=NumberExtractor(int, minimum=0, maximum=130))
+    def setAge(self, age: int):
+        """
+        set the age of the user.
+
+        Parameters:
+        age: age of the user in years
+        """
+        return f"age={age}"
+
+    def setName(self, name: str):
+        """
+        set the name of the user.
+
+        Parameters:
+        name: name of the user
+        """
+        return f"name={name}"
+
+
+@pytest.fixture
+def operator(tmp_path):
+    training_file = tmp_path / "train.csv"
+    training_file.write_text(TRAINING_DATA)
+    operator = ProfileOperator().set_backend(ExtractionBackend())
+    operator.train(str(tmp_path / "model"), str(training_file))
+    # Every query is low-confidence, so the speculative policy always chooses.
+    return operator.enable_confidence_gating(min_margin=1.01, policy="speculative")
+
+
+def test_speculative_policy_prefers_rule_matches(operator):
+    selected_operation, _ = operator.select_operations("I am 30, call me Alice")
+    assert selected_operation == "setName"
+    assert operator.run("I am 30, call me Alice") == "age=30"
+
+
+def test_speculative_policy_skips_invalid_arguments(operator):
+    assert operator.run("call me Alice") == "name=call me Alice"
+    assert operator.run_batch(["call me Alice", "I am 30 years old"]) == ["name=call me Alice", "age=30"]
+
@@ -0,0 +1,53 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from base_operator import Operator
+from http_server import MicroBatcher
+from model_backend import StubBackend
+
+
+class SlowOperator(Operator):
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+        self.add_operation(self.wait)
+
+    def wait(self):
+        """
+        wait for the model to answer.
+        """
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(0.1)
+        with self.lock:
+            self.active -= 1
+        return "done"
+
+
+@pytest.fixture
+def operator(tmp_path):
+    operator = SlowOperator().set_backend(StubBackend())
+    operator.train(str(tmp_path / "model"), None)
+    return operator
+
+
+def test_run_batch_calls_tools_concurrently(operator):
+    start = time.perf_counter()
+    assert operator.run_batch(["wait"] * 8) == ["done"] * 8
+    assert time.perf_counter() - start < 0.4
+    assert 1 < operator.max_active <= operator.max_concurrency
+
+
+def test_micro_batcher_runs_batches_concurrently(operator):
+    batcher = MicroBatcher(operator, max_batch_size=2, max_wait_ms=1.0, max_concurrent_batches=4)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda _: batcher.submit("wait"), range(8)))
+    assert [result["output"] for result in results] == ["done"] * 8
+    assert time.perf_counter() - start < 0.4
@@ -0,0 +1,25 @@
+from model_backend import ModelBackend, StubBackend
+
+
+class EchoBackend(ModelBackend):
+    def complete_text(self, prompt, model_name=None, system_prompt=None):
+        return prompt.upper()
+
+
+def test_default_stream_counts_one_call():
+    backend = EchoBackend()
+    assert list(backend.stream("hello")) == ["HELLO"]
+    assert backend.call_counts == {"classify": 0, "generate": 0, "generate_text": 0, "stream": 1, "embed": 0}
+    assert backend.generate_text("hello") == "HELLO"
+    assert backend.call_counts["generate_text"] == 1
+
+
+def test_stub_stream_counts_one_call():
+    backend = StubBackend()
+    assert "".join(backend.stream("hello")) == backend.get_completion("hello")
+    assert backend.call_counts == {"classify": 0, "generate": 0, "generate_text": 0, "stream": 1, "embed": 0}
+
+
+def test_stub_lognormal_latency_with_zero_median():
+    backend = StubBackend(latency={"generate_text": ("lognormal", 0, 0.4)})
+    assert backend.generate_text("hello") == backend.get_completion("hello")
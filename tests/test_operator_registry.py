@@ -0,0 +1,38 @@
+from operator_registry import OperatorRegistry
+
+
+class FakeOperator:
+    def load(self, path):
+        self.path = path
+        return self
+
+
+class OtherOperator(FakeOperator):
+    pass
+
+
+def test_register_default_keeps_custom_registration():
+    registry = OperatorRegistry()
+    registry.register("Onboarding", OtherOperator, "custom/")
+    registry.register_default("Onboarding", FakeOperator, "models/Onboarding/")
+    operator = registry.get("Onboarding")
+    assert isinstance(operator, OtherOperator) and operator.path == "custom/"
+
+
+def test_register_default_registers_missing_operator():
+    registry = OperatorRegistry()
+    registry.register_default("Onboarding", FakeOperator, "models/Onboarding/")
+    assert registry.get("Onboarding").path == "models/Onboarding/"
+
+
+def test_register_invalidates_built_operator():
+    registry = OperatorRegistry()
+    registry.register("Onboarding", FakeOperator, "models/Onboarding/")
+    first = registry.get("Onboarding")
+    registry.register("Onboarding", FakeOperator, "models/Onboarding/")
+    assert registry.get("Onboarding") is first
+    registry.register("Onboarding", FakeOperator, "other/")
+    assert not registry.is_loaded("Onboarding")
+    assert registry.get("Onboarding").path == "other/"
+    registry.register("Onboarding", OtherOperator, "other/")
+    assert isinstance(registry.get("Onboarding"), OtherOperator)
@@ -0,0 +1,48 @@
+from base_planning_operator import PlanningOperator
+from model_backend import StubBackend
+
+
+class RecordingPlanningOperator(PlanningOperator):
+    def __init__(self):
+        super().__init__(verbose=False)
+        self.prompts = {}
+
+    def run(self, query, prompt=None, timings=None):
+        self.prompts[query] = prompt
+        return f"done {query}"
+
+
+def test_step_dependencies_default_to_all_earlier_steps():
+    operator = PlanningOperator(verbose=False)
+    steps, dependencies = operator.get_step_dependencies([
+        "Check the calendar.",
+        "Look up the weather (independent).",
+        "Set a reminder.",
+        "Send a message (after step 1 and 3).",
+        "Log the workout (after step 9).",
+        "Share the log (after step 5 and 7).",
+        "Thank the user (after step 7).",
+    ])
+    assert steps == [
+        "Check the calendar.", "Look up the weather", "Set a reminder.", "Send a message", "Log the workout",
+        "Share the log", "Thank the user",
+    ]
+    # References to missing, later or the same steps fall back to all earlier steps.
+    assert dependencies == [[], [], [0, 1], [0, 2], [0, 1, 2, 3], [0, 1, 2, 3, 4], [0, 1, 2, 3, 4, 5]]
+
+
+def test_observations_keep_their_step_numbers():
+    operator = RecordingPlanningOperator()
+    observations = operator.execute_plan(["a", "b (independent)", "c (after step 2)", "d"], "query")
+    assert observations == ["done a", "done b", "done c", "done d"]
+    assert "Previous observations" not in operator.prompts["b"]
+    assert operator.prompts["c"].endswith("Previous observations: 2) done b")
+    assert operator.prompts["d"].endswith("Previous observations: 1) done a; 2) done b; 3) done c")
+
+
+def test_stub_planner_emits_independent_and_dependent_steps():
+    operator = PlanningOperator(verbose=False)
+    completion = StubBackend().get_completion("Tools available:\n- first: a\n- second: b\n- third: c\n")
+    plan = operator.postprocess_enumerated_list(operator.planning_cue + completion.split("\n\n")[0])
+    _, dependencies = operator.get_step_dependencies(plan)
+    assert dependencies == [[], [], [1]]
@@ -0,0 +1,52 @@
+import pytest
+
+from base_planning_operator import EnumeratedListStreamParser, PlanningOperator
+
+
+PLANS = [
+    " Use setReminder for the workout.\n2. Use sendCongratsMessage (after step 1).\n3. Use sendFollowupMessage.",
+    " Check the calendar. 2. Set a reminder at 10.30am. 3. Send a message.\n\n4. Ignored after the blank line.",
+    " A single step without a second marker",
+    " Step one.\n12. Step twelve, numbered oddly.\n13. Last step.\n",
+]
+
+
+def parse(plan):
+    operator = PlanningOperator.__new__(PlanningOperator)
+    operator.enumerated_list_pattern = r'\d+\.\s(.*?)(?=\s*\d+\.\s|\Z)'
+    return operator.postprocess_enumerated_list(" 1." + plan.split("\n\n")[0])
+
+
+def stream(chunks):
+    parser = EnumeratedListStreamParser(prefix=" 1.")
+    items = []
+    for chunk in chunks:
+        items += parser.feed(chunk)
+    return items + parser.finish()
+
+
+@pytest.mark.parametrize("plan", PLANS)
+def test_streamed_plan_matches_parser(plan):
+    assert stream([plan]) == parse(plan)
+
+
+@pytest.mark.parametrize("plan", PLANS)
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5])
+def test_streamed_plan_matches_parser_in_chunks(plan, chunk_size):
+    chunks = [plan[i:i + chunk_size] for i in range(0, len(plan), chunk_size)]
+    assert stream(chunks) == parse(plan)
+
+
+@pytest.mark.parametrize("plan", PLANS)
+def test_list_marker_split_across_chunks(plan):
+    # Split the plan at every position, including inside the "2." and "12." markers.
+    for i in range(1, len(plan)):
+        assert stream([plan[:i], plan[i:]]) == parse(plan)
+
+
+def test_items_are_emitted_once_complete():
+    parser = EnumeratedListStreamParser(prefix=" 1.")
+    assert parser.feed(" First step.\n2") == []
+    assert parser.feed(". Second") == ["First step."]
+    assert parser.feed(" step.\n\n3. ignored") == ["Second step."]
+    assert parser.finish() == []
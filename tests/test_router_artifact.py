@@ -0,0 +1,88 @@
+import hashlib
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from fast_router import FastRouter
+from model_backend import StubClassifier
+from router_artifact import MappedClassifier, check_artifact, export_router
+
+
+class FakeLogisticRegression:
+    def __init__(self, n_classes, dimensions, seed=0):
+        generator = np.random.default_rng(seed)
+        self.classes_ = np.arange(n_classes)
+        self.coef_ = generator.normal(size=(1 if n_classes == 2 else n_classes, dimensions))
+        self.intercept_ = generator.normal(size=self.coef_.shape[0])
+
+    def predict_proba(self, embeddings):
+        logits = embeddings @ self.coef_.T + self.intercept_
+        if self.coef_.shape[0] == 1:
+            positive = 1.0 / (1.0 + np.exp(-logits))
+            return np.hstack([1.0 - positive, positive])
+        probabilities = np.exp(logits - logits.max(axis=1, keepdims=True))
+        return probabilities / probabilities.sum(axis=1, keepdims=True)
+
+
+class FakeLaminiClassifier:
+    '''
+    Has the attributes of a trained LaminiClassifier that export_router reads, with deterministic local embeddings.
+    '''
+    def __init__(self, class_names, dimensions=16):
+        self.config = {"production": {"key": "secret", "url": "https://api.example.com"}}
+        self.class_ids_to_metadata = {i: {"class_name": name} for i, name in enumerate(class_names)}
+        self.logistic_regression = FakeLogisticRegression(len(class_names), dimensions)
+        self.dimensions = dimensions
+
+    def get_embeddings(self, data):
+        return np.array([
+            np.random.default_rng(int(hashlib.sha256(text.encode()).hexdigest()[:8], 16)).normal(size=self.dimensions)
+            for text in data
+        ])
+
+    def predict_proba(self, data):
+        return self.logistic_regression.predict_proba(self.get_embeddings(data))
+
+
+QUERIES = ["I want to order a pizza", "where is my order", "cancel it", "hello there"]
+
+
+@pytest.mark.parametrize("class_names", [["order", "track"], ["order", "track", "cancel"]])
+def test_artifact_probabilities_match_classifier(tmp_path, class_names):
+    classifier = FakeLaminiClassifier(class_names)
+    router = SimpleNamespace(classifier=classifier, fast_router=None)
+    path = str(tmp_path / "router.bin")
+    export_router(router, path)
+    check_artifact(router, path, QUERIES)
+
+    mapped = MappedClassifier.load(path, embed=classifier.get_embeddings)
+    assert [mapped.class_ids_to_metadata[i]["class_name"] for i in range(len(class_names))] == class_names
+    np.testing.assert_allclose(mapped.predict_proba(QUERIES), classifier.predict_proba(QUERIES), atol=1e-5)
+
+
+def test_artifact_keeps_embedding_config_without_credentials(tmp_path):
+    router = SimpleNamespace(classifier=FakeLaminiClassifier(["order", "track"]), fast_router=None)
+    path = str(tmp_path / "router.bin")
+    export_router(router, path)
+    assert MappedClassifier.load(path).embedding_config == {"production": {"url": "https://api.example.com"}}
+
+
+def test_check_artifact_detects_mismatch(tmp_path):
+    classifier = FakeLaminiClassifier(["order", "track", "cancel"])
+    router = SimpleNamespace(classifier=classifier, fast_router=None)
+    path = str(tmp_path / "router.bin")
+    export_router(router, path)
+    classifier.logistic_regression.coef_ = classifier.logistic_regression.coef_[::-1].copy()
+    with pytest.raises(Exception, match="does not match"):
+        check_artifact(router, path, QUERIES)
+
+
+def test_export_rejects_classifier_without_weights(tmp_path):
+    classifier = StubClassifier()
+    classifier.add_data_to_class("order", ["order a pizza"])
+    classifier.add_data_to_class("track", ["where is my order"])
+    classifier.train()
+    router = SimpleNamespace(classifier=classifier, fast_router=FastRouter().fit(classifier.class_examples))
+    with pytest.raises(Exception, match="Cannot export a router with a StubClassifier"):
+        export_router(router, str(tmp_path / "router.bin"))
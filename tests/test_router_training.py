@@ -0,0 +1,204 @@
+import os
+import json
+
+from model_backend import StubBackend
+from llm_routing_agent import LLMRoutingAgent
+from router_training import RouterTrainer
+
+
+CLASSES = {"order": "order food from a restaurant.", "track": "track the delivery of an order."}
+
+
+def write_training_file(path, rows):
+    path.write_text("class_name,data\n" + "".join(f'{class_name},"{data}"\n' for class_name, data in rows))
+    return str(path)
+
+
+def list_files(directory):
+    return sorted(os.listdir(directory)) if os.path.exists(directory) else []
+
+
+def test_training_again_reuses_the_router(tmp_path):
+    training_file = write_training_file(tmp_path / "train.csv", [("order", "I want a pizza"), ("track", "where is my food")])
+    backend = StubBackend()
+    trainer = RouterTrainer(str(tmp_path / "model" / "router.pkl"), backend)
+    assert trainer.train(CLASSES, training_file)
+    calls = dict(backend.call_counts)
+    assert not RouterTrainer(str(tmp_path / "model" / "router.pkl"), backend).train(CLASSES, training_file)
+    assert backend.call_counts == calls
+
+
+def test_training_rows_are_the_classifier_examples(tmp_path):
+    training_file = write_training_file(tmp_path / "train.csv", [("order", "I want a pizza")])
+    trainer = RouterTrainer(str(tmp_path / "model" / "router.pkl"), StubBackend())
+    trainer.train(CLASSES, training_file)
+    examples = trainer.load_examples()
+    assert examples["order"] == ["I want a pizza"]
+    assert examples["track"][0] == CLASSES["track"]
+
+
+def test_router_without_manifest_is_adopted(tmp_path):
+    training_file = write_training_file(tmp_path / "train.csv", [("order", "I want a pizza"), ("track", "where is my food")])
+    router_path = str(tmp_path / "model" / "router.pkl")
+    RouterTrainer(router_path, StubBackend()).train(CLASSES, training_file)
+    os.remove(str(tmp_path / "model" / "router.manifest.json"))
+    with open(router_path, "rb") as f:
+        router = f.read()
+
+    backend = StubBackend()
+    assert not RouterTrainer(router_path, backend).train(CLASSES, training_file)
+    assert sum(backend.call_counts.values()) == 0
+    with open(router_path, "rb") as f:
+        assert f.read() == router
+    assert os.path.exists(str(tmp_path / "model" / "router.manifest.json"))
+    assert not RouterTrainer(router_path, backend).train(CLASSES, training_file)
+
+
+def test_unreferenced_artifacts_are_pruned(tmp_path):
+    directory = tmp_path / "model"
+    router_path = str(directory / "router.pkl")
+    training_file = write_training_file(tmp_path / "train.csv", [("order", "I want a pizza"), ("track", "where is my food")])
+    RouterTrainer(router_path, StubBackend()).train(CLASSES, training_file)
+    RouterTrainer(str(directory / "flat_router.pkl"), StubBackend()).train({"order": CLASSES["order"]}, training_file)
+
+    training_file = write_training_file(tmp_path / "train.csv", [("order", "I want a burger"), ("track", "where is my food")])
+    trainer = RouterTrainer(router_path, StubBackend())
+    assert trainer.train(CLASSES, training_file)
+
+    referenced = set()
+    for name in ["router.manifest.json", "flat_router.manifest.json"]:
+        with open(directory / name) as f:
+            manifest = json.load(f)
+        referenced.update(manifest["classes"].values())
+        referenced.add(manifest["router"])
+    examples = list_files(directory / "examples")
+    routers = list_files(directory / "routers")
+    assert {name.split(".")[0] for name in examples} <= referenced
+    assert {name.split(".")[0].replace("fast_", "") for name in routers} <= referenced
+    # The current and the flat router, each with its fast-path router.
+    assert len(routers) == 4
+    # order and track of the router, and the order class of the flat router, which has no track rows to change.
+    assert len(examples) == 3
+
+
+def test_chunk_size_does_not_change_the_router(tmp_path):
+    rows = [("order", f"I want {i} pizzas") for i in range(7)] + [("track", f"where is order {i}") for i in range(5)]
+    training_file = write_training_file(tmp_path / "train.csv", rows)
+    manifests = []
+    for chunk_size in [2, 10000]:
+        trainer = RouterTrainer(str(tmp_path / f"model_{chunk_size}" / "router.pkl"), StubBackend(), chunk_size=chunk_size)
+        trainer.train(CLASSES, training_file)
+        with open(trainer.manifest_path) as f:
+            manifests.append(json.load(f))
+        assert trainer.load_examples()["order"] == [data for class_name, data in rows if class_name == "order"]
+    assert manifests[0] == manifests[1]
+
+
+def test_examples_are_embedded_in_chunks(tmp_path, monkeypatch):
+    from model_backend import StubClassifier
+
+    sizes = []
+    embed = StubClassifier.embed
+    monkeypatch.setattr(StubClassifier, "embed", staticmethod(lambda data: sizes.append(len(data)) or embed(data)))
+    rows = [("order", f"I want {i} pizzas") for i in range(7)]
+    training_file = write_training_file(tmp_path / "train.csv", rows)
+    RouterTrainer(str(tmp_path / "model" / "router.pkl"), StubBackend(), chunk_size=3).train(CLASSES, training_file)
+    # The 7 order rows in chunks of 3, and the description of track.
+    assert sorted(sizes) == [1, 1, 3, 3]
+
+
+def test_fit_trains_from_a_training_file(tmp_path):
+    training_file = write_training_file(tmp_path / "train.csv", [("order", "I want a pizza"), ("track", "where is my food")])
+    router = LLMRoutingAgent(str(tmp_path / "router.pkl"), backend=StubBackend())
+    router.fit(CLASSES, training_file)
+    assert router.predict(["I want a pizza"])[0] == ["order"]
+
+    router = LLMRoutingAgent(str(tmp_path / "prompt_router.pkl"), backend=StubBackend())
+    router.fit(CLASSES)
+    assert router.predict(["track the delivery of an order."])[0] == ["track"]
+
+
+def test_csv_values_lose_the_space_and_quotes_after_the_comma(tmp_path):
+    from training_data import TrainingDataReader
+
+    path = tmp_path / "train.csv"
+    path.write_text('class_name,data\norder, "I\'d like a bag of apples, please"\ntrack,where is it\n')
+    assert TrainingDataReader(CLASSES).read(str(path)) == {
+        "order": ["I'd like a bag of apples, please"],
+        "track": ["where is it"],
+    }
+
+
+def test_adding_rows_to_a_class_only_embeds_that_class(tmp_path):
+    rows = [("order", "I want a pizza"), ("track", "where is my food")]
+    router_path = str(tmp_path / "model" / "router.pkl")
+    RouterTrainer(router_path, StubBackend()).train(CLASSES, write_training_file(tmp_path / "train.csv", rows))
+
+    backend = StubBackend()
+    trainer = RouterTrainer(router_path, backend)
+    assert trainer.train(CLASSES, write_training_file(tmp_path / "train.csv", rows + [("order", "get me a burger")]))
+    assert trainer.counts["embedded"] == 1
+    assert backend.call_counts["embed"] == 1
+
+    router = LLMRoutingAgent(router_path, backend=StubBackend())
+    assert router.predict(["get me a burger", "where is my food"])[0] == ["order", "track"]
+
+
+def test_classes_without_rows_are_prompt_trained(tmp_path, monkeypatch):
+    from model_backend import StubClassifier
+
+    prompt_trained = []
+    prompt_train = StubClassifier.prompt_train
+    monkeypatch.setattr(
+        StubClassifier, "prompt_train", lambda self, classes: prompt_trained.append(classes) or prompt_train(self, classes)
+    )
+    backend = StubBackend()
+    RouterTrainer(str(tmp_path / "model" / "router.pkl"), backend).train(CLASSES)
+    assert prompt_trained == [CLASSES]
+    assert backend.call_counts["generate_text"] == 0
+
+    trainer = RouterTrainer(str(tmp_path / "generated" / "router.pkl"), backend, generate_examples=True)
+    trainer.train(CLASSES)
+    assert len(prompt_trained) == 1
+    assert trainer.load_examples()["order"][0] == CLASSES["order"]
+
+
+def test_router_is_swapped_in_as_a_link(tmp_path):
+    directory = tmp_path / "model"
+    router_path = str(directory / "router.pkl")
+    RouterTrainer(router_path, StubBackend()).train(CLASSES, write_training_file(tmp_path / "train.csv", [("order", "pizza")]))
+    stored = os.path.realpath(router_path)
+    assert os.path.islink(router_path) and os.path.dirname(stored) == str(directory / "routers")
+    assert os.path.realpath(LLMRoutingAgent.get_fast_router_path(router_path)) == LLMRoutingAgent.get_fast_router_path(stored)
+
+    # A router loaded from the old link keeps its own fast-path router after a new one is swapped in.
+    router = LLMRoutingAgent(router_path, backend=StubBackend())
+    RouterTrainer(router_path, StubBackend()).train(CLASSES, write_training_file(tmp_path / "train.csv", [("order", "burger")]))
+    assert os.path.realpath(router_path) != stored
+    assert router.predict(["pizza"])[0] == ["order"]
+
+
+def test_files_of_unfinished_trainings_are_pruned(tmp_path):
+    from router_training import is_running
+
+    dead_pid = next(pid for pid in range(2 ** 22, 2 ** 22 + 1000) if not is_running(pid))
+    directory = tmp_path / "model"
+    (directory / "routers").mkdir(parents=True)
+    leftovers = [f"abc.pkl.{dead_pid}.partial", f"fast_abc.pkl.{dead_pid}.npz", f"def.pkl.{os.getpid()}.partial"]
+    for name in leftovers:
+        (directory / "routers" / name).write_text("")
+    RouterTrainer(str(directory / "router.pkl"), StubBackend()).train(CLASSES)
+    routers = list_files(directory / "routers")
+    assert leftovers[0] not in routers and leftovers[1] not in routers
+    assert leftovers[2] in routers
+
+
+def test_stage_counts_under_concurrency(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+
+    router = LLMRoutingAgent(str(tmp_path / "router.pkl"), backend=StubBackend())
+    router.fit(CLASSES, write_training_file(tmp_path / "train.csv", [("order", "I want a pizza"), ("track", "where is my food")]))
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda i: router.predict([f"I want a pizza {i}", "hello"]), range(200)))
+    report = router.get_stage_report()
+    assert report["fast_router"]["count"] + report["classifier"]["count"] == 400
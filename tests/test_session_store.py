@@ -0,0 +1,90 @@
+import threading
+
+from session_store import Session, SQLiteSessionStore
+
+
+def render(session):
+    return Session(session.conversation_id, **session.to_dict()).get_history()
+
+
+def test_history_is_extended_with_new_turns(monkeypatch):
+    session = Session("c", max_recent_turns=4)
+    renders = []
+    render_history = Session._Session__render_history
+    monkeypatch.setattr(Session, "_Session__render_history", lambda self: renders.append(1) or render_history(self))
+
+    assert session.get_prefix("head: ") == "head: "
+    session.add_turn("User", "hi")
+    session.add_turn("System", "hello")
+    assert session.get_prefix("head: ") == "head: User: hi\nSystem: hello"
+    session.add_turn("User", "how are you?")
+    assert session.get_prefix("other head: ") == "other head: User: hi\nSystem: hello\nUser: how are you?"
+    assert len(renders) == 1
+    assert session.get_history() == render(session)
+
+
+def test_history_is_rendered_again_when_the_summary_changes():
+    session = Session("c", max_recent_turns=2)
+    for i in range(3):
+        session.add_turn("User", f"message {i}.")
+        session.get_history()
+    assert session.summary
+    assert session.get_history() == render(session)
+    assert session.get_history().startswith("Summary of earlier conversation: User: message 0.")
+
+
+def test_only_the_latest_rendering_is_kept():
+    session = Session("c")
+    session.add_turn("User", "hi")
+    for i in range(10):
+        session.get_prefix(f"head {i}: ")
+    assert session.rendered == (1, 0, "User: hi")
+
+
+def test_sqlite_sessions_survive_a_restart(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    store = SQLiteSessionStore(path)
+    session = store.get("c")
+    session.add_turn("User", "hi")
+    store.save(session)
+
+    session = SQLiteSessionStore(path).get("c")
+    assert session.turns == [("User", "hi")]
+    assert session.turn_count == 1
+
+
+def test_sqlite_sessions_are_reloaded_after_another_store_adds_turns(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    first, second = SQLiteSessionStore(path), SQLiteSessionStore(path)
+    session = first.get("c")
+    session.add_turn("User", "hi")
+    first.save(session)
+    assert first.get("c").get_history() == "User: hi"
+
+    session = second.get("c")
+    session.add_turn("System", "hello")
+    second.save(session)
+    assert first.get("c").get_history() == "User: hi\nSystem: hello"
+
+    second.delete("c")
+    assert not SQLiteSessionStore(path).get("c")
+
+
+def test_sqlite_concurrent_appends_are_all_saved(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    store = SQLiteSessionStore(path, max_recent_turns=100)
+
+    def append(i):
+        for j in range(5):
+            session = store.get("c")
+            session.add_turn("User", f"message {i} {j}")
+            store.save(session)
+
+    threads = [threading.Thread(target=append, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    session = SQLiteSessionStore(path, max_recent_turns=100).get("c")
+    assert session.turn_count == 40
+    assert len(session.turns) == 40
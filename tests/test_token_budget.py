@@ -0,0 +1,73 @@
+from base_operator import ArgumentExtractor, ARGS_PROMPT_TEMPLATE
+from planning_motivation_operator import PlanningMotivationOperator
+from token_budget import TokenBudget
+
+
+def count_words(text):
+    return len(text.split())
+
+
+def make_budget(default_budget=100, **kwargs):
+    return TokenBudget(default_budget=default_budget, reserve_tokens=0, tokenizer=count_words, **kwargs)
+
+
+def test_truncate_keeps_the_start_or_the_end():
+    budget = make_budget()
+    text = "one two three four five six"
+    assert budget.truncate(text, 10) is text
+    assert budget.truncate(text, 4) == "one two three…"
+    assert budget.truncate(text, 4, keep_end=True) == "…four five six"
+    assert count_words(budget.truncate(text, 4)) <= 4
+
+
+def test_truncate_cuts_at_word_boundaries():
+    budget = TokenBudget(reserve_tokens=0, tokenizer=len)
+    assert budget.truncate("alpha beta gamma", 9) == "alpha…"
+    assert budget.truncate("alpha beta gamma", 9, keep_end=True) == "…gamma"
+
+
+def test_fit_sections_drops_the_least_relevant_first():
+    budget = make_budget()
+    sections = {"a": "one two", "b": "three four", "c": "five six"}
+    assert budget.fit_sections(sections, 6, {"a": 3, "b": 1, "c": 2}) == ["a", "b", "c"]
+    assert budget.fit_sections(sections, 4, {"a": 3, "b": 1, "c": 2}) == ["a", "c"]
+    assert budget.fit_sections(sections, 0, {"a": 3, "b": 1, "c": 2}) == ["a"]
+    assert budget.fit_sections(sections, 0, {"a": 3, "b": 1, "c": 2}, min_sections=2) == ["a", "c"]
+
+
+def test_fit_observations_truncates_the_oldest_first():
+    budget = make_budget()
+    observations = ["old one two three four", "new five six"]
+    assert budget.fit_observations(observations, 8) == observations
+    fitted = budget.fit_observations(observations, 6)
+    assert fitted[1] == "new five six"
+    assert fitted[0].endswith("…") and sum(map(count_words, fitted)) <= 6
+
+
+def test_argument_extraction_keeps_a_share_of_the_budget_for_the_query():
+    class Operator:
+        backend = None
+        model_name = "model"
+
+    budget = make_budget(default_budget=count_words(ARGS_PROMPT_TEMPLATE) + 20, min_query_share=0.1)
+    extractor = ArgumentExtractor(Operator(), "operation", [], " ".join(["argument"] * 40), token_budget=budget)
+    query = " ".join(f"word{i}" for i in range(50))
+    fitted = extractor.fit_query(query, "model")
+    assert fitted.endswith("word49")
+    assert 1 < count_words(fitted) <= int(budget.get_budget("model") * 0.1)
+
+
+def test_planning_prompt_drops_tools_before_the_chat_history():
+    operator = PlanningMotivationOperator()
+    history = "\n".join(f"user: I ran {i} miles today" for i in range(50))
+    prompt = operator.render_planning_prompt("remind me to work out", history, operator.create_tools_prompt())
+    tools = operator.get_tool_prompts()
+    longest_tool = max(count_words(tool) for tool in tools.values())
+    operator.enable_token_budget(
+        default_budget=count_words(prompt) - sum(count_words(tool) for tool in tools.values()) + longest_tool,
+        reserve_tokens=0,
+        tokenizer=count_words,
+    )
+    fitted = operator.fit_planning_prompt("remind me to work out", history, prompt)
+    assert history in fitted
+    assert 1 <= sum(tool in fitted for tool in tools.values()) < len(tools)
@@ -0,0 +1,132 @@
+import time
+import random
+
+import numpy as np
+
+from fast_router import FastRouter
+from tool_index import ToolIndex
+
+
+def make_catalog(operations=150, examples=200, seed=0):
+    rng = random.Random(seed)
+    vocabulary = [f"word{i}" for i in range(2000)]
+    catalog = {}
+    for i in range(operations):
+        topic = [f"topic{i}a", f"topic{i}b"]
+        catalog[f"operation_{i}"] = [
+            f"please {rng.choice(topic)} the " + " ".join(rng.choices(vocabulary, k=8)) for _ in range(examples)
+        ]
+    return catalog
+
+
+def test_search_ranks_the_matching_operation_first():
+    index = ToolIndex()
+    index.add("order_food", ["Order food from a restaurant", "get me a pizza", "I want sushi delivered"])
+    index.add("track_order", ["Track the status of an order", "where is my delivery"])
+    index.add("cancel_order", ["Cancel an order", "cancel my pizza order"])
+
+    assert index.search("where is my delivery")[0][0] == "track_order"
+    assert index.search("cancel the pizza", k=1)[0][0] == "cancel_order"
+    assert index.search("unrelated words") == []
+
+
+def test_stopwords_and_common_terms_are_not_indexed():
+    index = ToolIndex(min_cutoff_operations=3)
+    index.add("order_food", ["order pizza for the table"])
+    index.add("track_order", ["track order status"])
+    index.add("cancel_order", ["cancel order now"])
+
+    assert index.search("the") == []
+    assert index.search("order") == []
+    assert [name for name, _ in index.search("order pizza")] == ["order_food"]
+
+
+def test_search_sees_documents_added_later():
+    index = ToolIndex()
+    index.add("order_food", ["order pizza"])
+    index.add("track_order", ["track delivery"])
+    assert index.search("refund") == []
+    index.add("refund_order", ["refund my money"])
+    assert index.search("refund")[0][0] == "refund_order"
+
+
+def test_search_is_fast_on_a_large_catalog():
+    index = ToolIndex()
+    for name, examples in make_catalog().items():
+        index.add(name, examples)
+    index.search("warm up")
+
+    start = time.perf_counter()
+    for i in range(100):
+        results = index.search(f"please topic{i}a the word1 word2 word3", k=10)
+        assert results[0][0] == f"operation_{i}"
+    assert (time.perf_counter() - start) / 100 < 0.005
+
+
+def test_single_candidate_scores_against_all_classes():
+    router = FastRouter(threshold=0.5).fit({
+        "order_food": ["order a pizza", "get me sushi"],
+        "track_order": ["where is my delivery", "track my order"],
+        "cancel_order": ["cancel my order", "stop the delivery"],
+    })
+    probabilities, confident = router.predict_proba(["order pizza"], [["track_order"]])
+    assert router.class_names[int(np.argmax(probabilities[0]))] == "order_food"
+    assert np.count_nonzero(probabilities[0]) == 3
+    probabilities, confident = router.predict_proba(["order pizza"], [["track_order", "cancel_order"]])
+    assert probabilities[0][router.class_names.index("order_food")] == 0
+
+
+def test_small_catalogs_keep_shared_terms():
+    index = ToolIndex()
+    index.add("search", ["search the grocery catalog for food"])
+    index.add("order", ["order food from the grocery"])
+    index.add("noop", ["do nothing"])
+
+    assert [name for name, _ in index.search("grocery food")] == ["order", "search"]
+
+
+def test_shortlist_is_padded_to_k():
+    from base_operator import Operator
+
+    class CatalogOperator(Operator):
+        def __init__(self):
+            super().__init__()
+            for name in ["search", "order", "track", "cancel"]:
+                self.add_operation(getattr(self, name))
+
+        def search(self, item: str):
+            """
+            search the catalog for an item.
+
+            Parameters:
+            item: the item to look for
+            """
+
+        def order(self, item: str):
+            """
+            order an item.
+
+            Parameters:
+            item: the item to buy
+            """
+
+        def track(self, order_id: str):
+            """
+            track the delivery of a purchase.
+
+            Parameters:
+            order_id: id of the purchase
+            """
+
+        def cancel(self, order_id: str):
+            """
+            cancel a purchase.
+
+            Parameters:
+            order_id: id of the purchase
+            """
+
+    operator = CatalogOperator().enable_tool_shortlist(k=3)
+    assert operator.shortlist_operations("search for apples") == ["search", "order", "track"]
+    assert operator.shortlist_operations("nothing relevant here") is None
+    assert CatalogOperator().enable_tool_shortlist(k=4).shortlist_operations("search for apples") is None
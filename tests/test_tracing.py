@@ -0,0 +1,55 @@
+import json
+import time
+
+from tracing import OTLPExporter, Tracer
+
+
+class SlowOTLPExporter(OTLPExporter):
+    def __init__(self, path, **kwargs):
+        super().__init__(path=path, **kwargs)
+        self.sent = []
+
+    def send(self, spans):
+        time.sleep(0.2)
+        self.sent.append(len(spans))
+        super().send(spans)
+
+
+def trace(exporter, count):
+    tracer = Tracer()
+    tracer.add_exporter(exporter)
+    for i in range(count):
+        with tracer.span("run", step=i):
+            pass
+
+
+def read_spans(path):
+    with open(path) as f:
+        return [span for line in f for span in json.loads(line)["resourceSpans"][0]["scopeSpans"][0]["spans"]]
+
+
+def test_export_does_not_wait_for_send(tmp_path):
+    exporter = SlowOTLPExporter(str(tmp_path / "spans.jsonl"), max_batch_size=2)
+    start = time.perf_counter()
+    trace(exporter, 6)
+    assert time.perf_counter() - start < 0.1
+    exporter.flush()
+    assert sum(exporter.sent) == 6
+    assert [span["name"] for span in read_spans(tmp_path / "spans.jsonl")] == ["run"] * 6
+
+
+def test_flush_sends_partial_batch(tmp_path):
+    exporter = OTLPExporter(path=str(tmp_path / "spans.jsonl"), max_batch_size=100, flush_interval=60)
+    trace(exporter, 3)
+    exporter.flush()
+    assert len(read_spans(tmp_path / "spans.jsonl")) == 3
+    exporter.flush()
+    assert len(read_spans(tmp_path / "spans.jsonl")) == 3
+
+
+def test_spans_are_dropped_when_queue_is_full(tmp_path):
+    exporter = SlowOTLPExporter(str(tmp_path / "spans.jsonl"), max_batch_size=1, max_queue_size=2)
+    trace(exporter, 10)
+    exporter.flush()
+    assert exporter.dropped > 0
+    assert sum(exporter.sent) + exporter.dropped == 10